@@ -1,14 +1,30 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 import db as db_module
-import bcrypt
+import broker
+import json
 import secrets
+import login_limiter
 import mailer
-import threading
+import passwords
+import mail_queue
+import media
+import response_cache
+import session_reaper
+import uploads
 import os
+import time
+from html import escape as escape_html
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
+# 上传接口的文件在解析 multipart 时流式写入临时文件并计算哈希，见 uploads.py；其他接口不受影响
+app.request_class = uploads.UploadRequest
+uploads.UploadRequest.upload_endpoints = frozenset({"upload_media"})
+app.config["MAX_CONTENT_LENGTH"] = uploads.UPLOAD_MAX_BYTES
+# 媒体文件交给前端服务器发送（见 media.py 的 MEDIA_SERVE_MODE）
+app.config["USE_X_SENDFILE"] = media.MEDIA_SERVE_MODE == "x-sendfile"
 # 允许跨域请求
 # CORS will be configured after FRONTEND_URL is defined so we can restrict allowed origins
 
@@ -20,7 +36,14 @@ APP_NAME = "泥邮工具人"
 BACKEND_URL = "http://localhost:5000"
 FRONTEND_URL = "http://localhost:5173"
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'media')
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'mov', 'avi'}
+# 消息历史分页：默认每页条数与上限
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 200
+# 商品列表分页：默认每页条数与上限
+GOODS_PAGE_SIZE = 20
+GOODS_PAGE_MAX = 100
+# SSE 空闲心跳间隔（秒），用于保活连接并及时发现已断开的客户端
+SSE_HEARTBEAT_SECONDS = 15
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -32,9 +55,46 @@ except Exception:
     # fallback to permissive CORS if something unexpected happens
     CORS(app)
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# 导入时初始化数据库表结构并执行未完成的迁移（gunicorn 等直接导入 app 的部署方式同样会执行）。
+# 迁移失败时异常直接抛出、中止启动，不在迁移了一半的表结构上提供服务
+db_module.init_db()
+# 确定 bcrypt 工作因子（BCRYPT_ROUNDS=auto 时读取保存的校准结果，没有时按本机速度校准），不让第一个注册/登录请求等待
+passwords.rounds()
+
+def avatar_url(user_id, path):
+    """头像链接：上传过头像时返回 /media 下的路径（文件名含内容哈希，换头像即换链接），否则返回默认头像"""
+    if path:
+        return f"/media/{path}"
+    return f"https://picsum.photos/seed/{user_id}/150/150"
+
+def serialize_message(m):
+    """消息的对外 JSON 结构"""
+    return {
+        "id": m['id'],
+        "senderId": m['sender_id'],
+        "receiverId": m['receiver_id'],
+        "text": m['text'],
+        "createdAt": m['created_at']
+    }
+
+def search_marks_to_html(text):
+    """把搜索结果里的高亮标记转成 <mark>，其余内容按 HTML 转义"""
+    if text is None:
+        return None
+    return (
+        escape_html(text)
+        .replace(db_module.SEARCH_MARK_START, "<mark>")
+        .replace(db_module.SEARCH_MARK_END, "</mark>")
+    )
+
+def attach_images(goods):
+    """给商品附上图片链接 image_urls 与封面 cover_url（一次批量查询，不扫描媒体目录）"""
+    media = db_module.get_goods_media([good["id"] for good in goods])
+    for good in goods:
+        urls = [f"/media/{path}" for path in media.get(good["id"], [])]
+        good["image_urls"] = urls
+        good["cover_url"] = urls[0] if urls else None
+    return goods
 
 def get_current_user_from_request():
     """从请求中获取当前用户，优先检查 Authorization: Bearer <token>，其次检查 cookie 中的 session_token。返回用户 dict 或 None。"""
@@ -45,6 +105,7 @@ def get_current_user_from_request():
         if token:
             user = db_module.get_user_by_session(token)
             if user:
+                user.pop("session_refreshed_until", None)
                 return user
 
     # 2. Cookie
@@ -52,20 +113,84 @@ def get_current_user_from_request():
     if session_token:
         user = db_module.get_user_by_session(session_token)
         if user:
+            # session 被顺延（滑动过期）时，cookie 的有效期也要跟着延长
+            refreshed_until = user.pop("session_refreshed_until", None)
+            if refreshed_until:
+                g.session_cookie_refresh = (session_token, refreshed_until)
             return user
 
     return None
 
+@app.before_request
+def start_session_reaper():
+    """
+    启动过期 session 的清理线程。放在请求钩子里而不是 __main__，
+    gunicorn 等直接导入 app 的部署方式（以及 fork 出的每个 worker）同样会启动；已启动时只是一次判断
+    """
+    session_reaper.start()
+
+@app.before_request
+def start_mail_queue():
+    """
+    启动邮件发送队列（补发上次退出前未完成的邮件、到期的重试）。与 session 清理线程一样放在请求钩子里，
+    每个 worker 进程都会启动；已退出的发送线程也在这里补齐
+    """
+    mail_queue.start()
+
+@app.after_request
+def refresh_session_cookie(response):
+    """把本次请求中顺延过的 session 重新写入 cookie"""
+    refresh = g.pop("session_cookie_refresh", None)
+    if refresh:
+        session_token, refreshed_until = refresh
+        response.set_cookie(
+            'session_token',
+            session_token,
+            httponly=True,
+            secure=True,
+            samesite='None',
+            max_age=max(0, refreshed_until - int(time.time()))
+        )
+    return response
+
 @app.route("/")
 def hello():
     """根路由，测试后端是否存活"""
     return jsonify({"message": "Backend is running!"})
 
 
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """运行指标：数据库写队列深度与写延迟等"""
+    return jsonify({
+        "db_writer": db_module.get_write_stats(),
+        "session_cache": db_module.get_session_cache_stats(),
+        "push": broker.get_broker().stats(),
+        "mail_queue": mail_queue.stats(),
+        "response_cache": response_cache.stats(),
+        "passwords": passwords.stats(),
+        "login_limiter": login_limiter.stats(),
+        "login_miss_cache": db_module.get_login_miss_cache_stats(),
+        "session_reaper": session_reaper.stats(),
+    })
+
+
 @app.route("/labels", methods=["GET"])
 def get_labels():
-    """获取所有标签"""
-    return jsonify(db_module.get_all_labels())
+    """获取所有标签（直接返回预先序列化好的内容，带 ETag）"""
+    payload, etag = db_module.get_labels_payload()
+    response = Response(payload, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@app.errorhandler(passwords.Busy)
+def password_hasher_busy(e):
+    """密码哈希队列已满：让客户端稍后重试，而不是占住请求线程排队"""
+    response = jsonify({"error": "服务繁忙，请稍后再试"})
+    response.headers["Retry-After"] = "1"
+    return response, 429
 
 
 @app.route("/user/register", methods=["POST"])
@@ -89,8 +214,8 @@ def create_user():
     if not email:
         return jsonify({"error": "Email is required"}), 400
 
-    # 密码加密
-    pswd_hash = bcrypt.hashpw(pswd.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    # 密码加密（在进程池中计算，队列满时返回 429）
+    pswd_hash = passwords.hash_password(pswd)
     # 生成验证 Token
     confirmation_token = secrets.token_urlsafe(32)
 
@@ -111,20 +236,19 @@ def create_user():
             current_year=2025
         )
         
-        # 定义异步发送任务
-        def send_async_email():
-            mailer.send_email(
-                to_email=email,
-                to_name=name,
-                subject="完成注册 - 泥邮工具人",
-                content="请点击链接完成注册。",
-                html=html
-            )
-
-        # 启动线程发送邮件
-        threading.Thread(target=send_async_email).start()
+        # 写入邮件发送队列，由后台工作线程发送
+        mail_queue.enqueue(
+            to_email=email,
+            to_name=name,
+            subject="完成注册 - 泥邮工具人",
+            content="请点击链接完成注册。",
+            html=html
+        )
         
         return jsonify({"message": "User created, confirmation email sent", "user_id": user['id']}), 201
+    except ValueError as e:
+        # 用户名或邮箱已被占用
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -145,29 +269,24 @@ def login():
     if not identifier or not password:
         return jsonify({"error": "请输入账号和密码"}), 400
 
+    # 同一账号短时间内失败次数过多时直接拒绝，不查库也不计算 bcrypt
+    wait = login_limiter.retry_after(identifier)
+    if wait > 0:
+        response = jsonify({"error": "尝试次数过多，请稍后再试"})
+        response.headers["Retry-After"] = str(int(wait) + 1)
+        return response, 429
+
     try:
-        conn = db_module._get_conn()
-        # 在数据库查找用户
-        user = conn.execute("SELECT * FROM users WHERE name = ? OR email = ?", (identifier, identifier)).fetchone()
-        conn.close()
+        # 只取校验所需的字段（唯一索引查找；不存在的账号短时间内不会重复查库）
+        user = db_module.find_user_for_login(identifier)
 
         if user:
-            # 获取数据库中的 Hash 密码
+            # 验证密码（在进程池中计算，队列满时返回 429）
             stored_hash = user['pswd_hash']
-            if isinstance(stored_hash, str):
-                stored_hash = stored_hash.encode('utf-8')
-
-            # 验证密码
-            if bcrypt.checkpw(password.encode('utf-8'), stored_hash):
+            if stored_hash and passwords.verify_password(password, stored_hash):
+                login_limiter.reset(identifier)
                 # 在允许登录前，检查邮箱是否已验证
-                try:
-                    verified = user['verified']
-                except Exception:
-                    # 如果 Row 不支持直接索引（极少见），尝试通过 get
-                    try:
-                        verified = user.get('verified')
-                    except Exception:
-                        verified = None
+                verified = user['verified']
 
                 # 归一化可能的字符串/数字表示
                 if isinstance(verified, str):
@@ -179,16 +298,24 @@ def login():
                 if not verified:
                     return jsonify({"error": "请先验证邮箱后再登录"}), 403
 
+                # 工作因子配置变化后，用本次登录的明文密码按新配置重新哈希
+                if passwords.needs_rehash(stored_hash):
+                    try:
+                        db_module.update_password_hash(user['id'], passwords.hash_password(password))
+                    except passwords.Busy:
+                        pass
+
                 # 创建session
                 session_token = db_module.create_session(user['id'], expires_hours=24)
+                profile = db_module.get_user(user['id'])
 
                 payload = {
                     "message": "Login successful",
                     "user": {
                         "id": user['id'],
-                        "name": user['name'],
-                        "email": user['email'],
-                        "avatar": f"https://picsum.photos/seed/{user['id']}/150/150",
+                        "name": profile['name'],
+                        "email": profile['email'],
+                        "avatar": avatar_url(user['id'], profile['avatar']),
                         "balance": 0.00,
                         "creditScore": 100
                     }
@@ -210,7 +337,10 @@ def login():
                     )
                     return response, 200
 
+        login_limiter.record_failure(identifier)
         return jsonify({"error": "账号或密码错误"}), 401
+    except passwords.Busy:
+        raise
     except Exception as e:
         print(f"Login error: {e}")
         return jsonify({"error": "Server error"}), 500
@@ -235,6 +365,7 @@ def confirm_user():
     
     success = db_module.update_user_verified(user['id'], True)
     if success:
+        response_cache.invalidate(f"user:{user['id']}")
         # 验证成功后自动创建session
         session_token = db_module.create_session(user['id'], expires_hours=24)
 
@@ -244,7 +375,7 @@ def confirm_user():
                 "id": user['id'],
                 "name": user['name'],
                 "email": user['email'],
-                "avatar": f"https://picsum.photos/seed/{user['id']}/150/150",
+                "avatar": avatar_url(user['id'], user['avatar']),
                 "balance": 0.00,
                 "creditScore": 100
             }
@@ -293,6 +424,7 @@ def logout():
     return response, 200
     
 @app.route("/user/<int:user_id>")
+@response_cache.cached(lambda user_id: (f"user:{user_id}", None))
 def get_user_info(user_id):
     """获取用户信息"""
     user = db_module.get_user(user_id)
@@ -304,7 +436,7 @@ def get_user_info(user_id):
     user.pop("confirmation_token", None)
     
     # 添加头像链接
-    user["avatar"] = f"https://picsum.photos/seed/{user['id']}/150/150"
+    user["avatar"] = avatar_url(user["id"], user.get("avatar"))
     user["balance"] = 0.00
     user["creditScore"] = 100
     
@@ -315,33 +447,22 @@ def get_user_info(user_id):
 def get_user_goods(user_id):
     """获取用户发布的商品"""
     goods = db_module.get_goods_by_seller(user_id, True)
-    return jsonify(goods)
+    return jsonify(attach_images(goods))
 
 
 @app.route("/user/<int:user_id>/orders")
 def get_user_orders(user_id):
     """获取用户的订单（作为买家）"""
-    orders = db_module.get_orders_by_buyer(user_id)
-    # 丰富订单信息，加入商品详情
-    for order in orders:
-        good = db_module.get_good(order['goods_id'])
-        if good:
-            order['good_name'] = good['name']
-            order['good_value'] = good['value']
-            order['good_description'] = good['description']
+    # 订单与商品详情一次查询取回
+    orders = db_module.get_orders_by_buyer_with_goods(user_id)
     return jsonify(orders)
 
 
 @app.route("/good/<int:good_id>/orders")
 def get_good_orders(good_id):
     """获取某商品的订单（供卖家查看）"""
-    orders = db_module.get_orders_by_good(good_id)
-    # 丰富订单信息，加入买家详情
-    for order in orders:
-        buyer = db_module.get_user(order['buyer_id'])
-        if buyer:
-            order['buyer_name'] = buyer['name']
-            order['buyer_email'] = buyer['email']
+    # 订单与买家详情一次查询取回
+    orders = db_module.get_orders_by_good_with_buyers(good_id)
     return jsonify(orders)
 
 @app.route("/user/<int:user_id>/preferences", methods=["PUT"])
@@ -360,6 +481,7 @@ def update_preferences(user_id):
     try:
         success = db_module.update_user_preferences(user_id, labels)
         if success:
+            response_cache.invalidate(f"user:{user_id}")
             return jsonify({"message": "Preferences updated"}), 200
         else:
             return jsonify({"error": "User not found or update failed"}), 404
@@ -408,34 +530,34 @@ def create_good():
         # 2. 写入数据库
         good = db_module.create_good(name, seller_id, num, value, description, labels=labels, type=is_task)
         
-        # 3. 异步发送通知邮件给感兴趣的用户
+        # 3. 通知邮件写入发送队列，由后台工作线程发送
         if labels:
-            def send_prefer_notifications():
-                try:
-                    interested_users = db_module.get_users_interested_in(labels)
-                    for user in interested_users:
-                        if user.get('email'):
-                            html = mailer.render_template(
-                                'new_arrival.html',
-                                user_name=user.get('name'),
-                                product_name=name,
-                                product_price=value,
-                                product_description=description,
-                                product_url=f"{FRONTEND_URL}/goods/{good['id']}", 
-                                app_name=APP_NAME,
-                                current_year=2025
-                            )
-                            mailer.send_email(
-                                to_email=user.get('email'),
-                                to_name=user.get('name'),
-                                subject=f"新品上架通知：{name}",
-                                content=f"新品 {name} 上架了，快来看看！",
-                                html=html
-                            )
-                except Exception as e:
-                    print(f"Failed to send notifications: {e}")
-            
-            threading.Thread(target=send_prefer_notifications).start()
+            try:
+                # 商品部分每个商品只渲染一次，每个收件人只替换称呼
+                batch = mailer.render_batch(
+                    'new_arrival.html',
+                    product_name=name,
+                    product_price=value,
+                    product_description=description,
+                    product_url=f"{FRONTEND_URL}/goods/{good['id']}", 
+                    app_name=APP_NAME,
+                    current_year=2025
+                )
+                subject = f"新品上架通知：{name}"
+                content = f"新品 {name} 上架了，快来看看！"
+                mails = []
+                for user in db_module.get_users_interested_in(labels):
+                    if user.get('email'):
+                        mails.append({
+                            "to_email": user.get('email'),
+                            "to_name": user.get('name'),
+                            "subject": subject,
+                            "content": content,
+                            "html": batch.render(user_name=user.get('name'))
+                        })
+                mail_queue.enqueue_many(mails)
+            except Exception as e:
+                print(f"Failed to queue notifications: {e}")
                 
         return jsonify(good), 201
     except Exception as e:
@@ -443,25 +565,114 @@ def create_good():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/goods", methods=["GET"])
+def list_goods():
+    """
+    商品列表（最新在前）
+    查询参数:
+    - labels: 标签 id，逗号分隔，如 "1,2"
+    - match: any（带有任一标签，默认）或 all（同时带有全部标签）
+    - is_task: true/false，不传则不限类型
+    - status: available（默认）/sold/removed，传 any 不限状态
+    - before_id: 取该 id 之前的一页
+    - limit: 每页条数，默认 GOODS_PAGE_SIZE，最大 GOODS_PAGE_MAX
+    返回 {"goods": [...], "facets": [{"label_id", "count"}], "next_before_id"}，
+    facets 是当前筛选条件下各标签的商品数，只在第一页（不带 before_id）计算，之后的页为 null
+    """
+    labels_raw = request.args.get("labels", "")
+    labels = [int(x) for x in labels_raw.split(",") if x.strip().isdigit()]
+    match = request.args.get("match", "any").lower()
+    if match not in ("any", "all"):
+        return jsonify({"error": "match must be 'any' or 'all'"}), 400
+    is_task_raw = request.args.get("is_task")
+    is_task = None if is_task_raw is None else is_task_raw.lower() == "true"
+    status = request.args.get("status", "available")
+    if status == "any":
+        status = None
+    before_id = request.args.get("before_id", type=int)
+    limit = request.args.get("limit", default=GOODS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, GOODS_PAGE_MAX))
+
+    try:
+        filters = {"labels": labels, "match_all": match == "all", "is_task": is_task, "status": status}
+        goods = attach_images(db_module.list_goods(before_id=before_id, limit=limit, **filters))
+        # 翻页时筛选条件不变，分面计数与第一页相同，不再重复统计
+        facets = db_module.count_goods_by_label(**filters) if before_id is None else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({
+        "goods": goods,
+        "facets": facets,
+        "next_before_id": goods[-1]["id"] if len(goods) == limit else None,
+    })
+
+
+@app.route("/goods/search", methods=["GET"])
+def search_goods():
+    """
+    全文搜索在售商品（按相关度排序）
+    查询参数:
+    - q: 关键词，空格分隔的多个词需同时出现
+    - labels: 标签 id，逗号分隔，带有任一标签即可
+    - min_price / max_price: 价格区间
+    - is_task: true/false，不传则不限类型
+    - page: 页码，从 1 开始；limit: 每页条数，默认 GOODS_PAGE_SIZE，最大 GOODS_PAGE_MAX
+    每个商品附带 name_highlight 与 snippet，命中的关键词用 <mark> 包围（其余内容已转义）
+    """
+    q = request.args.get("q", "").strip()
+    if not q:
+        return jsonify({"error": "q is required"}), 400
+    labels_raw = request.args.get("labels", "")
+    labels = [int(x) for x in labels_raw.split(",") if x.strip().isdigit()]
+    min_price = request.args.get("min_price", type=float)
+    max_price = request.args.get("max_price", type=float)
+    is_task_raw = request.args.get("is_task")
+    is_task = None if is_task_raw is None else is_task_raw.lower() == "true"
+    page = max(1, request.args.get("page", default=1, type=int))
+    limit = request.args.get("limit", default=GOODS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, GOODS_PAGE_MAX))
+
+    try:
+        # 多取一条用于判断是否还有下一页
+        goods = db_module.search_goods(
+            q, labels=labels, min_price=min_price, max_price=max_price, is_task=is_task,
+            offset=(page - 1) * limit, limit=limit + 1
+        )
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    has_more = len(goods) > limit
+    goods = attach_images(goods[:limit])
+    for good in goods:
+        good["name_highlight"] = search_marks_to_html(good["name_highlight"])
+        good["snippet"] = search_marks_to_html(good["snippet"])
+    return jsonify({"goods": goods, "page": page, "has_more": has_more})
+
+
 @app.route("/goods/random", methods=["GET"])
 def get_random_goods():
-    """获取随机商品"""
+    """获取随机商品（num 限制在 1..GOODS_PAGE_MAX）"""
     try:
         num = request.args.get("num", default=10, type=int)
+        num = max(1, min(num, GOODS_PAGE_MAX))
         is_task = request.args.get("is_task", "false").lower() == "true"
         goods = db_module.get_random_goods(num, is_task)
-        return jsonify(goods)
+        return jsonify(attach_images(goods))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/goods/<int:good_id>", methods=["GET"])
+@response_cache.cached(lambda good_id: (f"good:{good_id}", None))
 def get_good(good_id):
     """获取单个商品详情"""
     good = db_module.get_good(good_id)
     if not good:
         return jsonify({"error": "Good not found"}), 404
-    return jsonify(good)
+    return jsonify(attach_images([good])[0])
 
 
 @app.route("/goods/<int:good_id>/status", methods=["PUT"])
@@ -474,6 +685,7 @@ def update_good_status(good_id):
     try:
         success = db_module.update_good_status(good_id, status)
         if success:
+            response_cache.invalidate(f"good:{good_id}")
             return jsonify({"success": True})
         else:
             return jsonify({"error": "Update failed"}), 400
@@ -535,6 +747,14 @@ def update_order_status(order_id):
         return jsonify({"error": str(e)}), 400
 
 
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return jsonify({"error": "File too large"}), 413
+
+@app.errorhandler(UnsupportedMediaType)
+def upload_unsupported(e):
+    return jsonify({"error": "Unsupported file type"}), 415
+
 @app.route("/upload", methods=["POST"])
 def upload_media():
     """
@@ -561,89 +781,105 @@ def upload_media():
     except ValueError:
         return jsonify({"error": "Invalid id"}), 400
 
-    saved_files = []
-
     if upload_type == 'avatar':
         if len(files) > 1:
             return jsonify({"error": "Avatar limit is 1"}), 400
         
         file = files[0]
-        if file and allowed_file(file.filename):
-            ext = file.filename.rsplit('.', 1)[1].lower()
-            filename = f"avatar_{target_id}.{ext}"
-            # 删除旧头像
-            for old_ext in ALLOWED_EXTENSIONS:
-                old_path = os.path.join(UPLOAD_FOLDER+"/user", f"avatar_{target_id}.{old_ext}")
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-            
-            # 确保目录存在
-            user_dir = os.path.join(UPLOAD_FOLDER, "user")
-            os.makedirs(user_dir, exist_ok=True)
-            
-            file.save(os.path.join(user_dir, filename))
-            saved_files.append(filename)
+        ext = uploads.file_kind(file)
+        if ext and ext not in uploads.VIDEO_TYPES:
+            if not db_module.get_user(target_id):
+                return jsonify({"error": "User not found"}), 404
+            # 文件名带内容哈希，换头像后链接随之改变，客户端不会拿到缓存的旧图
+            path = f"user/avatar_{target_id}_{uploads.content_hash(file)[:12]}.{ext}"
+            uploads.save_as(file, os.path.join(UPLOAD_FOLDER, path))
+            old_path = db_module.set_user_avatar(target_id, path)
+            # 删除旧头像（路径记录在数据库中，无需逐个扩展名探测）
+            if old_path and old_path != path:
+                old_file = os.path.join(UPLOAD_FOLDER, old_path)
+                if os.path.exists(old_file):
+                    os.remove(old_file)
+                media.remove_variants(old_file)
+            # 缩略图等变体在进程池中生成，生成前 serve_media 返回原图
+            media.submit(os.path.join(UPLOAD_FOLDER, path))
+            response_cache.invalidate(f"avatar:{target_id}")
+            response_cache.invalidate(f"user:{target_id}")
         else:
              return jsonify({"error": "Invalid file type"}), 400
 
     elif upload_type == 'good':
         if len(files) > 9:
             return jsonify({"error": "Goods media limit is 9"}), 400
+        if not db_module.get_good(target_id):
+            return jsonify({"error": "Good not found"}), 404
         
-        # 确保目录存在
-        good_dir = os.path.join(UPLOAD_FOLDER, f"good_{target_id}")
-        os.makedirs(good_dir, exist_ok=True)
-        
-        for i, file in enumerate(files):
-            if file and allowed_file(file.filename):
-                ext = file.filename.rsplit('.', 1)[1].lower()
-                filename = f"good_{target_id}_{i}.{ext}"
-                file.save(os.path.join(good_dir, filename))
-                saved_files.append(filename)
-            else:
+        # 先检查全部文件（按文件头判断类型），避免只保存了一部分
+        for file in files:
+            if not uploads.file_kind(file):
                 return jsonify({"error": f"File {file.filename} invalid"}), 400
+
+        # 按内容哈希存储（相同内容只存一份），并替换 goods_media 中该商品的记录
+        uploads.replace_good_media(target_id, files, UPLOAD_FOLDER)
+        response_cache.invalidate(f"good_images:{target_id}")
+        response_cache.invalidate(f"good:{target_id}")
     else:
         return jsonify({"error": "Invalid upload type"}), 400
 
     return jsonify({"message": "Upload successful"}), 201
 
 @app.route("/user/<int:user_id>/avatar")
+@response_cache.cached(lambda user_id: (f"avatar:{user_id}", None))
 def get_user_avatar(user_id):
-    """获取用户头像"""
-    user_dir = os.path.join(UPLOAD_FOLDER, "user")
-    for ext in ALLOWED_EXTENSIONS:
-        path = os.path.join(user_dir, f"avatar_{user_id}.{ext}")
-        if os.path.exists(path):
-            return jsonify({"avatar_url": f"/media/user/avatar_{user_id}.{ext}"})
-    return jsonify({"error": "Avatar not found"}), 404
+    """获取用户头像（/user/<id> 等接口已直接附带 avatar，此接口保留兼容）"""
+    user = db_module.get_user(user_id)
+    if not user or not user["avatar"]:
+        return jsonify({"error": "Avatar not found"}), 404
+    return jsonify({"avatar_url": avatar_url(user_id, user["avatar"])})
 
 @app.route('/media/<path:filename>')
 def serve_media(filename):
-    """Serve media files"""
-    return send_from_directory(app.static_folder, filename)
+    """
+    Serve media files
+    图片按 ?w=<期望宽度> 选择尺寸，按 Accept 中明确列出的 image/avif、image/webp 选择格式；
+    变体尚未生成时返回原图。支持 Range 请求（视频拖动进度）；内容哈希命名的文件带一年的 immutable 缓存
+    """
+    width = request.args.get("w", type=int)
+    accepted = [mimetype for mimetype, _ in request.accept_mimetypes]
+    return media.send(app.static_folder, filename, width, accepted)
 
 @app.route("/good/<int:good_id>/images")
+@response_cache.cached(lambda good_id: (f"good_images:{good_id}", request.args.get("first", "false").lower()))
 def get_good_images(good_id):
     """获取商品图像，支持选择第一个或全部"""
-    good_dir = os.path.join(UPLOAD_FOLDER, f"good_{good_id}")
-    if not os.path.exists(good_dir):
-        return jsonify({"error": "No images found"}), 404
-    
-    first = request.args.get("first", "false").lower() == "true"
-    images = []
-    for file in os.listdir(good_dir):
-        if file.startswith(f"good_{good_id}_") and file.split('.')[-1].lower() in ALLOWED_EXTENSIONS:
-            images.append(f"/media/good_{good_id}/{file}")
-    
+    images = [f"/media/{path}" for path in db_module.get_goods_media([good_id]).get(good_id, [])]
     if not images:
         return jsonify({"error": "No images found"}), 404
     
+    first = request.args.get("first", "false").lower() == "true"
     if first:
         return jsonify({"image_url": images[0]})
     else:
         return jsonify({"image_urls": images})
 
 
+@app.route("/goods/images")
+def get_goods_images_batch():
+    """
+    批量获取多个商品的图像
+    查询参数: ids=1,2,3（最多 GOODS_PAGE_MAX 个）
+    返回 {"images": {"1": ["/media/...", ...], ...}}，没有图像的商品返回空列表
+    """
+    ids = [int(x) for x in request.args.get("ids", "").split(",") if x.strip().isdigit()]
+    if not ids:
+        return jsonify({"error": "ids required"}), 400
+    if len(ids) > GOODS_PAGE_MAX:
+        return jsonify({"error": f"At most {GOODS_PAGE_MAX} ids"}), 400
+    media = db_module.get_goods_media(ids)
+    return jsonify({"images": {
+        str(good_id): [f"/media/{path}" for path in media.get(good_id, [])] for good_id in ids
+    }})
+
+
 @app.route("/messages", methods=["POST"])
 def send_message():
     """
@@ -670,13 +906,7 @@ def send_message():
 
     try:
         message = db_module.create_message(current_user['id'], receiver_id, text)
-        return jsonify({
-            "id": message['id'],
-            "senderId": message['sender_id'],
-            "receiverId": message['receiver_id'],
-            "text": message['text'],
-            "createdAt": message['created_at']
-        }), 201
+        return jsonify(serialize_message(message)), 201
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
     except Exception as e:
@@ -686,26 +916,86 @@ def send_message():
 @app.route("/messages/<int:user_id>", methods=["GET"])
 def get_messages_with_user(user_id):
     """
-    获取与某个用户的所有消息
-    需要在 X-User-ID header 中提供当前用户ID
+    获取与某个用户的消息（按 id 升序）
+    查询参数:
+    - limit: 每页条数，默认 MESSAGES_PAGE_SIZE，最大 MESSAGES_PAGE_MAX
+    - before_id: 取该 id 之前的一页（向上翻历史）
+    - after_id: 取该 id 之后的新消息（轮询增量）
+    都不传时返回最新的一页
     """
     current_user = get_current_user_from_request()
     if not current_user:
         return jsonify({"error": "未认证，请先登录"}), 401
 
+    before_id = request.args.get("before_id", type=int)
+    after_id = request.args.get("after_id", type=int)
+    limit = request.args.get("limit", default=MESSAGES_PAGE_SIZE, type=int)
+    if before_id is not None and after_id is not None:
+        return jsonify({"error": "before_id and after_id are mutually exclusive"}), 400
+    limit = max(1, min(limit, MESSAGES_PAGE_MAX))
+
     try:
-        messages = db_module.get_messages_between(current_user['id'], user_id)
-        return jsonify([{
-            "id": m['id'],
-            "senderId": m['sender_id'],
-            "receiverId": m['receiver_id'],
-            "text": m['text'],
-            "createdAt": m['created_at']
-        } for m in messages])
+        messages = db_module.get_messages_between(
+            current_user['id'], user_id, before_id=before_id, after_id=after_id, limit=limit
+        )
+        db_module.mark_conversation_read(current_user['id'], user_id)
+        return jsonify([serialize_message(m) for m in messages])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/messages/<int:user_id>/read", methods=["POST"])
+def mark_messages_read(user_id):
+    """把与某个用户的对话标记为已读（打开的对话收到推送消息时调用）"""
+    current_user = get_current_user_from_request()
+    if not current_user:
+        return jsonify({"error": "未认证，请先登录"}), 401
+
+    try:
+        db_module.mark_conversation_read(current_user['id'], user_id)
+        return jsonify({"message": "ok"})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/messages/stream", methods=["GET"])
+def stream_messages():
+    """
+    新消息推送（Server-Sent Events）
+    连接建立后，当前用户收发的每条新消息都会以 `event: message` 推送，空闲时只发心跳注释，不查询数据库。
+    EventSource 无法设置请求头，因此除 Cookie 外也接受 ?token= 查询参数。
+    """
+    current_user = get_current_user_from_request()
+    token = request.args.get('token')
+    if not current_user and token:
+        current_user = db_module.get_user_by_session(token)
+    if not current_user:
+        return jsonify({"error": "未认证，请先登录"}), 401
+
+    pubsub = broker.get_broker()
+    subscription = pubsub.subscribe(broker.user_channel(current_user['id']))
+
+    def event_stream():
+        try:
+            # 断线后浏览器按该间隔（毫秒）自动重连
+            yield "retry: 3000\n\n"
+            while True:
+                message = subscription.get(timeout=SSE_HEARTBEAT_SECONDS)
+                if message is None:
+                    yield ": ping\n\n"
+                    continue
+                payload = json.dumps(serialize_message(message), ensure_ascii=False)
+                yield f"id: {message['id']}\nevent: message\ndata: {payload}\n\n"
+        finally:
+            pubsub.unsubscribe(subscription)
+
+    return Response(event_stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # 关闭反向代理（nginx）的响应缓冲，事件才能立即送达
+        "X-Accel-Buffering": "no",
+    })
+
+
 @app.route("/messages/list", methods=["GET"])
 def get_message_list():
     """
@@ -717,24 +1007,15 @@ def get_message_list():
         return jsonify({"error": "未认证，请先登录"}), 401
 
     try:
-        # 获取所有对话者的ID
-        conn = db_module._get_conn()
-        rows = conn.execute(
-            "SELECT DISTINCT CASE WHEN sender_id = ? THEN receiver_id ELSE sender_id END as other_id FROM messages WHERE sender_id = ? OR receiver_id = ?",
-            (current_user['id'], current_user['id'], current_user['id'])
-        ).fetchall()
-        conn.close()
-        
+        # 对话摘要（对方资料 + 最后一条消息 + 未读数）一次查询取回
         result = []
-        for row in rows:
-            other_user_id = row['other_id']
-            user = db_module.get_user(other_user_id)
-            if user:
-                # 移除敏感信息
-                user.pop("pswd_hash", None)
-                user.pop("confirmation_token", None)
-                user["avatar"] = f"https://picsum.photos/seed/{user['id']}/150/150"
-                result.append(user)
+        for conv in db_module.get_conversations(current_user['id']):
+            user = conv['user']
+            last = conv['last_message']
+            user["avatar"] = avatar_url(user["id"], user["avatar"])
+            user["lastMessage"] = serialize_message(last)
+            user["unreadCount"] = conv['unread_count']
+            result.append(user)
         
         return jsonify(result)
     except Exception as e:
@@ -742,10 +1023,7 @@ def get_message_list():
 
 
 if __name__ == "__main__":
-    try:
-        # 启动时自动初始化数据库表结构
-        db_module.init_db()
-    except Exception:
-        pass
+    # 预先加载标签表，之后只在 labels.json 修改时重新解析
+    db_module.get_all_labels()
     # 启动 Flask
     app.run(debug=True, host="0.0.0.0", port=5000)
\ No newline at end of file
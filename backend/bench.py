@@ -0,0 +1,568 @@
+"""
+后端性能基准脚本。
+在临时数据库上运行，不会影响 database.db。
+
+用法:
+    python bench.py pool        # 连接池前后 get_good / get_user_by_session 吞吐对比
+    python bench.py orders      # 订单列表逐条补充 vs JOIN 的查询次数与延迟
+    python bench.py smtp        # 本地 SMTP 服务上逐封建连 vs 会话复用的发信吞吐
+    python bench.py render      # 新品通知逐人渲染 vs 批量渲染（含 MIME 构造）的耗时
+    python bench.py subscribers # 10 万用户下按标签查找订阅者：逐个解析 prefer vs user_preferences 索引
+    python bench.py search      # 100 万在售商品上 /goods/search 各类查询的延迟
+    python bench.py passwords   # 登录高峰下：请求线程内 bcrypt vs 有界进程池，其他接口的延迟
+    python bench.py media       # 并发下载大文件、Range 拖动的吞吐与延迟，direct 与 x-accel 模式的单请求开销
+"""
+
+import argparse
+import os
+import socketserver
+import tempfile
+import threading
+import time
+
+import db as db_module
+
+
+def _use_temp_db() -> str:
+    """把 db 模块指向一个新的临时数据库并建表，返回文件路径"""
+    fd, path = tempfile.mkstemp(prefix="bench_", suffix=".db")
+    os.close(fd)
+    db_module._pool.close_all()
+    db_module.DB_PATH = path
+    db_module.init_db()
+    return path
+
+
+def _rate(fn, seconds: float) -> float:
+    """在 seconds 秒内反复调用 fn，返回每秒调用次数"""
+    count = 0
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        fn()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def bench_pool(seconds: float) -> None:
+    path = _use_temp_db()
+    # 关闭 session 缓存，两组都真正执行 SQL，只比较连接的获取方式
+    cache_size = db_module._session_cache.max_size
+    db_module._session_cache.max_size = 0
+    db_module._session_cache.clear()
+    try:
+        user = db_module.create_user("bench", "bench@example.com", "x", verified=True)
+        good = db_module.create_good("bench good", user["id"], 1, 9.9, "desc")
+        token = db_module.create_session(user["id"])
+
+        cases = [
+            ("get_good", lambda: db_module.get_good(good["id"])),
+            ("get_user_by_session", lambda: db_module.get_user_by_session(token)),
+        ]
+        pool_size = db_module._pool.size
+        print(f"{'query':<24}{'per-call conn':>16}{'pooled':>16}{'speedup':>10}")
+        for name, fn in cases:
+            # size=0 时每次归还都会关闭连接，等价于旧的每次调用新建连接
+            db_module._pool.size = 0
+            db_module._pool.close_all()
+            before = _rate(fn, seconds)
+            db_module._pool.size = pool_size
+            after = _rate(fn, seconds)
+            print(f"{name:<24}{before:>12.0f} r/s{after:>12.0f} r/s{after / before:>9.1f}x")
+    finally:
+        db_module._session_cache.max_size = cache_size
+        db_module._pool.close_all()
+        os.remove(path)
+
+
+class _QueryCounter:
+    """给新建的连接挂上 trace 回调，统计执行的 SQL 语句数"""
+
+    def __init__(self):
+        self.count = 0
+        self._orig_get_conn = db_module._get_conn
+
+    def __enter__(self):
+        def counting_get_conn():
+            conn = self._orig_get_conn()
+            conn.set_trace_callback(self._trace)
+            return conn
+
+        db_module._pool.close_all()
+        db_module._get_conn = counting_get_conn
+        return self
+
+    def _trace(self, statement):
+        self.count += 1
+
+    def __exit__(self, *exc):
+        db_module._get_conn = self._orig_get_conn
+        db_module._pool.close_all()
+
+
+def _measure(fn, repeat: int):
+    """返回 (每次调用的平均毫秒数, 每次调用的平均 SQL 语句数)"""
+    with _QueryCounter() as counter:
+        fn()  # 预热连接，不计入
+        counter.count = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat * 1000, counter.count / repeat
+
+
+def bench_orders(seconds: float) -> None:
+    path = _use_temp_db()
+    try:
+        buyer = db_module.create_user("buyer", "buyer@example.com", "x", verified=True)
+        seller = db_module.create_user("seller", "seller@example.com", "x", verified=True)
+        buyers = [db_module.create_user(f"b{i}", f"b{i}@example.com", "x")["id"] for i in range(500)]
+        goods = [db_module.create_good(f"g{i}", seller["id"], 1, 1.0, "desc")["id"] for i in range(2000)]
+        hot_good = goods[0]
+
+        def _seed(conn):
+            conn.executemany(
+                "INSERT INTO orders (goods_id, num, buyer_id, status) VALUES (?, 1, ?, 'processing')",
+                [(good_id, buyer["id"]) for good_id in goods],
+            )
+            conn.executemany(
+                "INSERT INTO orders (goods_id, num, buyer_id, status) VALUES (?, 1, ?, 'processing')",
+                [(hot_good, buyer_id) for buyer_id in buyers for _ in range(4)],
+            )
+        db_module._write(_seed)
+
+        def buyer_orders_n_plus_1():
+            orders = db_module.get_orders_by_buyer(buyer["id"])
+            for order in orders:
+                good = db_module.get_good(order["goods_id"])
+                if good:
+                    order["good_name"] = good["name"]
+            return orders
+
+        def good_orders_n_plus_1():
+            orders = db_module.get_orders_by_good(hot_good)
+            for order in orders:
+                user = db_module.get_user(order["buyer_id"])
+                if user:
+                    order["buyer_name"] = user["name"]
+            return orders
+
+        cases = [
+            ("/user/<id>/orders (2000)", buyer_orders_n_plus_1, lambda: db_module.get_orders_by_buyer_with_goods(buyer["id"])),
+            ("/good/<id>/orders (2000)", good_orders_n_plus_1, lambda: db_module.get_orders_by_good_with_buyers(hot_good)),
+        ]
+        repeat = max(1, int(seconds * 5))
+        print(f"{'endpoint':<28}{'N+1 ms':>10}{'N+1 queries':>14}{'JOIN ms':>10}{'JOIN queries':>14}")
+        for name, old, new in cases:
+            old_ms, old_q = _measure(old, repeat)
+            new_ms, new_q = _measure(new, repeat)
+            print(f"{name:<28}{old_ms:>10.1f}{old_q:>14.0f}{new_ms:>10.1f}{new_q:>14.0f}")
+    finally:
+        db_module._pool.close_all()
+        os.remove(path)
+
+
+class _SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """极简 SMTP 服务端：接受并丢弃所有邮件，只用于基准测试"""
+
+    def _reply(self, line: str) -> None:
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        self._reply("220 bench ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode(errors="replace").strip().upper()
+            if cmd.startswith("EHLO"):
+                self._reply("250-bench")
+                self._reply("250 8BITMIME")
+            elif cmd.startswith("DATA"):
+                self._reply("354 end with .")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                self.server.received += 1
+                self._reply("250 queued")
+            elif cmd.startswith("QUIT"):
+                self._reply("221 bye")
+                return
+            else:
+                self._reply("250 ok")
+
+
+class _SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    received = 0
+
+
+def bench_smtp(seconds: float) -> None:
+    import mailer
+
+    server = _SMTPSink(("127.0.0.1", 0), _SMTPSinkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mailer.SMTP_HOST, mailer.SMTP_PORT = server.server_address
+    mailer.SMTP_STARTTLS = False
+    mailer.SMTP_USER = mailer.SMTP_PASS = None
+    mailer.logger.disabled = True
+    try:
+        count = max(50, int(seconds * 250))
+        mails = [
+            {"to_email": f"user{i}@example.com", "to_name": f"用户{i}", "subject": "新品上架通知", "content": "新品上架了", "html": "<p>新品上架了</p>"}
+            for i in range(count)
+        ]
+
+        start = time.perf_counter()
+        for mail in mails:
+            mailer.send_email(**mail)
+        per_conn = count / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        results = mailer.send_bulk(mails)
+        pooled = count / (time.perf_counter() - start)
+
+        print(f"{count} 封邮件 -> 本地 SMTP（无 TLS，真实服务商还要加上每次 TLS 握手与登录）")
+        print(f"{'send_email (每封新连接)':<28}{per_conn:>10.0f} msg/s")
+        print(f"{'send_bulk (会话复用)':<28}{pooled:>10.0f} msg/s{pooled / per_conn:>9.1f}x")
+        print(f"成功 {sum(results)}/{count}，服务端共收到 {server.received} 封")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_render(seconds: float) -> None:
+    import mailer
+
+    context = {
+        "product_name": "二手自行车",
+        "product_price": 120.0,
+        "product_description": "九成新，送车锁",
+        "product_url": "http://localhost/goods/1",
+        "app_name": "泥邮工具人",
+        "current_year": 2025,
+    }
+    subject, content = "新品上架通知：二手自行车", "新品 二手自行车 上架了，快来看看！"
+    users = [(f"user{i}@example.com", f"用户{i}") for i in range(max(200, int(seconds * 1000)))]
+
+    def per_user():
+        # 原来的做法：每个收件人完整渲染模板，并从头构造、编码整封 MIME 邮件
+        from email.header import Header
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        from email.utils import formataddr, formatdate, make_msgid
+
+        for email, name in users:
+            html = mailer.render_template("new_arrival.html", user_name=name, **context)
+            msg = MIMEMultipart("alternative")
+            msg["From"] = mailer._resolve_sender()[0]
+            msg["To"] = formataddr((str(Header(name, "utf-8")), email))
+            msg["Subject"] = Header(subject, "utf-8")
+            msg["Date"] = formatdate(localtime=True)
+            msg["Message-ID"] = make_msgid()
+            msg.attach(MIMEText(content, "plain", "utf-8"))
+            msg.attach(MIMEText(html, "html", "utf-8"))
+            msg.as_string()
+
+    def batched():
+        batch = mailer.render_batch("new_arrival.html", **context)
+        sender = mailer._resolve_sender()
+        for email, name in users:
+            mailer._build_message(sender, email, subject, content, html=batch.render(user_name=name), to_name=name)
+
+    print(f"{len(users)} 位收件人（渲染 + MIME 构造）")
+    results = []
+    for name, fn in (("逐人渲染", per_user), ("批量渲染", batched)):
+        fn()  # 预热模板缓存
+        start = time.perf_counter()
+        fn()
+        results.append(time.perf_counter() - start)
+        print(f"{name:<12}{results[-1] * 1000:>10.1f} ms{len(users) / results[-1]:>10.0f} 封/s")
+    print(f"加速 {results[0] / results[1]:.1f}x")
+
+
+def bench_subscribers(seconds: float) -> None:
+    import json
+    import random
+
+    path = _use_temp_db()
+    try:
+        rng = random.Random(42)
+        users = 100_000
+
+        def _seed(conn):
+            rows = []
+            for i in range(users):
+                # 大约一半用户订阅了 1~3 个标签（标签 id 1~40）
+                prefer = rng.sample(range(1, 41), rng.randint(1, 3)) if i % 2 else []
+                rows.append((f"u{i}", f"u{i}@example.com", json.dumps(prefer), 1))
+            conn.executemany("INSERT INTO users (name, email, prefer, verified) VALUES (?, ?, ?, ?)", rows)
+            conn.execute(
+                "INSERT INTO user_preferences (user_id, label_id) "
+                "SELECT u.id, j.value FROM users u, json_each(u.prefer) j"
+            )
+        db_module._write(_seed)
+
+        labels = [3, 17]
+
+        def python_scan():
+            # 原来的做法：取出所有有偏好的已验证用户，逐个解析 JSON 求交集
+            with db_module._connection() as conn:
+                rows = conn.execute("SELECT * FROM users WHERE prefer != '[]' AND verified = 1").fetchall()
+            target = set(labels)
+            return [dict(row) for row in rows if not set(db_module._deserialize_labels(row["prefer"])).isdisjoint(target)]
+
+        repeat = max(3, int(seconds * 5))
+        print(f"{users} 位用户，标签 {labels}，订阅者 {len(db_module.get_users_interested_in(labels))} 人")
+        print(f"{'方式':<20}{'ms/次':>10}{'SQL/次':>10}")
+        for name, fn in (("Python 逐个解析", python_scan), ("user_preferences", lambda: db_module.get_users_interested_in(labels))):
+            ms, queries = _measure(fn, repeat)
+            print(f"{name:<20}{ms:>10.1f}{queries:>10.0f}")
+    finally:
+        db_module._pool.close_all()
+        os.remove(path)
+
+
+def bench_search(seconds: float) -> None:
+    import random
+
+    path = _use_temp_db()
+    try:
+        rng = random.Random(7)
+        adjectives = ["全新", "二手", "九成新", "闲置", "正品", "便携", "复古", "静音", "大容量", "轻薄", "限量", "国行"]
+        brands = ["小米", "华为", "苹果", "索尼", "罗技", "得力", "迪卡侬", "宜家", "优衣库", "联想", "戴森", "任天堂"]
+        items = ["自行车", "机械键盘", "蓝牙耳机", "台灯", "保温杯", "显示器", "羽毛球拍", "电饭煲", "行李箱", "吉他",
+                 "考研资料", "高数教材", "小电驴", "电风扇", "收纳箱", "游戏手柄", "充电宝", "帆布包", "运动鞋", "相机"]
+        extras = ["送原装充电器", "宿舍自提", "可小刀", "毕业甩卖", "仅拆封", "有发票", "功能完好", "支持验货", "西门交易", "不议价"]
+        total = 1_000_000
+        chunk = 50_000
+
+        seller = db_module.create_user("seller", "seller@example.com", "x", verified=True)
+        started = time.perf_counter()
+        for base in range(0, total, chunk):
+            rows = []
+            for _ in range(chunk):
+                name = f"{rng.choice(adjectives)}{rng.choice(brands)}{rng.choice(items)}"
+                desc = f"{rng.choice(extras)}，{rng.choice(extras)}，型号 {rng.randint(100, 99999)}"
+                rows.append((seller["id"], name, 1, 0, "[]", round(rng.uniform(1, 2000), 2), desc))
+
+            def insert(conn):
+                # 绕过 create_good 批量写入，二元组索引也在这里一并写入
+                first = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM goods").fetchone()[0]
+                conn.executemany(
+                    "INSERT INTO goods (seller_id, name, num, sold_num, labels, value, description) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                conn.executemany(
+                    "INSERT INTO goods_bigram (rowid, name, description) VALUES (?, ?, ?)",
+                    [(first + i, db_module._search_bigrams(row[1]), db_module._search_bigrams(row[6])) for i, row in enumerate(rows)],
+                )
+
+            db_module._write(insert)
+        db_module.optimize_search_index()
+        print(f"写入 {total} 个商品（含全文索引）用时 {time.perf_counter() - started:.1f}s")
+
+        cases = [
+            ("常见词 自行车", {"query": "自行车"}),
+            ("组合 索尼 蓝牙耳机", {"query": "索尼 蓝牙耳机"}),
+            ("精确 型号 12345", {"query": "12345"}),
+            ("价格区间", {"query": "机械键盘", "min_price": 100, "max_price": 300}),
+            ("两字词 小米（二元组）", {"query": "小米"}),
+            ("两个两字词 二手 吉他", {"query": "二手 吉他"}),
+            ("两字词+长词", {"query": "小米 充电宝"}),
+            ("单字（LIKE）", {"query": "米 宝"}),
+            ("排序窗口之后的页", {"query": "自行车", "offset": 5000}),
+        ]
+        repeat = max(3, int(seconds * 10))
+        print(f"{'查询':<22}{'命中':>8}{'p50 ms':>10}{'max ms':>10}")
+        for name, kwargs in cases:
+            db_module.search_goods(**kwargs)  # 预热
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                results = db_module.search_goods(**kwargs)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            print(f"{name:<22}{len(results):>8}{timings[len(timings) // 2]:>10.2f}{timings[-1]:>10.2f}")
+    finally:
+        db_module._pool.close_all()
+        os.remove(path)
+
+
+def bench_media(seconds: float) -> None:
+    import http.client
+    import logging
+    import random
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    from werkzeug.serving import make_server
+
+    import media
+
+    path = _use_temp_db()
+    root = tempfile.mkdtemp(prefix="bench_media_")
+    size = 64 * 1024 * 1024
+    name = f"blobs/ab/{'ab' * 32}.mp4"
+    os.makedirs(os.path.join(root, "blobs", "ab"))
+    with open(os.path.join(root, name), "wb") as f:
+        f.write(os.urandom(1024 * 1024) * (size // (1024 * 1024)))
+
+    import app as app_module
+    app_module.app.static_folder = root
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+
+    def get(headers=None):
+        conn = http.client.HTTPConnection(host, port)
+        try:
+            conn.request("GET", f"/media/{name}", headers=headers or {})
+            response = conn.getresponse()
+            received = 0
+            while chunk := response.read(1024 * 1024):
+                received += len(chunk)
+            return response.status, received
+        finally:
+            conn.close()
+
+    try:
+        print(f"文件 {size // (1024 * 1024)} MiB，werkzeug 多线程服务器（MEDIA_SERVE_MODE=direct）")
+        print(f"{'并发下载':<12}{'总吞吐 MiB/s':>14}{'耗时 s':>12}")
+        for clients in (1, 4, 16):
+            with ThreadPoolExecutor(clients) as pool:
+                start = time.perf_counter()
+                results = list(pool.map(lambda _: get(), range(clients)))
+                elapsed = time.perf_counter() - start
+            assert all(result == (200, size) for result in results), results
+            print(f"{clients:<16}{clients * size / elapsed / 1024 / 1024:>14.0f}{elapsed:>12.2f}")
+
+        # 模拟视频拖动：随机位置取 1 MiB，检查 206 与返回长度
+        rng = random.Random(7)
+        timings = []
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            offset = rng.randrange(0, size - 1024 * 1024)
+            start = time.perf_counter()
+            status, received = get({"Range": f"bytes={offset}-{offset + 1024 * 1024 - 1}"})
+            timings.append((time.perf_counter() - start) * 1000)
+            assert (status, received) == (206, 1024 * 1024), (status, received)
+        timings.sort()
+        print(f"Range 1 MiB 拖动 {len(timings)} 次: p50 {timings[len(timings) // 2]:.2f} ms, max {timings[-1]:.2f} ms")
+
+        # 同一请求在两种模式下 Python 侧的开销；x-accel 模式下文件内容由 nginx 发送
+        client = app_module.app.test_client()
+        print(f"{'模式':<12}{'Python 侧请求/s':>16}")
+        for mode in ("direct", "x-accel"):
+            media.MEDIA_SERVE_MODE = mode
+            rate = _rate(lambda: client.get(f"/media/{name}", headers={"Range": "bytes=0-65535"}).close(), seconds)
+            print(f"{mode:<12}{rate:>16.0f}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(root)
+        db_module._pool.close_all()
+        os.remove(path)
+
+
+def bench_passwords(seconds: float) -> None:
+    import contextlib
+    import http.client
+    import io
+    import json
+    import logging
+
+    from werkzeug.serving import make_server
+
+    import passwords
+
+    path = _use_temp_db()
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    import app as app_module
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+
+    rounds = passwords.rounds()
+    user = db_module.create_user("bench", "bench@example.com", passwords.hash_password("secret"), verified=True)
+    seller = db_module.create_user("seller", "seller@example.com", "x", verified=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(50):
+            db_module.create_good(f"good {i}", seller["id"], 1, 9.9, "desc")
+
+    def request(method, url, body=None):
+        conn = http.client.HTTPConnection(host, port)
+        try:
+            conn.request(method, url, body=body, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        finally:
+            conn.close()
+
+    login_body = json.dumps({"username": user["name"], "password": "secret"})
+    storm = 16
+
+    print(f"bcrypt 工作因子 {rounds}，{storm} 个线程持续登录，同时测 GET /goods 的延迟（{os.cpu_count()} CPU）")
+    print(f"{'模式':<24}{'登录 ok/s':>10}{'429':>8}{'/goods p50 ms':>15}{'/goods p99 ms':>15}")
+    try:
+        for label, workers in (("请求线程内计算", 0), (f"进程池 ({passwords.PASSWORD_WORKERS} 进程)", passwords.PASSWORD_WORKERS)):
+            passwords._hasher.workers = workers
+            stop = threading.Event()
+            counts = {"ok": 0, "busy": 0}
+            lock = threading.Lock()
+
+            def login_loop():
+                while not stop.is_set():
+                    status = request("POST", "/user/login", login_body)
+                    with lock:
+                        if status == 200:
+                            counts["ok"] += 1
+                        elif status == 429:
+                            counts["busy"] += 1
+                    if status == 429:
+                        # 按 Retry-After 退避，模拟正常客户端
+                        time.sleep(1)
+
+            threads = [threading.Thread(target=login_loop, daemon=True) for _ in range(storm)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.5)
+            timings = []
+            start = time.perf_counter()
+            while time.perf_counter() - start < seconds:
+                began = time.perf_counter()
+                request("GET", "/goods?limit=20")
+                timings.append((time.perf_counter() - began) * 1000)
+            elapsed = time.perf_counter() - start
+            stop.set()
+            for thread in threads:
+                thread.join()
+            timings.sort()
+            print(f"{label:<24}{counts['ok'] / elapsed:>10.1f}{counts['busy']:>8}"
+                  f"{timings[len(timings) // 2]:>15.2f}{timings[int(len(timings) * 0.99)]:>15.2f}")
+    finally:
+        server.shutdown()
+        db_module._pool.close_all()
+        os.remove(path)
+
+
+BENCHMARKS = {
+    "pool": bench_pool,
+    "orders": bench_orders,
+    "smtp": bench_smtp,
+    "render": bench_render,
+    "subscribers": bench_subscribers,
+    "search": bench_search,
+    "media": bench_media,
+    "passwords": bench_passwords,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--seconds", type=float, default=2.0, help="每个用例的运行时长")
+    args = parser.parse_args()
+    BENCHMARKS[args.name](args.seconds)
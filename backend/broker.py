@@ -0,0 +1,113 @@
+"""
+消息推送的发布/订阅。
+- Broker: 推送通道接口，按频道（如 "user:42"）发布与订阅
+- LocalBroker: 进程内实现，单进程部署直接使用；多进程部署时可换成
+  基于 Redis 等外部服务的实现，通过 set_broker() 注入，调用方无需改动
+"""
+
+import queue
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional, Set
+
+
+class Subscription:
+    """一个订阅者的收件队列。队列满时丢弃最旧的事件，慢消费者不会拖住发布方。"""
+
+    def __init__(self, channel: str, max_pending: int):
+        self.channel = channel
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+
+    def put(self, event: Any) -> None:
+        while True:
+            try:
+                self._queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        """等待下一个事件，超时返回 None"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broker(ABC):
+    """推送通道接口"""
+
+    @abstractmethod
+    def publish(self, channel: str, event: Any) -> None:
+        ...
+
+    @abstractmethod
+    def subscribe(self, channel: str) -> Subscription:
+        ...
+
+    @abstractmethod
+    def unsubscribe(self, subscription: Subscription) -> None:
+        ...
+
+    def stats(self) -> Dict:
+        return {}
+
+
+class LocalBroker(Broker):
+    """进程内发布/订阅：发布即把事件放入该频道所有订阅者的队列"""
+
+    def __init__(self, max_pending: int = 100):
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._channels: Dict[str, Set[Subscription]] = {}
+        self.published = 0
+
+    def publish(self, channel: str, event: Any) -> None:
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+            self.published += 1
+        for sub in subscribers:
+            sub.put(event)
+
+    def subscribe(self, channel: str) -> Subscription:
+        sub = Subscription(channel, self.max_pending)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subs = self._channels.get(subscription.channel)
+            if subs is None:
+                return
+            subs.discard(subscription)
+            if not subs:
+                del self._channels[subscription.channel]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "channels": len(self._channels),
+                "subscribers": sum(len(subs) for subs in self._channels.values()),
+                "published": self.published,
+            }
+
+
+_broker: Broker = LocalBroker()
+
+
+def get_broker() -> Broker:
+    return _broker
+
+
+def set_broker(broker: Broker) -> None:
+    """替换全局推送通道（例如多进程部署时换成外部消息服务的实现）"""
+    global _broker
+    _broker = broker
+
+
+def user_channel(user_id: int) -> str:
+    return f"user:{user_id}"
@@ -5,96 +5,749 @@
 
 import os
 import sqlite3
+import hashlib
 import json
-from typing import Optional, Dict, List
+import queue
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Iterator, Tuple
+
+import broker
 
 BASE_DIR = os.path.dirname(__file__)
 DB_PATH = os.path.join(BASE_DIR, "database.db")
 LABELS_PATH = os.path.join(BASE_DIR, "labels.json")
+# 上传文件目录（与 app.UPLOAD_FOLDER 相同），仅用于回填 goods_media
+MEDIA_DIR = os.path.join(os.path.dirname(BASE_DIR), "media")
+
+# 连接池配置：最多保留的空闲连接数；空闲超过该秒数的连接取出时先做健康检查
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.environ.get("DB_POOL_HEALTHCHECK_INTERVAL", 30))
+
+# 存储模式配置
+# - DB_JOURNAL_MODE: WAL 下读不阻塞写、写不阻塞读
+# - DB_SYNCHRONOUS: WAL 下 NORMAL 已足够安全（断电最多丢最后几个事务，不会损坏库）
+# - DB_BUSY_TIMEOUT_MS: 遇到锁时等待的毫秒数，而不是立刻抛出 "database is locked"
+# - DB_CACHE_SIZE_KB / DB_MMAP_SIZE: 每条连接的页缓存大小与内存映射大小
+# - DB_SINGLE_WRITER: 所有写操作交给一个专用写线程串行执行
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL")
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", 16384))
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 256 * 1024 * 1024))
+DB_SINGLE_WRITER = os.environ.get("DB_SINGLE_WRITER", "1").lower() in ("1", "true", "yes")
+# 全文搜索时参与 BM25 相关度排序的最新匹配条数，更早的匹配按时间倒序排在后面
+DB_SEARCH_RANK_WINDOW = int(os.environ.get("DB_SEARCH_RANK_WINDOW", 1000))
+# 写线程一次最多合并提交的写操作数
+DB_WRITER_BATCH = int(os.environ.get("DB_WRITER_BATCH", 64))
+# 等待写操作结果时，每隔该秒数确认一次写线程仍在运行
+DB_WRITER_CHECK_INTERVAL = float(os.environ.get("DB_WRITER_CHECK_INTERVAL", 1))
+
+
+def _search_bigrams(text: Optional[str]) -> str:
+	"""
+	把文本切成以空格分隔的二元组（相邻两个字母/数字/汉字），供 goods_bigram 索引。
+	跨越空白或标点的组合不输出。
+	"""
+	if not text:
+		return ""
+	text = text.lower()
+	return " ".join(
+		text[i:i + 2] for i in range(len(text) - 1) if text[i].isalnum() and text[i + 1].isalnum()
+	)
 
 
 def _get_conn() -> sqlite3.Connection:
-	conn = sqlite3.connect(DB_PATH)
+	"""建立一条新的数据库连接。业务代码请使用 `_connection()` 从连接池借用。"""
+	conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000)
 	conn.row_factory = sqlite3.Row
 	conn.execute("PRAGMA foreign_keys = ON")
+	conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+	conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+	# 负数表示以 KiB 为单位
+	conn.execute(f"PRAGMA cache_size = {-DB_CACHE_SIZE_KB}")
+	conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
 	return conn
 
 
+class _ConnectionPool:
+	"""
+	SQLite 连接池。
+	- 空闲连接放在 LIFO 队列里复用（最近用过的连接优先，页缓存更热），最多保留 `size` 条
+	- 同一线程内嵌套借用时直接复用当前连接，不会重复占用
+	- 空闲超过 `healthcheck_interval` 秒的连接在借出前执行 `SELECT 1`，失效则丢弃重建
+	"""
+
+	def __init__(self, size: int, healthcheck_interval: float):
+		self.size = size
+		self.healthcheck_interval = healthcheck_interval
+		self._idle: "queue.LifoQueue" = queue.LifoQueue()
+		self._local = threading.local()
+
+	@staticmethod
+	def _is_healthy(conn: sqlite3.Connection) -> bool:
+		try:
+			conn.execute("SELECT 1").fetchone()
+			return True
+		except sqlite3.Error:
+			return False
+
+	def _checkout(self) -> sqlite3.Connection:
+		while True:
+			try:
+				conn, last_used = self._idle.get_nowait()
+			except queue.Empty:
+				return _get_conn()
+			if time.monotonic() - last_used < self.healthcheck_interval or self._is_healthy(conn):
+				return conn
+			try:
+				conn.close()
+			except sqlite3.Error:
+				pass
+
+	def _checkin(self, conn: sqlite3.Connection) -> None:
+		if self.size <= 0 or self._idle.qsize() >= self.size:
+			conn.close()
+			return
+		self._idle.put((conn, time.monotonic()))
+
+	@contextmanager
+	def connection(self) -> Iterator[sqlite3.Connection]:
+		local = self._local
+		conn = getattr(local, "conn", None)
+		if conn is not None:
+			yield conn
+			return
+
+		conn = self._checkout()
+		local.conn = conn
+		try:
+			yield conn
+		finally:
+			local.conn = None
+			# 未提交的事务（通常是异常退出）一律回滚，保证归还的连接是干净的
+			if conn.in_transaction:
+				conn.rollback()
+			self._checkin(conn)
+
+	def close_all(self) -> None:
+		"""关闭所有空闲连接（例如切换 DB_PATH 之后）"""
+		while True:
+			try:
+				conn, _ = self._idle.get_nowait()
+			except queue.Empty:
+				return
+			conn.close()
+
+
+_pool = _ConnectionPool(DB_POOL_SIZE, DB_POOL_HEALTHCHECK_INTERVAL)
+
+
+def _connection():
+	"""从连接池借用一条连接：`with _connection() as conn: ...`"""
+	return _pool.connection()
+
+
+class _Writer:
+	"""
+	单写线程。
+	所有写操作以 `fn(conn)` 的形式进入队列，由专用线程在自己的连接上执行，
+	避免多个请求线程同时抢写锁。队列中积压的写操作会合并在同一个事务里提交
+	（每个操作各自一个 SAVEPOINT，失败只回滚自己），提交成功后才通知调用方。
+	"""
+
+	def __init__(self, batch: int):
+		self.batch = batch
+		self._queue: "queue.Queue" = queue.Queue()
+		self._thread: Optional[threading.Thread] = None
+		self._conn: Optional[sqlite3.Connection] = None
+		self._start_lock = threading.Lock()
+		self._stats_lock = threading.Lock()
+		self._writes = 0
+		self._errors = 0
+		self._restarts = 0
+		self._total_wait = 0.0
+		self._total_exec = 0.0
+		self._max_latency = 0.0
+
+	def _ensure_started(self) -> None:
+		"""启动写线程；线程意外退出（或在 fork 出的子进程中不存在）时重新启动"""
+		thread = self._thread
+		if thread is not None and thread.is_alive():
+			return
+		with self._start_lock:
+			if self._thread is not None and self._thread.is_alive():
+				return
+			if self._thread is not None:
+				self._restarts += 1
+				self._conn = None
+			thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+			thread.start()
+			self._thread = thread
+
+	def submit(self, fn):
+		"""提交写操作并等待结果；写线程内部的嵌套写直接执行"""
+		if threading.current_thread() is self._thread:
+			return fn(self._conn)
+		self._ensure_started()
+		future: Future = Future()
+		self._queue.put((fn, future, time.perf_counter()))
+		while True:
+			try:
+				return future.result(timeout=DB_WRITER_CHECK_INTERVAL)
+			except FutureTimeoutError:
+				# 写线程若已退出，重新启动它来处理队列中的操作
+				self._ensure_started()
+
+	def _open(self) -> sqlite3.Connection:
+		if self._conn is None:
+			conn = _get_conn()
+			# 事务由写线程显式控制
+			conn.isolation_level = None
+			self._conn = conn
+		return self._conn
+
+	def _discard_conn(self) -> None:
+		"""连接状态未知（ROLLBACK 失败等）时丢弃，下一批重新建立"""
+		conn, self._conn = self._conn, None
+		if conn is not None:
+			try:
+				conn.close()
+			except sqlite3.Error:
+				pass
+
+	def _run(self) -> None:
+		while True:
+			jobs = [self._queue.get()]
+			while len(jobs) < self.batch:
+				try:
+					jobs.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+			try:
+				self._run_batch(jobs)
+			except BaseException as e:
+				# 兜底：任何异常都不能让调用方永远等待，也不能让写线程退出
+				self._discard_conn()
+				for _, future, _ in jobs:
+					if not future.done():
+						future.set_exception(e)
+
+	def _run_batch(self, jobs) -> None:
+		started = time.perf_counter()
+		outcomes = []
+		try:
+			conn = self._open()
+			conn.execute("BEGIN IMMEDIATE")
+			for fn, future, _ in jobs:
+				conn.execute("SAVEPOINT job")
+				try:
+					outcomes.append((future, fn(conn), None))
+					conn.execute("RELEASE job")
+				except BaseException as e:
+					conn.execute("ROLLBACK TO job")
+					conn.execute("RELEASE job")
+					outcomes.append((future, None, e))
+			conn.execute("COMMIT")
+		except BaseException as e:
+			try:
+				if self._conn is not None and self._conn.in_transaction:
+					self._conn.execute("ROLLBACK")
+			except Exception:
+				self._discard_conn()
+			outcomes = [(future, None, e) for _, future, _ in jobs]
+		finished = time.perf_counter()
+
+		with self._stats_lock:
+			for (_, _, enqueued), (_, _, error) in zip(jobs, outcomes):
+				self._writes += 1
+				if error is not None:
+					self._errors += 1
+				self._total_wait += started - enqueued
+				self._total_exec += (finished - started) / len(jobs)
+				self._max_latency = max(self._max_latency, finished - enqueued)
+
+		for future, result, error in outcomes:
+			if error is not None:
+				future.set_exception(error)
+			else:
+				future.set_result(result)
+
+	def stats(self) -> Dict:
+		with self._stats_lock:
+			writes = self._writes or 1
+			return {
+				"enabled": DB_SINGLE_WRITER,
+				"queue_depth": self._queue.qsize(),
+				"writes": self._writes,
+				"errors": self._errors,
+				"restarts": self._restarts,
+				"avg_wait_ms": round(self._total_wait / writes * 1000, 3),
+				"avg_exec_ms": round(self._total_exec / writes * 1000, 3),
+				"max_latency_ms": round(self._max_latency * 1000, 3),
+			}
+
+
+_writer = _Writer(DB_WRITER_BATCH)
+
+
+def _write(fn):
+	"""
+	执行一个写操作 `fn(conn)` 并返回其结果。
+	fn 内不要 commit，事务由这里统一提交。
+	"""
+	if DB_SINGLE_WRITER:
+		return _writer.submit(fn)
+	with _connection() as conn:
+		result = fn(conn)
+		conn.commit()
+		return result
+
+
+def get_write_stats() -> Dict:
+	"""写队列的积压深度与写延迟统计"""
+	return _writer.stats()
+
+
+class _LabelSnapshot:
+	"""某一版 labels.json 的解析结果，创建后不再修改，可在线程间直接共享"""
+
+	def __init__(self, labels: List[Dict], mtime: Optional[float]):
+		self.labels = labels
+		self.mtime = mtime
+		self.by_id: Dict[int, Dict] = {label["id"]: label for label in labels}
+		self.ids = frozenset(self.by_id)
+		self.subscribable_ids = frozenset(label["id"] for label in labels if label.get("can_subscribe", False))
+		# /labels 直接返回这份序列化结果
+		self.payload = json.dumps(labels, ensure_ascii=False).encode("utf-8")
+		self.etag = hashlib.sha1(self.payload).hexdigest()
+
+
+class _LabelRegistry:
+	"""
+	标签表（labels.json）只在启动时和文件修改后解析一次：
+	- 按 id 建索引，可订阅标签的 id 预先算成 frozenset
+	- 每隔 check_interval 秒检查一次文件 mtime，变化后重新加载；解析失败时继续使用上一版
+	"""
+
+	def __init__(self, path: str, check_interval: float):
+		self.path = path
+		self.check_interval = check_interval
+		self._lock = threading.Lock()
+		self._snapshot = _LabelSnapshot([], None)
+		self._failed_mtime: Optional[float] = None
+		self._checked_at: Optional[float] = None
+
+	def snapshot(self) -> _LabelSnapshot:
+		checked_at = self._checked_at
+		if checked_at is not None and time.monotonic() - checked_at < self.check_interval:
+			return self._snapshot
+		with self._lock:
+			if self._checked_at == checked_at:
+				self._reload_if_changed()
+				self._checked_at = time.monotonic()
+		return self._snapshot
+
+	def _reload_if_changed(self) -> None:
+		try:
+			mtime = os.stat(self.path).st_mtime
+		except OSError:
+			if self._snapshot.mtime is not None:
+				self._snapshot = _LabelSnapshot([], None)
+			return
+		if mtime in (self._snapshot.mtime, self._failed_mtime):
+			return
+		try:
+			with open(self.path, "r", encoding="utf-8") as f:
+				labels = json.load(f)
+			self._snapshot = _LabelSnapshot(labels, mtime)
+		except Exception as e:
+			# 同一版坏文件只报一次，文件再次修改后重试
+			self._failed_mtime = mtime
+			print(f"加载标签文件失败，继续使用上一版: {e}")
+
+
+# 检查 labels.json 是否被修改的间隔（秒）
+DB_LABELS_CHECK_INTERVAL = float(os.environ.get("DB_LABELS_CHECK_INTERVAL", 2))
+_labels = _LabelRegistry(LABELS_PATH, DB_LABELS_CHECK_INTERVAL)
+
+
 def get_all_labels() -> List[Dict]:
-	"""Load all available labels from the JSON file."""
-	if not os.path.exists(LABELS_PATH):
-		return []
-	try:
-		with open(LABELS_PATH, "r", encoding="utf-8") as f:
-			return json.load(f)
-	except Exception:
-		return []
+	"""All available labels from labels.json (cached, reloaded when the file changes)."""
+	return _labels.snapshot().labels
 
 
-def init_db() -> None:
-	"""Create tables if they do not exist."""
-	conn = _get_conn()
-	cur = conn.cursor()
-	cur.executescript(
-		"""
-		CREATE TABLE IF NOT EXISTS users (
-			id INTEGER PRIMARY KEY AUTOINCREMENT,
-			name TEXT NOT NULL,
-			email TEXT,
-			pswd_hash TEXT,
-			prefer TEXT NOT NULL DEFAULT '[]',
-			verified BOOLEAN DEFAULT FALSE,
-			confirmation_token TEXT,
-			created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-		);
-
-		CREATE TABLE IF NOT EXISTS goods (
-			id INTEGER PRIMARY KEY AUTOINCREMENT,
-			seller_id INTEGER NOT NULL,
-			type BOOLEAN DEFAULT FALSE,
-			name TEXT NOT NULL,
-			num INTEGER NOT NULL,
-			sold_num INTEGER NOT NULL,
-			labels TEXT NOT NULL DEFAULT '[]',
-			value FLOAT NOT NULL,
-			description TEXT,
-			status TEXT NOT NULL DEFAULT 'available' CHECK(status IN ('available','sold','removed')),
-			created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-			FOREIGN KEY(seller_id) REFERENCES users(id)
-		);
-
-		CREATE TABLE IF NOT EXISTS orders (
-			id INTEGER PRIMARY KEY AUTOINCREMENT,
-			goods_id INTEGER NOT NULL,
-			num INTEGER NOT NULL,
-			buyer_id INTEGER NOT NULL,
-			status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('processing','completed','cancelled')),
-			created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-			FOREIGN KEY(goods_id) REFERENCES goods(id),
-			FOREIGN KEY(buyer_id) REFERENCES users(id)
-		);
-
-		CREATE TABLE IF NOT EXISTS messages (
-			id INTEGER PRIMARY KEY AUTOINCREMENT,
-			sender_id INTEGER NOT NULL,
-			receiver_id INTEGER NOT NULL,
-			text TEXT NOT NULL,
-			created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-			FOREIGN KEY(sender_id) REFERENCES users(id),
-			FOREIGN KEY(receiver_id) REFERENCES users(id)
-		);
+def get_label(label_id: int) -> Optional[Dict]:
+	return _labels.snapshot().by_id.get(label_id)
+
 
-		CREATE TABLE IF NOT EXISTS sessions (
-			session_token TEXT PRIMARY KEY,
-			user_id INTEGER NOT NULL,
+def get_subscribable_label_ids() -> frozenset:
+	"""可订阅（can_subscribe 为 true）的标签 id"""
+	return _labels.snapshot().subscribable_ids
+
+
+def get_labels_payload() -> Tuple[bytes, str]:
+	"""返回 (序列化好的标签列表 JSON 字节, ETag)"""
+	snapshot = _labels.snapshot()
+	return snapshot.payload, snapshot.etag
+
+
+def _backfill_goods_media(conn: sqlite3.Connection) -> None:
+	"""建表，并把 media/good_<id>/good_<id>_<序号>.<扩展名> 这些已上传的文件登记进去"""
+	conn.execute("""
+		CREATE TABLE IF NOT EXISTS goods_media (
+			good_id INTEGER NOT NULL,
+			position INTEGER NOT NULL,
+			path TEXT NOT NULL,
 			created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-			expires_at TIMESTAMP NOT NULL,
-			FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
-		);
-		"""
+			PRIMARY KEY (good_id, position),
+			FOREIGN KEY(good_id) REFERENCES goods(id) ON DELETE CASCADE
+		) WITHOUT ROWID
+	""")
+	if not os.path.isdir(MEDIA_DIR):
+		return
+	pattern = re.compile(r"good_(\d+)_(\d+)\.\w+$")
+	rows = []
+	for entry in os.scandir(MEDIA_DIR):
+		if not entry.is_dir() or not entry.name.startswith("good_"):
+			continue
+		for file in os.scandir(entry.path):
+			m = pattern.match(file.name)
+			if m and f"good_{m.group(1)}" == entry.name:
+				rows.append((int(m.group(1)), int(m.group(2)), f"{entry.name}/{file.name}"))
+	known = {row[0] for row in conn.execute("SELECT id FROM goods")}
+	conn.executemany(
+		"INSERT OR REPLACE INTO goods_media (good_id, position, path) VALUES (?, ?, ?)",
+		[row for row in sorted(rows) if row[0] in known],
+	)
+
+
+def _backfill_user_avatars(conn: sqlite3.Connection) -> None:
+	"""users 增加 avatar 列（相对 media 目录的路径），并登记 media/user/avatar_<id>.<扩展名> 这些已上传的头像"""
+	conn.execute("ALTER TABLE users ADD COLUMN avatar TEXT")
+	user_dir = os.path.join(MEDIA_DIR, "user")
+	if not os.path.isdir(user_dir):
+		return
+	pattern = re.compile(r"avatar_(\d+)\.\w+$")
+	conn.executemany(
+		"UPDATE users SET avatar = ? WHERE id = ?",
+		[(f"user/{entry.name}", int(m.group(1))) for entry in os.scandir(user_dir) if (m := pattern.match(entry.name))],
+	)
+
+
+def _unique_user_logins(conn: sqlite3.Connection) -> None:
+	"""
+	name、email 改为唯一索引。已有重复值时不自动改名或清空邮箱（那些用户会无法用熟悉的用户名/邮箱登录），
+	而是列出冲突的账号并中止迁移，由运维处理后重新启动。
+	"""
+	conflicts = []
+	for column, label in (("name", "用户名"), ("email", "邮箱")):
+		for value, ids in conn.execute(
+			f"SELECT {column}, GROUP_CONCAT(id, ', ') FROM users WHERE {column} IS NOT NULL "
+			f"GROUP BY {column} HAVING COUNT(*) > 1 ORDER BY MIN(id)"
+		):
+			conflicts.append(f"  {label} {value!r}: 用户 id {ids}")
+	if conflicts:
+		raise RuntimeError(
+			"users 表存在重复的用户名或邮箱，无法建立唯一索引。"
+			"请修改或合并以下账号（每个用户名/邮箱只保留一个账号使用）后重新启动：\n" + "\n".join(conflicts)
+		)
+	conn.execute("DROP INDEX IF EXISTS idx_users_name")
+	conn.execute("DROP INDEX IF EXISTS idx_users_email")
+	conn.execute("CREATE UNIQUE INDEX idx_users_name ON users(name)")
+	conn.execute("CREATE UNIQUE INDEX idx_users_email ON users(email)")
+
+
+def _create_goods_bigram(conn: sqlite3.Connection) -> None:
+	"""
+	建二元组索引 goods_bigram 并登记在售商品。列内容是 _search_bigrams 输出的空格分隔二元组；
+	普通（有内容的）FTS5 表，删除时按 rowid 即可，不需要重新计算原来的二元组
+	"""
+	conn.execute("""
+		CREATE VIRTUAL TABLE goods_bigram USING fts5(
+			name, description, tokenize='unicode61 remove_diacritics 0'
+		)
+	""")
+	conn.executemany(
+		"INSERT INTO goods_bigram (rowid, name, description) VALUES (?, ?, ?)",
+		[
+			(row[0], _search_bigrams(row[1]), _search_bigrams(row[2]))
+			for row in conn.execute("SELECT id, name, description FROM goods WHERE status = 'available'")
+		],
+	)
+	conn.execute("INSERT INTO goods_bigram (goods_bigram) VALUES ('optimize')")
+
+
+def _drop_goods_bigram_triggers(conn: sqlite3.Connection) -> None:
+	"""
+	早先的 14 号迁移用触发器维护无内容的 goods_bigram，触发器调用只在本模块连接上注册的 Python 函数，
+	其他连接（sqlite3 命令行、运维脚本）因此无法写入 goods。删除触发器并按现在的 14 号迁移重建索引
+	"""
+	triggers = [row[0] for row in conn.execute(
+		"SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'goods_bigram_%'"
+	)]
+	if not triggers:
+		return
+	for name in triggers:
+		conn.execute(f"DROP TRIGGER {name}")
+	conn.execute("DROP TABLE goods_bigram")
+	_create_goods_bigram(conn)
+
+
+def _index_good_bigrams(conn: sqlite3.Connection, good_id: int) -> None:
+	"""在写事务内同步一个商品的 goods_bigram 行（只索引在售商品）。修改 goods 的 name、description、status 后调用"""
+	conn.execute("DELETE FROM goods_bigram WHERE rowid = ?", (good_id,))
+	row = conn.execute("SELECT name, description, status FROM goods WHERE id = ?", (good_id,)).fetchone()
+	if row is not None and row["status"] == "available":
+		conn.execute(
+			"INSERT INTO goods_bigram (rowid, name, description) VALUES (?, ?, ?)",
+			(good_id, _search_bigrams(row["name"]), _search_bigrams(row["description"])),
+		)
+
+
+# 数据库结构迁移。版本号记录在 PRAGMA user_version 中，init_db() 会按顺序执行尚未应用的迁移。
+# 每一项为 (版本号, 说明, SQL 脚本或接收连接的函数)。已发布的迁移不要修改，新结构变更请追加新版本。
+_MIGRATIONS = [
+	(1, "initial schema", """
+	CREATE TABLE IF NOT EXISTS users (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		name TEXT NOT NULL,
+		email TEXT,
+		pswd_hash TEXT,
+		prefer TEXT NOT NULL DEFAULT '[]',
+		verified BOOLEAN DEFAULT FALSE,
+		confirmation_token TEXT,
+		created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+	);
+
+	CREATE TABLE IF NOT EXISTS goods (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		seller_id INTEGER NOT NULL,
+		type BOOLEAN DEFAULT FALSE,
+		name TEXT NOT NULL,
+		num INTEGER NOT NULL,
+		sold_num INTEGER NOT NULL,
+		labels TEXT NOT NULL DEFAULT '[]',
+		value FLOAT NOT NULL,
+		description TEXT,
+		status TEXT NOT NULL DEFAULT 'available' CHECK(status IN ('available','sold','removed')),
+		created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+		FOREIGN KEY(seller_id) REFERENCES users(id)
+	);
+
+	CREATE TABLE IF NOT EXISTS orders (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		goods_id INTEGER NOT NULL,
+		num INTEGER NOT NULL,
+		buyer_id INTEGER NOT NULL,
+		status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('processing','completed','cancelled')),
+		created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+		FOREIGN KEY(goods_id) REFERENCES goods(id),
+		FOREIGN KEY(buyer_id) REFERENCES users(id)
+	);
+
+	CREATE TABLE IF NOT EXISTS messages (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		sender_id INTEGER NOT NULL,
+		receiver_id INTEGER NOT NULL,
+		text TEXT NOT NULL,
+		created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+		FOREIGN KEY(sender_id) REFERENCES users(id),
+		FOREIGN KEY(receiver_id) REFERENCES users(id)
+	);
+
+	CREATE TABLE IF NOT EXISTS sessions (
+		session_token TEXT PRIMARY KEY,
+		user_id INTEGER NOT NULL,
+		created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+		expires_at TIMESTAMP NOT NULL,
+		FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+	);
+	"""),
+	(2, "secondary indexes for hot lookups", """
+	CREATE INDEX IF NOT EXISTS idx_goods_seller_type ON goods(seller_id, type);
+	CREATE INDEX IF NOT EXISTS idx_goods_type_status ON goods(type, status);
+	CREATE INDEX IF NOT EXISTS idx_orders_buyer ON orders(buyer_id);
+	CREATE INDEX IF NOT EXISTS idx_orders_goods ON orders(goods_id);
+	CREATE INDEX IF NOT EXISTS idx_messages_pair ON messages(sender_id, receiver_id, created_at);
+	CREATE INDEX IF NOT EXISTS idx_users_confirmation_token ON users(confirmation_token);
+	CREATE INDEX IF NOT EXISTS idx_users_name ON users(name);
+	CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+	"""),
+	(3, "conversation summaries maintained by create_message", """
+	CREATE TABLE IF NOT EXISTS conversations (
+		user_id INTEGER NOT NULL,
+		peer_id INTEGER NOT NULL,
+		last_message_id INTEGER NOT NULL,
+		unread_count INTEGER NOT NULL DEFAULT 0,
+		PRIMARY KEY (user_id, peer_id),
+		FOREIGN KEY(user_id) REFERENCES users(id),
+		FOREIGN KEY(peer_id) REFERENCES users(id),
+		FOREIGN KEY(last_message_id) REFERENCES messages(id)
+	) WITHOUT ROWID;
+	CREATE INDEX IF NOT EXISTS idx_conversations_user_recent ON conversations(user_id, last_message_id);
+
+	-- 历史消息没有已读状态，回填时未读数记为 0
+	INSERT OR REPLACE INTO conversations (user_id, peer_id, last_message_id, unread_count)
+	SELECT user_id, peer_id, MAX(id), 0 FROM (
+		SELECT sender_id AS user_id, receiver_id AS peer_id, id FROM messages
+		UNION ALL
+		SELECT receiver_id AS user_id, sender_id AS peer_id, id FROM messages
+	)
+	GROUP BY user_id, peer_id;
+	"""),
+	(4, "message index keyed by id for keyset pagination", """
+	DROP INDEX IF EXISTS idx_messages_pair;
+	CREATE INDEX IF NOT EXISTS idx_messages_pair_id ON messages(sender_id, receiver_id, id);
+	"""),
+	(5, "durable outbound mail queue", """
+	CREATE TABLE IF NOT EXISTS mail_queue (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		to_email TEXT NOT NULL,
+		to_name TEXT,
+		subject TEXT NOT NULL,
+		content TEXT NOT NULL,
+		html TEXT,
+		status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending','sending','sent','dead')),
+		attempts INTEGER NOT NULL DEFAULT 0,
+		next_attempt_at REAL NOT NULL,
+		last_error TEXT,
+		created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+		sent_at TIMESTAMP
+	);
+	CREATE INDEX IF NOT EXISTS idx_mail_queue_due ON mail_queue(status, next_attempt_at);
+	"""),
+	(6, "label -> subscriber index for new-arrival notifications", """
+	CREATE TABLE IF NOT EXISTS user_preferences (
+		user_id INTEGER NOT NULL,
+		label_id INTEGER NOT NULL,
+		PRIMARY KEY (user_id, label_id),
+		FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+	) WITHOUT ROWID;
+	CREATE INDEX IF NOT EXISTS idx_user_preferences_label ON user_preferences(label_id, user_id);
+
+	-- 从 users.prefer（JSON 数组）回填，非法数据跳过
+	INSERT OR IGNORE INTO user_preferences (user_id, label_id)
+	SELECT u.id, j.value FROM users u, json_each(u.prefer) j
+	WHERE json_valid(u.prefer) AND json_type(u.prefer) = 'array' AND j.type = 'integer';
+	"""),
+	# 只新增表并回填，goods.labels 列保留且继续写入，旧代码与新代码可以同时运行
+	(7, "goods_labels join table for label filtering and facets", """
+	CREATE TABLE IF NOT EXISTS goods_labels (
+		good_id INTEGER NOT NULL,
+		label_id INTEGER NOT NULL,
+		PRIMARY KEY (good_id, label_id),
+		FOREIGN KEY(good_id) REFERENCES goods(id) ON DELETE CASCADE
+	) WITHOUT ROWID;
+	CREATE INDEX IF NOT EXISTS idx_goods_labels_label ON goods_labels(label_id, good_id);
+	CREATE INDEX IF NOT EXISTS idx_goods_status ON goods(status);
+
+	INSERT OR IGNORE INTO goods_labels (good_id, label_id)
+	SELECT g.id, j.value FROM goods g, json_each(g.labels) j
+	WHERE json_valid(g.labels) AND json_type(g.labels) = 'array' AND j.type = 'integer';
+	"""),
+	# 外部内容 FTS5 表，正文存在 goods 里；只索引在售商品，由触发器随插入、修改、状态变化同步。
+	# trigram 分词按 3 个字符切分，不依赖空格，适合中文
+	(8, "full-text index over available goods", """
+	CREATE VIRTUAL TABLE IF NOT EXISTS goods_fts USING fts5(
+		name, description, content='goods', content_rowid='id', tokenize='trigram'
+	);
+
+	CREATE TRIGGER IF NOT EXISTS goods_fts_ai AFTER INSERT ON goods WHEN new.status = 'available' BEGIN
+		INSERT INTO goods_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+	END;
+	CREATE TRIGGER IF NOT EXISTS goods_fts_ad AFTER DELETE ON goods WHEN old.status = 'available' BEGIN
+		INSERT INTO goods_fts (goods_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+	END;
+	CREATE TRIGGER IF NOT EXISTS goods_fts_au AFTER UPDATE OF name, description, status ON goods BEGIN
+		INSERT INTO goods_fts (goods_fts, rowid, name, description)
+		SELECT 'delete', old.id, old.name, old.description WHERE old.status = 'available';
+		INSERT INTO goods_fts (rowid, name, description)
+		SELECT new.id, new.name, new.description WHERE new.status = 'available';
+	END;
+
+	INSERT INTO goods_fts (rowid, name, description)
+	SELECT id, name, description FROM goods WHERE status = 'available';
+	INSERT INTO goods_fts (goods_fts) VALUES ('optimize');
+	"""),
+	(9, "goods_media table replacing media directory listings", _backfill_goods_media),
+	(10, "index goods_media.path for shared content-addressed files", """
+	CREATE INDEX IF NOT EXISTS idx_goods_media_path ON goods_media(path);
+	"""),
+	(11, "users.avatar replacing avatar file probing", _backfill_user_avatars),
+	(12, "unique indexes on users.name and users.email", _unique_user_logins),
+	(13, "sessions with integer epoch expiry and an expiry index", """
+	CREATE TABLE sessions_new (
+		session_token TEXT PRIMARY KEY,
+		user_id INTEGER NOT NULL,
+		created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+		expires_at INTEGER NOT NULL,
+		lifetime INTEGER NOT NULL,
+		FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
+	) WITHOUT ROWID;
+	-- 旧的 expires_at 是本地时间的 ISO 字符串，created_at 是 UTC（CURRENT_TIMESTAMP）
+	INSERT INTO sessions_new (session_token, user_id, created_at, expires_at, lifetime)
+	SELECT session_token, user_id, created, expires, MAX(expires - created, 0)
+	FROM (
+		SELECT session_token, user_id,
+			COALESCE(CAST(strftime('%s', created_at) AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)) AS created,
+			CAST(strftime('%s', expires_at, 'utc') AS INTEGER) AS expires
+		FROM sessions
 	)
-	conn.commit()
-	conn.close()
+	WHERE expires IS NOT NULL;
+	DROP TABLE sessions;
+	ALTER TABLE sessions_new RENAME TO sessions;
+	CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at);
+	"""),
+	# trigram 索引无法查询两个字的词（大部分中文词），这里再建一个二元组索引，由商品的写函数维护
+	(14, "bigram full-text index for two-character terms", _create_goods_bigram),
+	# claimed_at 为取出发送的时间戳，超过租约仍是 sending 的邮件才视为发送进程已退出
+	(15, "mail_queue claim leases and sent-mail retention", """
+	ALTER TABLE mail_queue ADD COLUMN claimed_at REAL;
+	CREATE INDEX IF NOT EXISTS idx_mail_queue_sent ON mail_queue(status, sent_at);
+	"""),
+	(16, "goods_bigram maintained by the goods write functions instead of triggers", _drop_goods_bigram_triggers),
+]
+
+
+def _migrate(conn: sqlite3.Connection) -> int:
+	"""执行所有未应用的迁移，每个迁移连同版本号在同一个事务中提交。返回迁移后的版本号。"""
+	current = conn.execute("PRAGMA user_version").fetchone()[0]
+	for version, description, step in _MIGRATIONS:
+		if version <= current:
+			continue
+		if callable(step):
+			conn.execute("BEGIN IMMEDIATE")
+			try:
+				step(conn)
+				conn.execute(f"PRAGMA user_version = {version}")
+				conn.commit()
+			except BaseException:
+				conn.rollback()
+				raise
+		else:
+			# executescript 会先提交挂起的事务，所以把 BEGIN/COMMIT 写进脚本里
+			try:
+				conn.executescript(f"BEGIN IMMEDIATE;\n{step}\nPRAGMA user_version = {version};\nCOMMIT;")
+			except BaseException:
+				if conn.in_transaction:
+					conn.rollback()
+				raise
+		current = version
+	return current
+
+
+def init_db() -> None:
+	"""Create tables if they do not exist, then apply pending schema migrations."""
+	with _connection() as conn:
+		# journal_mode 是持久化在数据库文件里的，设置一次即可
+		conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+		_migrate(conn)
 
 
 def _row_to_dict(row: Optional[sqlite3.Row]) -> Optional[Dict]:
@@ -125,21 +778,26 @@ def _deserialize_labels(s: Optional[str]) -> List[int]:
 		return []
 
 
+# 热点查询的 SQL 写成模块常量（动态部分用 str.format 填入），函数与 _hot_queries() 的查询计划检查共用同一份
+_SQL_GET_USER = "SELECT * FROM users WHERE id = ?"
+
+
 def get_user(user_id: int) -> Optional[Dict]:
-	conn = _get_conn()
-	row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-	conn.close()
+	with _connection() as conn:
+		row = conn.execute(_SQL_GET_USER, (user_id,)).fetchone()
 	data = _row_to_dict(row)
 	if data is not None and "prefer" in data:
 		data["prefer"] = _deserialize_labels(data.get("prefer"))
 	return data
 
 
+_SQL_GOODS_BY_SELLER = "SELECT * FROM goods WHERE seller_id = ? AND type = ?"
+
+
 def get_goods_by_seller(seller_id: int, is_good: bool) -> List[Dict]:
-	conn = _get_conn()
 	type_filter = 0 if is_good else 1
-	rows = conn.execute("SELECT * FROM goods WHERE seller_id = ? AND type = ?", (seller_id, type_filter)).fetchall()
-	conn.close()
+	with _connection() as conn:
+		rows = conn.execute(_SQL_GOODS_BY_SELLER, (seller_id, type_filter)).fetchall()
 	results = []
 	for row in rows:
 		data = _row_to_dict(row)
@@ -151,16 +809,26 @@ def get_goods_by_seller(seller_id: int, is_good: bool) -> List[Dict]:
 
 
 def create_user(name: str, email: Optional[str] = None, pswd_hash: Optional[str] = None, verified: bool = False, confirmation_token: Optional[str] = None) -> Optional[Dict]:
-	conn = _get_conn()
-	cur = conn.cursor()
-	cur.execute(
-		"INSERT INTO users (name, email, pswd_hash, verified, confirmation_token) VALUES (?, ?, ?, ?, ?)",
-		(name, email, pswd_hash, verified, confirmation_token),
-	)
-	conn.commit()
-	user_id = cur.lastrowid
-	row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-	conn.close()
+	"""用户名或邮箱已被占用时抛出 ValueError"""
+	def _insert(conn):
+		cur = conn.execute(
+			"INSERT INTO users (name, email, pswd_hash, verified, confirmation_token) VALUES (?, ?, ?, ?, ?)",
+			(name, email, pswd_hash, verified, confirmation_token),
+		)
+		return conn.execute("SELECT * FROM users WHERE id = ?", (cur.lastrowid,)).fetchone()
+
+	try:
+		row = _write(_insert)
+	except sqlite3.IntegrityError as e:
+		if "users.name" in str(e):
+			raise ValueError("用户名已被使用") from e
+		if "users.email" in str(e):
+			raise ValueError("邮箱已被注册") from e
+		raise
+	# 新账号的用户名/邮箱可能刚被记为"查无此人"
+	_login_misses.discard(name)
+	if email:
+		_login_misses.discard(email)
 	return _row_to_dict(row)
 
 
@@ -168,175 +836,626 @@ def create_good(name: str, seller_id: int,  num: int, value: float, description:
 	"""Create a good. `labels` should be a list of ints (category/tag ids).
 	Returns the created row as a dict.
 	"""
-	conn = _get_conn()
-	cur = conn.cursor()
 	labels_json = _serialize_labels(labels)
-	cur.execute(
-		"INSERT INTO goods (seller_id, name, num, sold_num, labels, value, description, status, type) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-		(seller_id, name, num, 0, labels_json, value, description, status, type),
-	)
-	conn.commit()
-	good_id = cur.lastrowid
-	row = conn.execute("SELECT * FROM goods WHERE id = ?", (good_id,)).fetchone()
-	conn.close()
+
+	def _insert(conn):
+		cur = conn.execute(
+			"INSERT INTO goods (seller_id, name, num, sold_num, labels, value, description, status, type) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+			(seller_id, name, num, 0, labels_json, value, description, status, type),
+		)
+		conn.executemany(
+			"INSERT OR IGNORE INTO goods_labels (good_id, label_id) VALUES (?, ?)",
+			[(cur.lastrowid, label_id) for label_id in labels or []],
+		)
+		_index_good_bigrams(conn, cur.lastrowid)
+		return conn.execute("SELECT * FROM goods WHERE id = ?", (cur.lastrowid,)).fetchone()
+
+	row = _write(_insert)
 	print(row)
 	if row is None:
 		return None
+	if row["status"] == "available":
+		_available_goods.add(row["id"], row["type"])
 	data = _row_to_dict(row)
 	if data is not None and "labels" in data:
 		data["labels"] = _deserialize_labels(data.get("labels"))
 	return data
 
 
+_SQL_GET_GOOD = "SELECT * FROM goods WHERE id = ?"
+
+
 def get_good(id: int) -> Optional[Dict]:
-	conn = _get_conn()
-	row = conn.execute("SELECT * FROM goods WHERE id = ?", (id,)).fetchone()
-	conn.close()
+	with _connection() as conn:
+		row = conn.execute(_SQL_GET_GOOD, (id,)).fetchone()
 	data = _row_to_dict(row)
 	if data is not None and "labels" in data:
 		data["labels"] = _deserialize_labels(data.get("labels"))
 	return data
 
 
+_SQL_AVAILABLE_GOOD_IDS = "SELECT id FROM goods WHERE type = ? AND status = 'available'"
+_SQL_RANDOM_GOODS = "SELECT * FROM goods WHERE id IN ({ids}) AND status = 'available' AND type = ?"
+
+
+def _placeholders(n: int) -> str:
+	return ",".join("?" * n)
+
+
+class _AvailableGoodsPool:
+	"""
+	在售商品 ID 池，按 type 分组，用于常数时间随机抽样（代替 ORDER BY RANDOM() 全量排序）。
+	- 每个 type 首次抽样时从索引加载一次，之后由 create_good / update_good_status 增量维护
+	- 每组用 列表 + 位置字典 保存，增删都是 O(1)（删除时与末尾元素交换）
+	- 超过 ttl 秒后整组重新加载，以吸收其他进程写入造成的偏差。每组同时只有一个线程加载，
+	  其余线程继续用旧数据抽样；加载期间的增删记在日志里，换上新数据前重放，不会丢失
+	"""
+
+	def __init__(self, ttl: float):
+		self.ttl = ttl
+		self._lock = threading.Lock()
+		self._ids: Dict[int, List[int]] = {}
+		self._pos: Dict[int, Dict[int, int]] = {}
+		self._loaded_at: Dict[int, float] = {}
+		self._load_locks: Dict[int, threading.Lock] = {}
+		# 正在加载的组 -> 加载期间的增删（"add"/"discard", good_id）
+		self._journal: Dict[int, List[Tuple[str, int]]] = {}
+
+	def _fresh(self, type_filter: int) -> bool:
+		loaded_at = self._loaded_at.get(type_filter)
+		return loaded_at is not None and time.monotonic() - loaded_at < self.ttl
+
+	def _ensure_loaded(self, type_filter: int) -> None:
+		if self._fresh(type_filter):
+			return
+		with self._lock:
+			load_lock = self._load_locks.setdefault(type_filter, threading.Lock())
+			loaded = type_filter in self._ids
+		# 已有（过期的）数据时不等待别的线程加载完，先用旧数据
+		if not load_lock.acquire(blocking=not loaded):
+			return
+		try:
+			if self._fresh(type_filter):
+				return
+			with self._lock:
+				self._journal[type_filter] = []
+			try:
+				with _connection() as conn:
+					rows = conn.execute(_SQL_AVAILABLE_GOOD_IDS, (type_filter,)).fetchall()
+				ids = [row["id"] for row in rows]
+				pos = {good_id: i for i, good_id in enumerate(ids)}
+				with self._lock:
+					for op, good_id in self._journal[type_filter]:
+						if op == "add":
+							self._append(ids, pos, good_id)
+						else:
+							self._remove(ids, pos, good_id)
+					self._ids[type_filter] = ids
+					self._pos[type_filter] = pos
+					self._loaded_at[type_filter] = time.monotonic()
+			finally:
+				with self._lock:
+					self._journal.pop(type_filter, None)
+		finally:
+			load_lock.release()
+
+	@staticmethod
+	def _append(ids: List[int], pos: Dict[int, int], good_id: int) -> None:
+		if good_id not in pos:
+			pos[good_id] = len(ids)
+			ids.append(good_id)
+
+	@staticmethod
+	def _remove(ids: List[int], pos: Dict[int, int], good_id: int) -> None:
+		index = pos.pop(good_id, None)
+		if index is None:
+			return
+		last = ids.pop()
+		if last != good_id:
+			ids[index] = last
+			pos[last] = index
+
+	def add(self, good_id: int, type_value) -> None:
+		type_filter = 1 if type_value else 0
+		with self._lock:
+			if type_filter in self._journal:
+				self._journal[type_filter].append(("add", good_id))
+			# 尚未加载的组在首次抽样时会从数据库完整读取
+			if type_filter in self._ids:
+				self._append(self._ids[type_filter], self._pos[type_filter], good_id)
+
+	def discard(self, good_id: int) -> None:
+		with self._lock:
+			for journal in self._journal.values():
+				journal.append(("discard", good_id))
+			for type_filter, pos in self._pos.items():
+				self._remove(self._ids[type_filter], pos, good_id)
+
+	def sample(self, type_filter: int, k: int) -> List[int]:
+		self._ensure_loaded(type_filter)
+		with self._lock:
+			ids = self._ids.get(type_filter, [])
+			return random.sample(ids, min(k, len(ids)))
+
+	def clear(self) -> None:
+		with self._lock:
+			self._ids.clear()
+			self._pos.clear()
+			self._loaded_at.clear()
+
+
+# 在售商品 ID 池整体重新加载的间隔（秒）
+DB_RANDOM_POOL_TTL = float(os.environ.get("DB_RANDOM_POOL_TTL", 300))
+_available_goods = _AvailableGoodsPool(DB_RANDOM_POOL_TTL)
+
+
 def get_random_goods(num: int, is_task: bool) -> List[Dict]:
-	conn = _get_conn()
+	"""随机取 num 个在售商品（不重复），耗时与商品总数无关。num 由调用方限制上限（IN 列表受 SQLite 参数个数限制）"""
+	if num <= 0:
+		return []
 	type_filter = 1 if is_task else 0
-	rows = conn.execute(
-		"SELECT * FROM goods WHERE status = 'available' AND type = ? ORDER BY RANDOM() LIMIT ?", (type_filter, num)
-	).fetchall()
-	conn.close()
+	ids = _available_goods.sample(type_filter, num)
+	if not ids:
+		return []
+	with _connection() as conn:
+		rows = conn.execute(
+			_SQL_RANDOM_GOODS.format(ids=_placeholders(len(ids))), (*ids, type_filter)
+		).fetchall()
+	# 保持抽样顺序；池中已过期（被其他进程下架）的 ID 会在这里被过滤掉
+	by_id = {row["id"]: row for row in rows}
+	results = []
+	for good_id in ids:
+		row = by_id.get(good_id)
+		if row is None:
+			_available_goods.discard(good_id)
+			continue
+		data = _row_to_dict(row)
+		if "labels" in data:
+			data["labels"] = _deserialize_labels(data.get("labels"))
+		results.append(data)
+	return results
+
+
+_SQL_MEDIA_PATH_REFERENCED = "SELECT 1 FROM goods_media WHERE path = ? LIMIT 1"
+_SQL_GOODS_MEDIA = "SELECT good_id, path FROM goods_media WHERE good_id IN ({ids}) ORDER BY good_id, position"
+
+
+def set_good_media(good_id: int, paths: List[str]) -> List[str]:
+	"""
+	用 paths（相对 media 目录的路径，按顺序占用序号 0..n-1）替换商品的全部媒体文件。
+	同一文件可被多个商品引用；返回被替换下来、且已不再被任何商品引用的路径，由调用方删除文件。
+	"""
+	def replace(conn: sqlite3.Connection) -> List[str]:
+		old = {row[0] for row in conn.execute("SELECT path FROM goods_media WHERE good_id = ?", (good_id,))}
+		conn.execute("DELETE FROM goods_media WHERE good_id = ? AND position >= ?", (good_id, len(paths)))
+		conn.executemany(
+			"""
+			INSERT INTO goods_media (good_id, position, path) VALUES (?, ?, ?)
+			ON CONFLICT(good_id, position) DO UPDATE SET path = excluded.path, created_at = CURRENT_TIMESTAMP
+			""",
+			[(good_id, position, path) for position, path in enumerate(paths)],
+		)
+		return [
+			path for path in sorted(old.difference(paths))
+			if conn.execute(_SQL_MEDIA_PATH_REFERENCED, (path,)).fetchone() is None
+		]
+
+	return _write(replace)
+
+
+def get_goods_media(good_ids: List[int]) -> Dict[int, List[str]]:
+	"""批量查询多个商品的媒体文件路径，返回 {商品 id: [路径, ...]}（按序号排序，没有文件的商品不出现）"""
+	good_ids = list(set(good_ids))
+	if not good_ids:
+		return {}
+	with _connection() as conn:
+		rows = conn.execute(_SQL_GOODS_MEDIA.format(ids=_placeholders(len(good_ids))), good_ids).fetchall()
+	media: Dict[int, List[str]] = {}
+	for row in rows:
+		media.setdefault(row["good_id"], []).append(row["path"])
+	return media
+
+
+GOOD_STATUSES = ("available", "sold", "removed")
+
+
+def _goods_filter(labels: Optional[List[int]], match_all: bool, is_task: Optional[bool], status: Optional[str]):
+	"""商品列表与分面统计共用的 WHERE 条件，返回 (SQL 片段, 参数)"""
+	clauses, params = [], []
+	if status is not None:
+		if status not in GOOD_STATUSES:
+			raise ValueError(f"invalid good status: {status}")
+		clauses.append("g.status = ?")
+		params.append(status)
+	if is_task is not None:
+		clauses.append("g.type = ?")
+		params.append(1 if is_task else 0)
+	if labels:
+		labels = list(set(labels))
+		placeholders = _placeholders(len(labels))
+		if match_all and len(labels) > 1:
+			# 同时带有全部标签：按商品分组，命中的标签数等于要求的标签数
+			clauses.append(
+				f"g.id IN (SELECT good_id FROM goods_labels WHERE label_id IN ({placeholders}) "
+				"GROUP BY good_id HAVING COUNT(*) = ?)"
+			)
+			params.extend(labels)
+			params.append(len(labels))
+		else:
+			clauses.append(f"g.id IN (SELECT good_id FROM goods_labels WHERE label_id IN ({placeholders}))")
+			params.extend(labels)
+	return (" AND ".join(clauses) or "1"), params
+
+
+_SQL_LIST_GOODS = "SELECT g.* FROM goods g WHERE {where} ORDER BY g.id DESC LIMIT ?"
+_SQL_COUNT_GOODS_BY_LABEL = """
+	SELECT gl.label_id, COUNT(*) AS count FROM goods_labels gl
+	JOIN goods g ON g.id = gl.good_id
+	WHERE {where}
+	GROUP BY gl.label_id
+	ORDER BY count DESC, gl.label_id
+"""
+
+
+def list_goods(labels: Optional[List[int]] = None, match_all: bool = False, is_task: Optional[bool] = None,
+		status: Optional[str] = "available", before_id: Optional[int] = None, limit: int = 20) -> List[Dict]:
+	"""
+	按标签（任一 / 全部）、类型与状态筛选商品，按 id 倒序（最新在前）。
+	before_id: 取该 id 之前的一页（上一页最后一个商品的 id）
+	"""
+	where, params = _goods_filter(labels, match_all, is_task, status)
+	if before_id is not None:
+		where += " AND g.id < ?"
+		params.append(before_id)
+	with _connection() as conn:
+		rows = conn.execute(_SQL_LIST_GOODS.format(where=where), (*params, limit)).fetchall()
 	results = []
 	for row in rows:
 		data = _row_to_dict(row)
-		if data is not None:
-			if "labels" in data:
-				data["labels"] = _deserialize_labels(data.get("labels"))
-			results.append(data)
+		data["labels"] = _deserialize_labels(data.get("labels"))
+		results.append(data)
+	return results
+
+
+def count_goods_by_label(labels: Optional[List[int]] = None, match_all: bool = False, is_task: Optional[bool] = None,
+		status: Optional[str] = "available") -> List[Dict]:
+	"""在与 list_goods 相同的筛选条件下，统计每个标签下的商品数（分面计数），按数量降序"""
+	where, params = _goods_filter(labels, match_all, is_task, status)
+	with _connection() as conn:
+		rows = conn.execute(_SQL_COUNT_GOODS_BY_LABEL.format(where=where), params).fetchall()
+	return [_row_to_dict(row) for row in rows]
+
+
+# 搜索结果高亮标记。用控制字符而不是 HTML 标签，由调用方转义正文后再替换成需要的标记
+SEARCH_MARK_START = "\x02"
+SEARCH_MARK_END = "\x03"
+# trigram 分词下，少于 3 个字符的词无法走 goods_fts；两个字的词改走 goods_bigram
+_FTS_MIN_TERM = 3
+
+
+def _fts_phrase(term: str) -> str:
+	return '"' + term.replace('"', '""') + '"'
+
+
+def _escape_like(term: str) -> str:
+	return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _is_bigram_term(term: str) -> bool:
+	"""能否用 goods_bigram 查询：恰好两个字母/数字/汉字（与 _search_bigrams 的切分一致）"""
+	return len(term) == 2 and term.isalnum()
+
+
+def _mark_terms(text: Optional[str], terms: List[str]) -> Optional[str]:
+	"""给 text 中出现的 terms 加上高亮标记（用于不走 goods_fts 的短词）"""
+	if not text:
+		return text
+	for term in terms:
+		text = re.sub(re.escape(term), lambda m: SEARCH_MARK_START + m.group(0) + SEARCH_MARK_END, text, flags=re.IGNORECASE)
+	return text
+
+
+# 全文搜索：{table} 为 goods_fts 或 goods_bigram，{where} 为 _goods_filter 等拼出的条件
+_SQL_SEARCH_MATCHED = "FROM {table} CROSS JOIN goods g ON g.id = {table}.rowid WHERE {table} MATCH ? AND {where}"
+_SQL_SEARCH_BY_RANK = "ORDER BY bm25({table}, 10.0, 1.0) LIMIT ? OFFSET ?"
+_SQL_SEARCH_BY_RECENCY = "ORDER BY {table}.rowid DESC LIMIT ? OFFSET ?"
+_SQL_SEARCH_BOUNDARY = "SELECT rowid FROM {table} WHERE {table} MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?"
+_SQL_SEARCH_HIGHLIGHT = """
+	SELECT g.*,
+		highlight(goods_fts, 0, ?, ?) AS name_highlight,
+		snippet(goods_fts, 1, ?, ?, '…', 24) AS snippet
+	FROM goods_fts CROSS JOIN goods g ON g.id = goods_fts.rowid
+	WHERE goods_fts MATCH ? AND goods_fts.rowid IN ({ids})
+"""
+_SQL_SEARCH_PLAIN = "SELECT g.*, g.name AS name_highlight, g.description AS snippet FROM goods g WHERE g.id IN ({ids})"
+_SQL_SEARCH_LIKE = (
+	"SELECT g.*, g.name AS name_highlight, g.description AS snippet FROM goods g "
+	"WHERE {where} ORDER BY g.id DESC LIMIT ? OFFSET ?"
+)
+_SQL_SEARCH_BIGRAM_FILTER = "g.id IN (SELECT rowid FROM goods_bigram WHERE goods_bigram MATCH ?)"
+
+
+def _search_fts(conn: sqlite3.Connection, table: str, match: str, where: str, params: List, offset: int, limit: int) -> List[int]:
+	"""
+	在全文索引 table（goods_fts 或 goods_bigram）上查询本页商品 id。
+	BM25 需要为每个匹配文档计算得分，常见词在百万级数据上可能匹配数万条。
+	因此只对最新的 DB_SEARCH_RANK_WINDOW 条匹配按相关度排序，排在前面；
+	更早的匹配接在后面按发布时间倒序，翻页结果不重复、不遗漏。
+	CROSS JOIN 固定以全文索引为外层循环，避免规划器改为逐行扫描 goods 再匹配。
+	"""
+	matched = _SQL_SEARCH_MATCHED.format(table=table, where=where)
+	by_rank = _SQL_SEARCH_BY_RANK.format(table=table)
+	boundary = conn.execute(
+		_SQL_SEARCH_BOUNDARY.format(table=table), (match, DB_SEARCH_RANK_WINDOW - 1)
+	).fetchone()
+	if boundary is None:
+		# 匹配数不超过窗口，全部按相关度排序
+		return [row[0] for row in conn.execute(f"SELECT g.id {matched} {by_rank}", (match, *params, limit, offset))]
+	boundary = boundary[0]
+	ids = [row[0] for row in conn.execute(
+		f"SELECT g.id {matched} AND {table}.rowid >= ? {by_rank}", (match, *params, boundary, limit, offset)
+	)]
+	if len(ids) < limit:
+		ranked = conn.execute(
+			f"SELECT COUNT(*) {matched} AND {table}.rowid >= ?", (match, *params, boundary)
+		).fetchone()[0]
+		ids += [row[0] for row in conn.execute(
+			f"SELECT g.id {matched} AND {table}.rowid < ? {_SQL_SEARCH_BY_RECENCY.format(table=table)}",
+			(match, *params, boundary, limit - len(ids), max(0, offset - ranked)),
+		)]
+	return ids
+
+
+def optimize_search_index() -> None:
+	"""把全文索引的各段合并成一段。日常写入由 FTS5 自动合并，批量导入大量商品后调用一次可明显加快查询"""
+	def _optimize(conn):
+		conn.execute("INSERT INTO goods_fts (goods_fts) VALUES ('optimize')")
+		conn.execute("INSERT INTO goods_bigram (goods_bigram) VALUES ('optimize')")
+
+	_write(_optimize)
+
+
+def search_goods(query: str, labels: Optional[List[int]] = None, min_price: Optional[float] = None,
+		max_price: Optional[float] = None, is_task: Optional[bool] = None,
+		offset: int = 0, limit: int = 20) -> List[Dict]:
+	"""
+	全文搜索在售商品，按 BM25 相关度排序（名称命中的权重高于描述）。
+	query 按空白切分成词，所有词都要出现。长度不少于 3 的词走 FTS5 trigram 索引（goods_fts），
+	两个字的词（大部分中文词）走二元组索引（goods_bigram）；有长词时以 goods_fts 排序、goods_bigram 过滤。
+	剩下的单字或带标点的两字词用 LIKE 在候选结果上过滤；全部是这类词时按发布时间倒序扫描在售商品。
+	匹配很多时只有最新的 DB_SEARCH_RANK_WINDOW 条参与相关度排序（见 _search_fts）。
+	每个结果附带 name_highlight 与 snippet（描述摘要），命中处用 SEARCH_MARK_START/END 包围。
+	"""
+	terms = [t for t in query.split() if t]
+	if not terms:
+		return []
+	long_terms = [t for t in terms if len(t) >= _FTS_MIN_TERM]
+	bigram_terms = [t for t in terms if _is_bigram_term(t)]
+	like_terms = [t for t in terms if len(t) < _FTS_MIN_TERM and not _is_bigram_term(t)]
+	short_terms = bigram_terms + like_terms
+
+	where, params = _goods_filter(labels, False, is_task, "available")
+	if min_price is not None:
+		where += " AND g.value >= ?"
+		params.append(min_price)
+	if max_price is not None:
+		where += " AND g.value <= ?"
+		params.append(max_price)
+	for term in like_terms:
+		where += " AND (g.name LIKE ? ESCAPE '\\' OR g.description LIKE ? ESCAPE '\\')"
+		pattern = f"%{_escape_like(term)}%"
+		params.extend((pattern, pattern))
+	bigram_match = " ".join(_fts_phrase(t.lower()) for t in bigram_terms)
+
+	with _connection() as conn:
+		if long_terms:
+			if bigram_terms:
+				where += " AND " + _SQL_SEARCH_BIGRAM_FILTER
+				params.append(bigram_match)
+			match = " ".join(_fts_phrase(t) for t in long_terms)
+			ids = _search_fts(conn, "goods_fts", match, where, params, offset, limit)
+			# 高亮与摘要只为本页生成
+			rows = conn.execute(
+				_SQL_SEARCH_HIGHLIGHT.format(ids=_placeholders(len(ids))),
+				(SEARCH_MARK_START, SEARCH_MARK_END, SEARCH_MARK_START, SEARCH_MARK_END, match, *ids),
+			).fetchall() if ids else []
+		elif bigram_terms:
+			# goods_bigram 不存正文，无法生成 highlight/snippet，由下面的 _mark_terms 补上标记
+			ids = _search_fts(conn, "goods_bigram", bigram_match, where, params, offset, limit)
+			rows = conn.execute(
+				_SQL_SEARCH_PLAIN.format(ids=_placeholders(len(ids))), ids
+			).fetchall() if ids else []
+		else:
+			rows = conn.execute(_SQL_SEARCH_LIKE.format(where=where), (*params, limit, offset)).fetchall()
+			ids = [row["id"] for row in rows]
+
+	by_id = {row["id"]: row for row in rows}
+	results = []
+	for good_id in ids:
+		if good_id not in by_id:
+			continue
+		data = _row_to_dict(by_id[good_id])
+		data["labels"] = _deserialize_labels(data.get("labels"))
+		# goods_fts 的高亮只覆盖长词，短词在这里补上标记
+		data["name_highlight"] = _mark_terms(data["name_highlight"], short_terms)
+		data["snippet"] = _mark_terms(data["snippet"], short_terms)
+		results.append(data)
 	return results
 
 
 def update_good_status(good_id: int, status: str) -> bool:
-	ALLOWED = ("available", "sold", "removed")
-	if status not in ALLOWED:
+	if status not in GOOD_STATUSES:
 		raise ValueError(f"invalid good status: {status}")
-	conn = _get_conn()
-	cur = conn.cursor()
-	cur.execute("UPDATE goods SET status = ? WHERE id = ?", (status, good_id))
-	conn.commit()
-	updated = cur.rowcount
-	conn.close()
-	return updated > 0
+
+	def _update(conn):
+		if conn.execute("UPDATE goods SET status = ? WHERE id = ?", (status, good_id)).rowcount == 0:
+			return None
+		_index_good_bigrams(conn, good_id)
+		return conn.execute("SELECT type FROM goods WHERE id = ?", (good_id,)).fetchone()
+
+	row = _write(_update)
+	if row is None:
+		return False
+	if status == "available":
+		_available_goods.add(good_id, row["type"])
+	else:
+		_available_goods.discard(good_id)
+	return True
 
 def create_order(buyer_id: int, goods_id: int, num: int, status: str = "pending") -> Optional[Dict]:
 	"""Create an order. Returns the created order dict.
 	Note: this function does not perform inventory checks or transactions —
 	consider wrapping higher-level business logic to ensure consistency."""
-	conn = _get_conn()
-	cur = conn.cursor()
-	cur.execute(
-		"INSERT INTO orders (goods_id, num, buyer_id, status) VALUES (?, ?, ?, ?)",
-		(goods_id, num, buyer_id, status),
-	)
-	conn.commit()
-	order_id = cur.lastrowid
-	row = conn.execute("SELECT * FROM orders WHERE id = ?", (order_id,)).fetchone()
-	conn.close()
-	return _row_to_dict(row)
+	def _insert(conn):
+		cur = conn.execute(
+			"INSERT INTO orders (goods_id, num, buyer_id, status) VALUES (?, ?, ?, ?)",
+			(goods_id, num, buyer_id, status),
+		)
+		return conn.execute("SELECT * FROM orders WHERE id = ?", (cur.lastrowid,)).fetchone()
+
+	return _row_to_dict(_write(_insert))
 	
 def get_order(order_id: int) -> Optional[Dict]:
-	conn = _get_conn()
-	row = conn.execute("SELECT * FROM orders WHERE id = ?", (order_id,)).fetchone()
-	conn.close()
+	with _connection() as conn:
+		row = conn.execute("SELECT * FROM orders WHERE id = ?", (order_id,)).fetchone()
 	data = _row_to_dict(row)
 	return data
 
 
+_SQL_ORDERS_BY_BUYER = "SELECT * FROM orders WHERE buyer_id = ?"
+_SQL_ORDERS_BY_GOOD = "SELECT * FROM orders WHERE goods_id = ?"
+_SQL_ORDERS_BY_BUYER_WITH_GOODS = """
+	SELECT o.*, g.id AS good_found, g.name AS good_name, g.value AS good_value, g.description AS good_description
+	FROM orders o LEFT JOIN goods g ON g.id = o.goods_id
+	WHERE o.buyer_id = ?
+"""
+_SQL_ORDERS_BY_GOOD_WITH_BUYERS = """
+	SELECT o.*, u.id AS buyer_found, u.name AS buyer_name, u.email AS buyer_email
+	FROM orders o LEFT JOIN users u ON u.id = o.buyer_id
+	WHERE o.goods_id = ?
+"""
+
+
 def get_orders_by_buyer(buyer_id: int) -> List[Dict]:
-	conn = _get_conn()
-	rows = conn.execute("SELECT * FROM orders WHERE buyer_id = ?", (buyer_id,)).fetchall()
-	conn.close()
+	with _connection() as conn:
+		rows = conn.execute(_SQL_ORDERS_BY_BUYER, (buyer_id,)).fetchall()
 	return [_row_to_dict(row) for row in rows]
 
 
 def get_orders_by_good(goods_id: int) -> List[Dict]:
-	conn = _get_conn()
-	rows = conn.execute("SELECT * FROM orders WHERE goods_id = ?", (goods_id,)).fetchall()
-	conn.close()
+	with _connection() as conn:
+		rows = conn.execute(_SQL_ORDERS_BY_GOOD, (goods_id,)).fetchall()
 	return [_row_to_dict(row) for row in rows]
 
 
+def get_orders_by_buyer_with_goods(buyer_id: int) -> List[Dict]:
+	"""买家的订单，附带商品名称/价格/描述（一次 JOIN，不再逐单查询商品）"""
+	with _connection() as conn:
+		rows = conn.execute(_SQL_ORDERS_BY_BUYER_WITH_GOODS, (buyer_id,)).fetchall()
+	return [_pop_missing_join(_row_to_dict(row), "good_found", ("good_name", "good_value", "good_description")) for row in rows]
+
+
+def get_orders_by_good_with_buyers(goods_id: int) -> List[Dict]:
+	"""商品的订单，附带买家名称/邮箱（一次 JOIN，不再逐单查询用户）"""
+	with _connection() as conn:
+		rows = conn.execute(_SQL_ORDERS_BY_GOOD_WITH_BUYERS, (goods_id,)).fetchall()
+	return [_pop_missing_join(_row_to_dict(row), "buyer_found", ("buyer_name", "buyer_email")) for row in rows]
+
+
+def _pop_missing_join(data: Dict, found_key: str, fields) -> Dict:
+	"""LEFT JOIN 没有匹配到关联行时去掉关联字段，与逐条补充时的返回结构保持一致"""
+	if data.pop(found_key) is None:
+		for field in fields:
+			data.pop(field, None)
+	return data
+
+
 def update_order_status(order_id: int, status: str) -> bool:
 	ALLOWED = ("pending", "processing", "completed", "cancelled")
 	if status not in ALLOWED:
 		raise ValueError(f"invalid order status: {status}")
-	conn = _get_conn()
-	cur = conn.cursor()
-	cur.execute("UPDATE orders SET status = ? WHERE id = ?", (status, order_id))
-	conn.commit()
-	updated = cur.rowcount
-	conn.close()
+	updated = _write(lambda conn: conn.execute("UPDATE orders SET status = ? WHERE id = ?", (status, order_id)).rowcount)
 	return updated > 0
 
 
+_SQL_USER_BY_CONFIRMATION_TOKEN = "SELECT * FROM users WHERE confirmation_token = ?"
+
+
 def get_user_by_confirmation_token(token: str) -> Optional[Dict]:
-	conn = _get_conn()
-	row = conn.execute("SELECT * FROM users WHERE confirmation_token = ?", (token,)).fetchone()
-	conn.close()
+	with _connection() as conn:
+		row = conn.execute(_SQL_USER_BY_CONFIRMATION_TOKEN, (token,)).fetchone()
 	return _row_to_dict(row)
 
 def update_user_verified(user_id: int, verified: bool = True) -> bool:
-	conn = _get_conn()
-	cur = conn.cursor()
-	cur.execute("UPDATE users SET verified = ?, confirmation_token = NULL WHERE id = ?", (verified, user_id))
-	conn.commit()
-	updated = cur.rowcount
-	conn.close()
+	updated = _write(lambda conn: conn.execute(
+		"UPDATE users SET verified = ?, confirmation_token = NULL WHERE id = ?", (verified, user_id)
+	).rowcount)
+	_session_cache.invalidate_user(user_id)
+	return updated > 0
+
+def update_password_hash(user_id: int, pswd_hash: str) -> bool:
+	"""替换密码哈希（登录时按新的工作因子重新哈希）"""
+	updated = _write(lambda conn: conn.execute(
+		"UPDATE users SET pswd_hash = ? WHERE id = ?", (pswd_hash, user_id)
+	).rowcount)
+	_session_cache.invalidate_user(user_id)
 	return updated > 0
 
+def set_user_avatar(user_id: int, path: str) -> Optional[str]:
+	"""记录用户头像路径（相对 media 目录），返回被替换的旧路径"""
+	def replace(conn: sqlite3.Connection) -> Optional[str]:
+		row = conn.execute("SELECT avatar FROM users WHERE id = ?", (user_id,)).fetchone()
+		conn.execute("UPDATE users SET avatar = ? WHERE id = ?", (path, user_id))
+		return row["avatar"] if row else None
+
+	old = _write(replace)
+	_session_cache.invalidate_user(user_id)
+	return old
+
 def update_user_preferences(user_id: int, labels: List[int]) -> bool:
-	# Validate that all labels are allowed to be preferred
-	all_labels = get_all_labels()
-	allowed_ids = {l['id'] for l in all_labels if l.get('prefered', False)}
-	
-	if not set(labels).issubset(allowed_ids):
+	# Validate that all labels can be subscribed to
+	if not get_subscribable_label_ids().issuperset(labels):
 		raise ValueError("包含不可订阅的标签")
 
-	conn = _get_conn()
-	cur = conn.cursor()
 	labels_json = _serialize_labels(labels)
-	cur.execute("UPDATE users SET prefer = ? WHERE id = ?", (labels_json, user_id))
-	conn.commit()
-	updated = cur.rowcount
-	conn.close()
+
+	def _update(conn):
+		updated = conn.execute("UPDATE users SET prefer = ? WHERE id = ?", (labels_json, user_id)).rowcount
+		if updated:
+			# users.prefer 与 user_preferences 在同一事务内更新，保持一致
+			conn.execute("DELETE FROM user_preferences WHERE user_id = ?", (user_id,))
+			conn.executemany(
+				"INSERT OR IGNORE INTO user_preferences (user_id, label_id) VALUES (?, ?)",
+				[(user_id, label_id) for label_id in labels],
+			)
+		return updated
+
+	updated = _write(_update)
+	_session_cache.invalidate_user(user_id)
 	return updated > 0
 
+_SQL_USERS_INTERESTED_IN = """
+	SELECT u.id, u.name, u.email FROM users u
+	WHERE u.id IN (SELECT user_id FROM user_preferences WHERE label_id IN ({labels}))
+		AND u.verified = 1
+"""
+
+
 def get_users_interested_in(tag_ids: List[int]) -> List[Dict]:
 	"""
-	Find users who have any of the given tag_ids in their preferences.
-	Returns a list of user dicts.
+	Find verified users who have any of the given tag_ids in their preferences.
+	Returns a list of {id, name, email} dicts (only what the notification mail needs).
 	"""
 	if not tag_ids:
 		return []
-	
-	conn = _get_conn()
-	# Get all users with non-empty preferences who are verified
-	rows = conn.execute("SELECT * FROM users WHERE prefer != '[]' AND verified = 1").fetchall()
-	conn.close()
-	
-	interested_users = []
-	target_set = set(tag_ids)
-	
-	for row in rows:
-		try:
-			user_prefs_str = row['prefer']
-			user_prefs = set(_deserialize_labels(user_prefs_str))
-			# If intersection is not empty, user is interested
-			if not user_prefs.isdisjoint(target_set):
-				interested_users.append(_row_to_dict(row))
-		except Exception:
-			continue
-			
-	return interested_users
+
+	tag_ids = list(set(tag_ids))
+	# 通过 user_preferences(label_id) 索引取出订阅者，再按主键回表，不扫描 users
+	with _connection() as conn:
+		rows = conn.execute(
+			_SQL_USERS_INTERESTED_IN.format(labels=_placeholders(len(tag_ids))), tag_ids
+		).fetchall()
+	return [_row_to_dict(row) for row in rows]
 
 
 def create_message(sender_id: int, receiver_id: int, text: str) -> Optional[Dict]:
@@ -347,137 +1466,645 @@ def create_message(sender_id: int, receiver_id: int, text: str) -> Optional[Dict
 	if sender_id == receiver_id:
 		raise ValueError("不能给自己发送消息")
 	
-	conn = _get_conn()
-	cur = conn.cursor()
-	cur.execute(
-		"INSERT INTO messages (sender_id, receiver_id, text) VALUES (?, ?, ?)",
-		(sender_id, receiver_id, text.strip())
+	def _insert(conn):
+		cur = conn.execute(
+			"INSERT INTO messages (sender_id, receiver_id, text) VALUES (?, ?, ?)",
+			(sender_id, receiver_id, text.strip())
+		)
+		message_id = cur.lastrowid
+		# 同一事务内更新双方的对话摘要：发送方不计未读，接收方未读 +1
+		conn.execute(
+			"""
+			INSERT INTO conversations (user_id, peer_id, last_message_id, unread_count) VALUES (?, ?, ?, 0)
+			ON CONFLICT(user_id, peer_id) DO UPDATE SET last_message_id = excluded.last_message_id
+			""",
+			(sender_id, receiver_id, message_id)
+		)
+		conn.execute(
+			"""
+			INSERT INTO conversations (user_id, peer_id, last_message_id, unread_count) VALUES (?, ?, ?, 1)
+			ON CONFLICT(user_id, peer_id) DO UPDATE SET
+				last_message_id = excluded.last_message_id,
+				unread_count = unread_count + 1
+			""",
+			(receiver_id, sender_id, message_id)
+		)
+		return conn.execute("SELECT * FROM messages WHERE id = ?", (message_id,)).fetchone()
+
+	message = _row_to_dict(_write(_insert))
+	# 提交成功后推送给双方（发送方可能在其他标签页/设备上在线）
+	pubsub = broker.get_broker()
+	pubsub.publish(broker.user_channel(receiver_id), message)
+	pubsub.publish(broker.user_channel(sender_id), message)
+	return message
+
+
+# {cond} 为 id 的范围条件，{order} 为 ASC / DESC
+_SQL_MESSAGES_BETWEEN = """
+	SELECT * FROM (
+		SELECT * FROM messages WHERE sender_id = ? AND receiver_id = ? AND {cond}
+		ORDER BY id {order} LIMIT ?
 	)
-	conn.commit()
-	message_id = cur.lastrowid
-	row = conn.execute("SELECT * FROM messages WHERE id = ?", (message_id,)).fetchone()
-	conn.close()
-	return _row_to_dict(row)
+	UNION ALL
+	SELECT * FROM (
+		SELECT * FROM messages WHERE sender_id = ? AND receiver_id = ? AND {cond}
+		ORDER BY id {order} LIMIT ?
+	)
+	ORDER BY id {order} LIMIT ?
+"""
 
 
-def get_messages_between(user_id1: int, user_id2: int) -> List[Dict]:
-	"""获取两个用户之间的所有消息"""
-	conn = _get_conn()
-	rows = conn.execute(
-		"""
-		SELECT * FROM messages 
-		WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
-		ORDER BY created_at ASC
-		""",
-		(user_id1, user_id2, user_id2, user_id1)
-	).fetchall()
-	conn.close()
-	return [_row_to_dict(row) for row in rows]
+def get_messages_between(user_id1: int, user_id2: int, before_id: Optional[int] = None, after_id: Optional[int] = None, limit: Optional[int] = None) -> List[Dict]:
+	"""
+	获取两个用户之间的消息，按 id 升序返回。
+	- 只给 limit：最新的 limit 条
+	- before_id：id 小于它的最新 limit 条（向上翻页）
+	- after_id：id 大于它的最早 limit 条（增量拉取新消息）
+	- 都不给：全部历史
+	两个方向各走一次 (sender_id, receiver_id, id) 索引的范围扫描，LIMIT 可以下推到每一边。
+	"""
+	if before_id is not None and after_id is not None:
+		raise ValueError("before_id 与 after_id 不能同时指定")
+	sql_limit = -1 if limit is None else limit
+	if after_id is not None:
+		cond, order, bound = "id > ?", "ASC", after_id
+	elif before_id is not None:
+		cond, order, bound = "id < ?", "DESC", before_id
+	else:
+		cond, order, bound = "id > ?", "DESC", 0
+	with _connection() as conn:
+		rows = conn.execute(
+			_SQL_MESSAGES_BETWEEN.format(cond=cond, order=order),
+			(user_id1, user_id2, bound, sql_limit, user_id2, user_id1, bound, sql_limit, sql_limit)
+		).fetchall()
+	messages = [_row_to_dict(row) for row in rows]
+	if order == "DESC":
+		messages.reverse()
+	return messages
+
+
+_SQL_CONVERSATIONS = """
+	SELECT c.unread_count,
+		u.id AS user_id, u.name AS user_name, u.email AS user_email, u.prefer AS user_prefer,
+		u.verified AS user_verified, u.avatar AS user_avatar, u.created_at AS user_created_at,
+		m.id AS message_id, m.sender_id, m.receiver_id, m.text, m.created_at
+	FROM conversations c
+	JOIN users u ON u.id = c.peer_id
+	JOIN messages m ON m.id = c.last_message_id
+	WHERE c.user_id = ?
+	ORDER BY c.last_message_id DESC
+"""
+
+
+def get_conversations(user_id: int) -> List[Dict]:
+	"""
+	当前用户的对话列表，按最后一条消息从新到旧排列。
+	每项包含对方的公开资料 `user`、最后一条消息 `last_message` 和未读数 `unread_count`，
+	一次查询完成，开销与对话数成正比，与消息总数无关。
+	"""
+	with _connection() as conn:
+		rows = conn.execute(_SQL_CONVERSATIONS, (user_id,)).fetchall()
+	return [
+		{
+			"user": {
+				"id": row["user_id"],
+				"name": row["user_name"],
+				"email": row["user_email"],
+				"prefer": _deserialize_labels(row["user_prefer"]),
+				"verified": row["user_verified"],
+				"avatar": row["user_avatar"],
+				"created_at": row["user_created_at"],
+			},
+			"last_message": {
+				"id": row["message_id"],
+				"sender_id": row["sender_id"],
+				"receiver_id": row["receiver_id"],
+				"text": row["text"],
+				"created_at": row["created_at"],
+			},
+			"unread_count": row["unread_count"],
+		}
+		for row in rows
+	]
+
+
+_SQL_CONVERSATION_UNREAD = "SELECT unread_count FROM conversations WHERE user_id = ? AND peer_id = ?"
+
+
+def mark_conversation_read(user_id: int, peer_id: int) -> bool:
+	"""把与 peer_id 的对话标记为已读。没有未读时不产生写操作。"""
+	with _connection() as conn:
+		row = conn.execute(_SQL_CONVERSATION_UNREAD, (user_id, peer_id)).fetchone()
+	if row is None or row["unread_count"] == 0:
+		return False
+	_write(lambda conn: conn.execute(
+		"UPDATE conversations SET unread_count = 0 WHERE user_id = ? AND peer_id = ?",
+		(user_id, peer_id)
+	))
+	return True
 
 
 def get_latest_messages(user_id: int) -> List[Dict]:
 	"""获取当前用户最新对话列表（每个对话方只取最后一条消息）"""
-	conn = _get_conn()
-	# 获取与该用户有过沟通的所有用户ID及其最后一条消息
-	rows = conn.execute(
-		"""
-		SELECT DISTINCT 
-			CASE 
-				WHEN sender_id = ? THEN receiver_id
-				ELSE sender_id
-			END as other_user_id,
-			(SELECT * FROM messages m2 WHERE 
-				(m2.sender_id = m.sender_id AND m2.receiver_id = m.receiver_id) OR
-				(m2.sender_id = m.receiver_id AND m2.receiver_id = m.sender_id)
-			ORDER BY m2.created_at DESC LIMIT 1) as last_msg
-		FROM messages m
-		WHERE sender_id = ? OR receiver_id = ?
-		ORDER BY created_at DESC
-		""",
-		(user_id, user_id, user_id)
-	).fetchall()
-	conn.close()
-	return [_row_to_dict(row) for row in rows if row is not None]
+	return [
+		{"other_user_id": conv["user"]["id"], "last_msg": conv["last_message"]}
+		for conv in get_conversations(user_id)
+	]
+
+
+def enqueue_mails(mails: List[Dict]) -> List[int]:
+	"""
+	把邮件写入发送队列（一个事务），返回队列 ID。
+	每项需包含 to_email, subject, content，可选 html, to_name。
+	"""
+	now = time.time()
+
+	def _insert(conn):
+		ids = []
+		for mail in mails:
+			cur = conn.execute(
+				"INSERT INTO mail_queue (to_email, to_name, subject, content, html, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?)",
+				(mail["to_email"], mail.get("to_name"), mail["subject"], mail["content"], mail.get("html"), now)
+			)
+			ids.append(cur.lastrowid)
+		return ids
+
+	return _write(_insert)
+
+
+_SQL_DUE_MAIL = "SELECT * FROM mail_queue WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?"
+
+
+def claim_due_mail(limit: int = 1) -> List[Dict]:
+	"""取出最多 limit 封到期待发的邮件并标记为 sending。没有到期邮件时不产生写操作。"""
+	now = time.time()
+	with _connection() as conn:
+		due = conn.execute(_SQL_DUE_MAIL, (now, 1)).fetchone()
+	if due is None:
+		return []
+
+	def _claim(conn):
+		rows = conn.execute(_SQL_DUE_MAIL, (now, limit)).fetchall()
+		conn.executemany(
+			"UPDATE mail_queue SET status = 'sending', attempts = attempts + 1, claimed_at = ? WHERE id = ?",
+			[(now, row["id"]) for row in rows]
+		)
+		return rows
+
+	claimed = []
+	for row in _write(_claim):
+		data = _row_to_dict(row)
+		data["attempts"] += 1
+		claimed.append(data)
+	return claimed
+
+
+def mark_mail_sent(mail_id: int) -> None:
+	_write(lambda conn: conn.execute(
+		"UPDATE mail_queue SET status = 'sent', last_error = NULL, sent_at = CURRENT_TIMESTAMP WHERE id = ?", (mail_id,)
+	))
+
+
+def mark_mail_failed(mail_id: int, error: str, retry_at: Optional[float]) -> None:
+	"""发送失败：retry_at 为下次重试的时间戳；为 None 时进入死信（status = 'dead'）"""
+	if retry_at is None:
+		_write(lambda conn: conn.execute(
+			"UPDATE mail_queue SET status = 'dead', last_error = ? WHERE id = ?", (error, mail_id)
+		))
+	else:
+		_write(lambda conn: conn.execute(
+			"UPDATE mail_queue SET status = 'pending', last_error = ?, next_attempt_at = ? WHERE id = ?",
+			(error, retry_at, mail_id)
+		))
+
+
+def requeue_interrupted_mail(lease_seconds: float) -> int:
+	"""
+	把取出超过 lease_seconds 秒仍处于 sending 的邮件放回队列（发送它的进程已退出），返回数量。
+	租约内的邮件可能正由其他进程发送，不能动。没有超时的邮件时不产生写操作。
+	"""
+	expired = time.time() - lease_seconds
+	stale = "status = 'sending' AND (claimed_at IS NULL OR claimed_at < ?)"
+	with _connection() as conn:
+		if conn.execute(f"SELECT 1 FROM mail_queue WHERE {stale} LIMIT 1", (expired,)).fetchone() is None:
+			return 0
+	return _write(lambda conn: conn.execute(
+		f"UPDATE mail_queue SET status = 'pending', claimed_at = NULL WHERE {stale}", (expired,)
+	).rowcount)
+
+
+_SQL_PURGE_SENT_MAIL = (
+	"DELETE FROM mail_queue WHERE id IN "
+	"(SELECT id FROM mail_queue WHERE status = 'sent' AND sent_at < ? LIMIT ?)"
+)
+
+
+def purge_sent_mail(older_than_seconds: float, batch_size: int = 1000) -> int:
+	"""分批删除发送成功超过 older_than_seconds 秒的邮件（每批一个短事务），返回删除数量"""
+	cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - older_than_seconds))
+	deleted = 0
+	while True:
+		count = _write(lambda conn: conn.execute(_SQL_PURGE_SENT_MAIL, (cutoff, batch_size)).rowcount)
+		deleted += count
+		if count < batch_size:
+			return deleted
+
+
+def get_mail_queue_counts() -> Dict[str, int]:
+	"""发送队列中各状态的邮件数"""
+	with _connection() as conn:
+		rows = conn.execute("SELECT status, COUNT(*) AS n FROM mail_queue GROUP BY status").fetchall()
+	return {row["status"]: row["n"] for row in rows}
 
 
 def create_session(user_id: int, expires_hours: int = 24) -> str:
 	"""创建session，返回session_token"""
 	import secrets
-	from datetime import datetime, timedelta
 	
 	session_token = secrets.token_urlsafe(32)
-	expires_at = (datetime.now() + timedelta(hours=expires_hours)).isoformat()
+	now = int(time.time())
+	lifetime = expires_hours * 3600
 	
-	conn = _get_conn()
-	cur = conn.cursor()
-	cur.execute(
-		"INSERT INTO sessions (session_token, user_id, expires_at) VALUES (?, ?, ?)",
-		(session_token, user_id, expires_at)
-	)
-	conn.commit()
-	conn.close()
+	_write(lambda conn: conn.execute(
+		"INSERT INTO sessions (session_token, user_id, created_at, expires_at, lifetime) VALUES (?, ?, ?, ?, ?)",
+		(session_token, user_id, now, now + lifetime, lifetime)
+	))
 	return session_token
 
 
-def get_user_by_session(session_token: str) -> Optional[Dict]:
-	"""通过session_token获取用户，检查是否过期"""
-	from datetime import datetime
-	
-	conn = _get_conn()
-	row = conn.execute(
-		"SELECT * FROM sessions WHERE session_token = ?",
-		(session_token,)
-	).fetchone()
-	
-	if row is None:
-		conn.close()
+class _SessionCache:
+	"""
+	session_token -> (用户, 过期时间戳, 有效期秒数) 的进程内 LRU 缓存。
+	- 条目在缓存中最多保留 ttl 秒，且不会超过 session 自身的过期时间
+	- 最多 max_size 条，超出时淘汰最久未使用的条目
+	- 登出与用户资料变更时主动失效（按 token 或按 user_id）
+	"""
+
+	def __init__(self, max_size: int, ttl: float):
+		self.max_size = max_size
+		self.ttl = ttl
+		self._lock = threading.Lock()
+		self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+		self._tokens_by_user: Dict[int, set] = {}
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	@staticmethod
+	def _copy(user: Dict) -> Dict:
+		data = dict(user)
+		if isinstance(data.get("prefer"), list):
+			data["prefer"] = list(data["prefer"])
+		return data
+
+	def get(self, token: str, now: float) -> Optional[Tuple[Dict, int, int]]:
+		"""返回 (用户副本, 过期时间戳, 有效期秒数)"""
+		with self._lock:
+			entry = self._entries.get(token)
+			if entry is not None:
+				user, expires_at, lifetime, cached_at = entry
+				if now < expires_at and time.monotonic() - cached_at < self.ttl:
+					self._entries.move_to_end(token)
+					self.hits += 1
+					return self._copy(user), expires_at, lifetime
+				self._remove(token)
+			self.misses += 1
+			return None
+
+	def put(self, token: str, user: Dict, expires_at: int, lifetime: int) -> None:
+		if self.max_size <= 0:
+			return
+		with self._lock:
+			self._remove(token)
+			self._entries[token] = (self._copy(user), expires_at, lifetime, time.monotonic())
+			self._tokens_by_user.setdefault(user["id"], set()).add(token)
+			while len(self._entries) > self.max_size:
+				oldest = next(iter(self._entries))
+				self._remove(oldest)
+				self.evictions += 1
+
+	def _remove(self, token: str) -> None:
+		entry = self._entries.pop(token, None)
+		if entry is None:
+			return
+		user_id = entry[0]["id"]
+		tokens = self._tokens_by_user.get(user_id)
+		if tokens is not None:
+			tokens.discard(token)
+			if not tokens:
+				del self._tokens_by_user[user_id]
+
+	def extend(self, token: str, expires_at: int) -> None:
+		"""session 顺延后更新缓存中的过期时间"""
+		with self._lock:
+			entry = self._entries.get(token)
+			if entry is not None:
+				self._entries[token] = (entry[0], expires_at, entry[2], entry[3])
+
+	def invalidate_token(self, token: str) -> None:
+		with self._lock:
+			self._remove(token)
+
+	def invalidate_user(self, user_id: int) -> None:
+		with self._lock:
+			for token in list(self._tokens_by_user.get(user_id, ())):
+				self._remove(token)
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+			self._tokens_by_user.clear()
+
+	def stats(self) -> Dict:
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				"size": len(self._entries),
+				"max_size": self.max_size,
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+				"hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+			}
+
+
+# session 缓存容量与单条缓存的最长存活秒数
+DB_SESSION_CACHE_SIZE = int(os.environ.get("DB_SESSION_CACHE_SIZE", 10000))
+DB_SESSION_CACHE_TTL = float(os.environ.get("DB_SESSION_CACHE_TTL", 60))
+_session_cache = _SessionCache(DB_SESSION_CACHE_SIZE, DB_SESSION_CACHE_TTL)
+# 滑动过期：剩余有效期不足一半时把过期时间顺延一个完整有效期，只有这时才写库
+DB_SESSION_SLIDING = os.environ.get("DB_SESSION_SLIDING", "false").lower() in ("1", "true", "yes")
+
+
+class _MissCache:
+	"""
+	最近查不到的登录标识（用户名或邮箱）的进程内缓存，带 TTL 与容量上限（LRU 淘汰）。
+	对同一个不存在的标识反复尝试登录时不再查库；create_user 会移除新账号对应的标识。
+	多进程部署时，其他进程新注册的账号最多 ttl 秒后才能在本进程登录。
+	"""
+
+	def __init__(self, max_size: int, ttl: float):
+		self.max_size = max_size
+		self.ttl = ttl
+		self._lock = threading.Lock()
+		self._entries: "OrderedDict[str, float]" = OrderedDict()
+		self.hits = 0
+
+	def __contains__(self, key: str) -> bool:
+		with self._lock:
+			expires = self._entries.get(key)
+			if expires is None:
+				return False
+			if time.monotonic() >= expires:
+				del self._entries[key]
+				return False
+			self._entries.move_to_end(key)
+			self.hits += 1
+			return True
+
+	def add(self, key: str) -> None:
+		if self.max_size <= 0:
+			return
+		with self._lock:
+			self._entries[key] = time.monotonic() + self.ttl
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+
+	def discard(self, key: str) -> None:
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self) -> Dict:
+		with self._lock:
+			return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits}
+
+
+# 登录时查无此人的标识缓存容量与有效秒数
+DB_LOGIN_MISS_CACHE_SIZE = int(os.environ.get("DB_LOGIN_MISS_CACHE_SIZE", 10000))
+DB_LOGIN_MISS_CACHE_TTL = float(os.environ.get("DB_LOGIN_MISS_CACHE_TTL", 30))
+_login_misses = _MissCache(DB_LOGIN_MISS_CACHE_SIZE, DB_LOGIN_MISS_CACHE_TTL)
+
+
+def get_login_miss_cache_stats() -> Dict:
+	return _login_misses.stats()
+
+
+_SQL_FIND_USER_FOR_LOGIN = """
+	SELECT id, pswd_hash, verified FROM users WHERE name = ?
+	UNION ALL
+	SELECT id, pswd_hash, verified FROM users WHERE email = ?
+	LIMIT 1
+"""
+
+
+def find_user_for_login(identifier: str) -> Optional[Dict]:
+	"""
+	按用户名或邮箱查找登录所需的字段 {id, pswd_hash, verified}，用户名优先。
+	两次唯一索引查找，不扫描 users；不存在的标识在短时间内直接返回 None。
+	"""
+	if identifier in _login_misses:
 		return None
-	
-	session_data = _row_to_dict(row)
-	
-	# 检查是否过期
-	expires_at = datetime.fromisoformat(session_data['expires_at'])
-	if datetime.now() > expires_at:
-		# 删除过期session
-		cur = conn.cursor()
-		cur.execute("DELETE FROM sessions WHERE session_token = ?", (session_token,))
-		conn.commit()
-		conn.close()
+	with _connection() as conn:
+		row = conn.execute(_SQL_FIND_USER_FOR_LOGIN, (identifier, identifier)).fetchone()
+	if row is None:
+		_login_misses.add(identifier)
 		return None
-	
-	# 获取用户信息
-	user_row = conn.execute(
-		"SELECT * FROM users WHERE id = ?",
-		(session_data['user_id'],)
-	).fetchone()
-	conn.close()
-	
-	user_data = _row_to_dict(user_row)
-	if user_data is not None and "prefer" in user_data:
-		user_data["prefer"] = _deserialize_labels(user_data.get("prefer"))
+	return dict(row)
+
+
+def get_session_cache_stats() -> Dict:
+	"""session 缓存的命中/未命中计数"""
+	return _session_cache.stats()
+
+
+_SQL_USER_BY_SESSION = """
+	SELECT s.expires_at AS session_expires_at, s.lifetime AS session_lifetime, u.*
+	FROM sessions s JOIN users u ON u.id = s.user_id
+	WHERE s.session_token = ?
+"""
+
+
+def get_user_by_session(session_token: str) -> Optional[Dict]:
+	"""
+	通过session_token获取用户，检查是否过期。
+	开启滑动过期（DB_SESSION_SLIDING）且本次调用顺延了有效期时，
+	返回的 dict 中带 session_refreshed_until（新的过期时间戳），供调用方刷新 cookie。
+	"""
+	now = time.time()
+	cached = _session_cache.get(session_token, now)
+	if cached is not None:
+		user_data, expires_at, lifetime = cached
+	else:
+		# session 与用户信息一次 JOIN 取回
+		with _connection() as conn:
+			row = conn.execute(_SQL_USER_BY_SESSION, (session_token,)).fetchone()
+
+		if row is None:
+			return None
+
+		user_data = _row_to_dict(row)
+		
+		# 检查是否过期
+		expires_at = user_data.pop('session_expires_at')
+		lifetime = user_data.pop('session_lifetime')
+		if now >= expires_at:
+			# 删除过期session
+			_write(lambda conn: conn.execute("DELETE FROM sessions WHERE session_token = ?", (session_token,)))
+			return None
+		
+		if "prefer" in user_data:
+			user_data["prefer"] = _deserialize_labels(user_data.get("prefer"))
+		_session_cache.put(session_token, user_data, expires_at, lifetime)
+
+	if DB_SESSION_SLIDING and expires_at - now < lifetime / 2:
+		refreshed_until = int(now) + lifetime
+		_write(lambda conn: conn.execute(
+			"UPDATE sessions SET expires_at = ? WHERE session_token = ?", (refreshed_until, session_token)
+		))
+		_session_cache.extend(session_token, refreshed_until)
+		user_data["session_refreshed_until"] = refreshed_until
 	return user_data
 
 
 def delete_session(session_token: str) -> bool:
 	"""删除session（用户登出）"""
-	conn = _get_conn()
-	cur = conn.cursor()
-	cur.execute("DELETE FROM sessions WHERE session_token = ?", (session_token,))
-	conn.commit()
-	deleted = cur.rowcount
-	conn.close()
+	_session_cache.invalidate_token(session_token)
+	deleted = _write(lambda conn: conn.execute("DELETE FROM sessions WHERE session_token = ?", (session_token,)).rowcount)
 	return deleted > 0
 
 
-def cleanup_expired_sessions() -> int:
-	"""清理所有过期的session，返回删除的数量"""
-	from datetime import datetime
-	
-	conn = _get_conn()
-	cur = conn.cursor()
-	now = datetime.now().isoformat()
-	cur.execute("DELETE FROM sessions WHERE expires_at < ?", (now,))
-	conn.commit()
-	deleted = cur.rowcount
-	conn.close()
-	return deleted
+_SQL_DELETE_EXPIRED_SESSIONS = (
+	"DELETE FROM sessions WHERE session_token IN "
+	"(SELECT session_token FROM sessions WHERE expires_at <= ? LIMIT ?)"
+)
+
+
+def cleanup_expired_sessions(batch_size: int = 1000) -> int:
+	"""
+	清理所有过期的session，返回删除的数量。
+	每批最多删除 batch_size 条、各自一个事务（走 expires_at 索引），批与批之间其他写操作可以插队。
+	"""
+	now = int(time.time())
+	total = 0
+	while True:
+		deleted = _write(lambda conn: conn.execute(_SQL_DELETE_EXPIRED_SESSIONS, (now, batch_size)).rowcount)
+		total += deleted
+		if deleted < batch_size:
+			return total
+
+
+def _hot_queries() -> Dict[str, Tuple[str, tuple]]:
+	"""
+	热点查询及示例参数，供 EXPLAIN QUERY PLAN 回归检查使用（tests/test_query_plans.py 与 python db.py）。
+	SQL 直接取自上面函数使用的 _SQL_* 常量，动态条件用与函数相同的 _goods_filter 拼出，函数里的查询改动会被一起检查。
+	"""
+	def goods_where(labels=None, match_all=False, is_task=None, status="available"):
+		return _goods_filter(labels, match_all, is_task, status)
+
+	def search(table, where, params):
+		sql = f"SELECT g.id {_SQL_SEARCH_MATCHED.format(table=table, where=where)} {_SQL_SEARCH_BY_RANK.format(table=table)}"
+		return sql, ('"自行车"' if table == "goods_fts" else '"钢琴"', *params, 20, 0)
+
+	any_where, any_params = goods_where([1, 2], is_task=False)
+	all_where, all_params = goods_where([1, 2], match_all=True)
+	status_where, status_params = goods_where()
+	search_where, search_params = goods_where()
+	search_where += " AND g.value >= ?"
+	search_params.append(0)
+	return {
+		"get_user": (_SQL_GET_USER, (1,)),
+		"get_goods_by_seller": (_SQL_GOODS_BY_SELLER, (1, 0)),
+		"get_good": (_SQL_GET_GOOD, (1,)),
+		"get_random_goods (pool load)": (_SQL_AVAILABLE_GOOD_IDS, (0,)),
+		"get_random_goods": (_SQL_RANDOM_GOODS.format(ids=_placeholders(3)), (1, 2, 3, 0)),
+		"get_orders_by_buyer": (_SQL_ORDERS_BY_BUYER, (1,)),
+		"get_orders_by_good": (_SQL_ORDERS_BY_GOOD, (1,)),
+		"get_orders_by_buyer_with_goods": (_SQL_ORDERS_BY_BUYER_WITH_GOODS, (1,)),
+		"get_orders_by_good_with_buyers": (_SQL_ORDERS_BY_GOOD_WITH_BUYERS, (1,)),
+		"get_user_by_confirmation_token": (_SQL_USER_BY_CONFIRMATION_TOKEN, ("t",)),
+		"find_user_for_login": (_SQL_FIND_USER_FOR_LOGIN, ("n", "n")),
+		"get_messages_between (before_id)": (
+			_SQL_MESSAGES_BETWEEN.format(cond="id < ?", order="DESC"), (1, 2, 100, 50, 2, 1, 100, 50, 50),
+		),
+		"get_messages_between (after_id)": (
+			_SQL_MESSAGES_BETWEEN.format(cond="id > ?", order="ASC"), (1, 2, 100, 50, 2, 1, 100, 50, 50),
+		),
+		"get_conversations": (_SQL_CONVERSATIONS, (1,)),
+		"mark_conversation_read": (_SQL_CONVERSATION_UNREAD, (1, 2)),
+		"claim_due_mail": (_SQL_DUE_MAIL, (0, 1)),
+		"purge_sent_mail": (_SQL_PURGE_SENT_MAIL, ("2024-01-01 00:00:00", 1000)),
+		"get_users_interested_in": (_SQL_USERS_INTERESTED_IN.format(labels=_placeholders(2)), (1, 2)),
+		"list_goods (labels any)": (_SQL_LIST_GOODS.format(where=any_where), (*any_params, 20)),
+		"list_goods (labels all)": (_SQL_LIST_GOODS.format(where=all_where), (*all_params, 20)),
+		"list_goods (status only)": (_SQL_LIST_GOODS.format(where=status_where), (*status_params, 20)),
+		"get_goods_media": (_SQL_GOODS_MEDIA.format(ids=_placeholders(3)), (1, 2, 3)),
+		"set_good_media (references)": (_SQL_MEDIA_PATH_REFERENCED, ("blobs/ab/ab.jpg",)),
+		"count_goods_by_label": (_SQL_COUNT_GOODS_BY_LABEL.format(where=any_where), tuple(any_params)),
+		"search_goods": search("goods_fts", search_where, search_params),
+		"search_goods (bigram)": search("goods_bigram", search_where, search_params),
+		"search_goods (trigram + bigram)": search(
+			"goods_fts", f"{search_where} AND {_SQL_SEARCH_BIGRAM_FILTER}", [*search_params, '"钢琴"']
+		),
+		"search_goods (rank boundary)": (_SQL_SEARCH_BOUNDARY.format(table="goods_fts"), ('"自行车"', 999)),
+		"search_goods (highlight)": (
+			_SQL_SEARCH_HIGHLIGHT.format(ids=_placeholders(2)), ("[", "]", "[", "]", '"自行车"', 1, 2),
+		),
+		"search_goods (bigram rows)": (_SQL_SEARCH_PLAIN.format(ids=_placeholders(2)), (1, 2)),
+		"get_user_by_session": (_SQL_USER_BY_SESSION, ("t",)),
+		"cleanup_expired_sessions": (_SQL_DELETE_EXPIRED_SESSIONS, (0, 1000)),
+	}
+
+
+def explain_hot_queries() -> Dict[str, List[str]]:
+	"""返回每个热点查询的 EXPLAIN QUERY PLAN 明细"""
+	plans = {}
+	with _connection() as conn:
+		for name, (sql, params) in _hot_queries().items():
+			rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+			plans[name] = [row["detail"] for row in rows]
+	return plans
+
+
+def _is_full_scan(step: str) -> bool:
+	# 扫描子查询（协程）的结果不算全表扫描，它的大小已由子查询自身的 LIMIT 限定；
+	# FTS5 虚拟表带 MATCH 约束（索引串里有 M）时走的是全文索引
+	if not step.startswith("SCAN ") or step.startswith("SCAN (subquery"):
+		return False
+	return not re.search(r"VIRTUAL TABLE INDEX \d+:\S*M", step)
+
+
+def find_full_scans(plans: Dict[str, List[str]]) -> Dict[str, List[str]]:
+	"""挑出计划里出现全表/全索引扫描（SCAN）的查询"""
+	return {
+		name: [step for step in steps if _is_full_scan(step)]
+		for name, steps in plans.items()
+		if any(_is_full_scan(step) for step in steps)
+	}
+
+
+if __name__ == "__main__":
+	# 查询计划回归检查：在临时库上建表，任何热点查询退化为全表扫描则以非零状态退出
+	import sys
+	import tempfile
+
+	fd, tmp_path = tempfile.mkstemp(suffix=".db")
+	os.close(fd)
+	DB_PATH = tmp_path
+	try:
+		init_db()
+		plans = explain_hot_queries()
+		for name, steps in plans.items():
+			print(f"{name}: {' | '.join(steps)}")
+		scans = find_full_scans(plans)
+	finally:
+		_pool.close_all()
+		os.remove(tmp_path)
+	if scans:
+		print(f"\n全表扫描: {scans}")
+		sys.exit(1)
+	print("\n所有热点查询均命中索引")
@@ -0,0 +1,90 @@
+"""
+按登录标识（用户名/邮箱）限制失败的登录尝试，状态保存在进程内。
+同一标识在 LOGIN_FAILURE_WINDOW 秒内失败 LOGIN_MAX_FAILURES 次后，窗口结束前的登录请求直接拒绝（429），
+不再查库，也不再计算 bcrypt；登录成功后清零。
+多进程部署时各进程分别计数。
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List
+
+LOGIN_MAX_FAILURES = int(os.environ.get("LOGIN_MAX_FAILURES", 5))
+LOGIN_FAILURE_WINDOW = float(os.environ.get("LOGIN_FAILURE_WINDOW", 300))
+# 最多跟踪的标识数，超出时淘汰最久未更新的
+LOGIN_LIMITER_SIZE = int(os.environ.get("LOGIN_LIMITER_SIZE", 100000))
+
+
+class AttemptLimiter:
+    def __init__(self, max_failures: int, window: float, max_size: int):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # 标识 -> [窗口开始时刻, 失败次数]
+        self._failures: "OrderedDict[str, List[float]]" = OrderedDict()
+        self.blocked = 0
+
+    @staticmethod
+    def _key(identifier: str) -> str:
+        # 大小写、首尾空格不同的写法计入同一个标识
+        return identifier.strip().lower()
+
+    def retry_after(self, identifier: str) -> float:
+        """该标识还需等待的秒数；为 0 表示允许尝试"""
+        key = self._key(identifier)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._failures.get(key)
+            if entry is None:
+                return 0.0
+            started, count = entry
+            if now - started >= self.window:
+                del self._failures[key]
+                return 0.0
+            if count < self.max_failures:
+                return 0.0
+            self.blocked += 1
+            return started + self.window - now
+
+    def record_failure(self, identifier: str) -> None:
+        key = self._key(identifier)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._failures.get(key)
+            if entry is None or now - entry[0] >= self.window:
+                self._failures[key] = [now, 1]
+            else:
+                entry[1] += 1
+            self._failures.move_to_end(key)
+            while len(self._failures) > self.max_size:
+                self._failures.popitem(last=False)
+
+    def reset(self, identifier: str) -> None:
+        with self._lock:
+            self._failures.pop(self._key(identifier), None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"tracked": len(self._failures), "blocked": self.blocked}
+
+
+_limiter = AttemptLimiter(LOGIN_MAX_FAILURES, LOGIN_FAILURE_WINDOW, LOGIN_LIMITER_SIZE)
+
+
+def retry_after(identifier: str) -> float:
+    return _limiter.retry_after(identifier)
+
+
+def record_failure(identifier: str) -> None:
+    _limiter.record_failure(identifier)
+
+
+def reset(identifier: str) -> None:
+    _limiter.reset(identifier)
+
+
+def stats() -> Dict:
+    return _limiter.stats()
@@ -0,0 +1,214 @@
+"""
+持久化的邮件发送队列。
+邮件先写入数据库 mail_queue 表再返回，由固定数量的后台线程取出发送
+（每个线程复用自己的 SMTP 连接）：
+- 发送失败按指数退避重试（带随机抖动），超过最大次数进入死信（status = 'dead'）
+- 取出的邮件记录取出时间（租约）。超过 MAIL_LEASE_SECONDS 仍未发送完成的邮件视为发送进程已退出，
+  重新入队；租约内的邮件可能正由其他进程（reloader 的父子进程、多个 gunicorn worker）发送，不会被重复投递
+- 发送成功的邮件保留 MAIL_SENT_RETENTION_DAYS 天后删除
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import db as db_module
+import mailer
+
+logger = logging.getLogger(__name__)
+
+MAIL_WORKERS = int(os.environ.get("MAIL_WORKERS", 4))
+# 每个工作线程一次从队列取出的邮件数
+MAIL_BATCH = int(os.environ.get("MAIL_BATCH", 20))
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", 6))
+# 第 n 次失败后等待 MAIL_RETRY_BASE * 2^(n-1) 秒（不超过 MAIL_RETRY_MAX）再重试
+MAIL_RETRY_BASE = float(os.environ.get("MAIL_RETRY_BASE", 30))
+MAIL_RETRY_MAX = float(os.environ.get("MAIL_RETRY_MAX", 3600))
+# 队列空闲时检查到期重试的间隔（秒）；新邮件入队会立即唤醒工作线程
+MAIL_POLL_INTERVAL = float(os.environ.get("MAIL_POLL_INTERVAL", 5))
+# 租约秒数，需大于发送一批邮件（MAIL_BATCH 封，每封最多 mailer.SMTP_TIMEOUT 秒并可能重连一次）的最长耗时
+MAIL_LEASE_SECONDS = float(os.environ.get("MAIL_LEASE_SECONDS", 1800))
+MAIL_SENT_RETENTION_DAYS = float(os.environ.get("MAIL_SENT_RETENTION_DAYS", 7))
+# 回收超时租约、清理已发送邮件的间隔（秒）
+MAIL_MAINTENANCE_INTERVAL = float(os.environ.get("MAIL_MAINTENANCE_INTERVAL", 300))
+
+
+def retry_delay(attempts: int) -> float:
+    """第 attempts 次失败后的重试等待秒数"""
+    delay = min(MAIL_RETRY_BASE * (2 ** (attempts - 1)), MAIL_RETRY_MAX)
+    # ±20% 抖动，避免大量失败邮件在同一时刻集中重试
+    return delay * random.uniform(0.8, 1.2)
+
+
+class MailQueue:
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dead = 0
+        self._total_send_time = 0.0
+        self._maintenance_lock = threading.Lock()
+        self._next_maintenance = 0.0
+        self.requeued = 0
+        self.purged = 0
+        self._spawned = 0
+        self.restarts = 0
+
+    def _running(self) -> bool:
+        return len(self._threads) == self.workers and all(thread.is_alive() for thread in self._threads)
+
+    def start(self) -> None:
+        """
+        启动工作线程（重复调用无副作用）。已退出的线程会被替换：
+        fork 出的子进程里线程不存在，或线程因未预料的异常退出时，下次调用会补齐
+        """
+        if self._running():
+            return
+        with self._lock:
+            alive = [thread for thread in self._threads if thread.is_alive()]
+            if self._threads and len(alive) < len(self._threads):
+                self.restarts += len(self._threads) - len(alive)
+                logger.error(f"邮件发送线程已退出 {len(self._threads) - len(alive)} 个，重新启动")
+            while len(alive) < self.workers:
+                self._spawned += 1
+                thread = threading.Thread(target=self._run, name=f"mail-worker-{self._spawned}", daemon=True)
+                thread.start()
+                alive.append(thread)
+            self._threads = alive
+
+    def enqueue(self, to_email: str, subject: str, content: str, html: Optional[str] = None, to_name: Optional[str] = None) -> int:
+        """写入一封待发邮件，返回队列 ID"""
+        return self.enqueue_many([{
+            "to_email": to_email,
+            "to_name": to_name,
+            "subject": subject,
+            "content": content,
+            "html": html,
+        }])[0]
+
+    def enqueue_many(self, mails: List[Dict]) -> List[int]:
+        """在一个事务里写入多封待发邮件"""
+        if not mails:
+            return []
+        ids = db_module.enqueue_mails(mails)
+        self.start()
+        self._wakeup.set()
+        return ids
+
+    def maintain(self) -> None:
+        """回收租约已过期的邮件，删除过了保留期的已发送邮件"""
+        requeued = db_module.requeue_interrupted_mail(MAIL_LEASE_SECONDS)
+        if requeued:
+            logger.info(f"重新入队 {requeued} 封租约过期的邮件")
+        purged = db_module.purge_sent_mail(MAIL_SENT_RETENTION_DAYS * 86400)
+        with self._stats_lock:
+            self.requeued += requeued
+            self.purged += purged
+
+    def _maybe_maintain(self) -> None:
+        # 只由一个空闲的工作线程执行
+        if time.monotonic() < self._next_maintenance or not self._maintenance_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_maintenance = time.monotonic() + MAIL_MAINTENANCE_INTERVAL
+            self.maintain()
+        except Exception as e:
+            logger.error(f"维护邮件队列失败: {e}")
+        finally:
+            self._maintenance_lock.release()
+
+    def _run(self) -> None:
+        # 每个工作线程持有一个 SMTP 会话，连续的邮件复用同一条已登录连接
+        session = mailer.SMTPSession()
+        while True:
+            self._maybe_maintain()
+            try:
+                jobs = db_module.claim_due_mail(MAIL_BATCH)
+            except Exception as e:
+                logger.error(f"读取邮件队列失败: {e}")
+                jobs = []
+            if not jobs:
+                # 队列清空后释放连接，不占用服务商的空闲连接
+                session.close()
+                self._wakeup.wait(MAIL_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            for job in jobs:
+                try:
+                    self._deliver(session, job)
+                except Exception as e:
+                    # 记录结果失败（如另一个进程锁住了数据库）时邮件保持 sending，租约过期后重新入队
+                    logger.error(f"处理邮件 {job['id']} 失败: {e}")
+
+    def _deliver(self, session: "mailer.SMTPSession", job: Dict) -> None:
+        started = time.perf_counter()
+        try:
+            ok = session.send(
+                to_email=job["to_email"],
+                to_name=job["to_name"],
+                subject=job["subject"],
+                content=job["content"],
+                html=job["html"],
+            )
+            error = None if ok else "SMTP send failed"
+        except Exception as e:
+            error = str(e)
+        elapsed = time.perf_counter() - started
+
+        with self._stats_lock:
+            self._total_send_time += elapsed
+            if error is None:
+                self.sent += 1
+            elif job["attempts"] >= MAIL_MAX_ATTEMPTS:
+                self.dead += 1
+            else:
+                self.failed += 1
+
+        if error is None:
+            db_module.mark_mail_sent(job["id"])
+        elif job["attempts"] >= MAIL_MAX_ATTEMPTS:
+            logger.error(f"邮件 {job['id']} 发送 {job['attempts']} 次仍失败，转入死信: {error}")
+            db_module.mark_mail_failed(job["id"], error, None)
+        else:
+            db_module.mark_mail_failed(job["id"], error, time.time() + retry_delay(job["attempts"]))
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            attempts = self.sent + self.failed + self.dead
+            return {
+                "workers": sum(thread.is_alive() for thread in self._threads),
+                "restarts": self.restarts,
+                "sent": self.sent,
+                "retried": self.failed,
+                "dead_lettered": self.dead,
+                "requeued": self.requeued,
+                "purged": self.purged,
+                "avg_send_ms": round(self._total_send_time / attempts * 1000, 3) if attempts else 0.0,
+                "queue": db_module.get_mail_queue_counts(),
+            }
+
+
+_queue = MailQueue(MAIL_WORKERS)
+
+
+def start() -> None:
+    _queue.start()
+
+
+def enqueue(to_email: str, subject: str, content: str, html: Optional[str] = None, to_name: Optional[str] = None) -> int:
+    return _queue.enqueue(to_email, subject, content, html=html, to_name=to_name)
+
+
+def enqueue_many(mails: List[Dict]) -> List[int]:
+    return _queue.enqueue_many(mails)
+
+
+def stats() -> Dict:
+    return _queue.stats()
@@ -1,15 +1,23 @@
 import smtplib
 import os
 import logging
+import random
+import sys
+import threading
+import time
+from functools import lru_cache
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email import base64mime
 from email.header import Header
+from email.message import Message
 from email.utils import formataddr, formatdate, make_msgid
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 
 try:
     from jinja2 import Environment, FileSystemLoader, select_autoescape
+    from markupsafe import escape
     HAS_JINJA2 = True
 except ImportError:
     HAS_JINJA2 = False
@@ -24,19 +32,47 @@ SMTP_USER = os.environ.get("SMTP_USER")
 SMTP_PASS = os.environ.get("SMTP_PASS")
 SMTP_SENDER = os.environ.get("SMTP_SENDER") or SMTP_USER or "noreply@example.com"
 SMTP_SENDER_NAME = os.environ.get("SMTP_SENDER_NAME", "泥邮工具人")
+# 非 465 端口时是否升级 STARTTLS（本地调试用的 SMTP 服务可关闭）
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "1").lower() in ("1", "true", "yes")
+# 单条 SMTP 连接最多发送的邮件数（多数服务商对每连接邮件数有限制），达到后重新连接
+SMTP_MAX_MESSAGES_PER_CONN = int(os.environ.get("SMTP_MAX_MESSAGES_PER_CONN", 100))
+# 连接空闲超过该秒数后，复用前先 NOOP 检查是否仍然可用
+SMTP_IDLE_CHECK_SECONDS = float(os.environ.get("SMTP_IDLE_CHECK_SECONDS", 30))
+# 连接与每次读写的超时秒数，服务商无响应时不会让发送线程一直挂起
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", 30))
 # print(SMTP_HOST,SMTP_PORT,SMTP_USER,SMTP_PASS)
 
 # 初始化 Jinja2 环境
 TEMPLATE_DIR = Path(__file__).parent / "templates"
 if HAS_JINJA2:
+    # Jinja2 会缓存编译后的模板；auto_reload 时每次 get_template 比较文件 mtime，模板修改后自动重新编译
     env = Environment(
         loader=FileSystemLoader(str(TEMPLATE_DIR)),
-        autoescape=select_autoescape(['html', 'xml'])
+        autoescape=select_autoescape(['html', 'xml']),
+        auto_reload=True,
     )
 else:
     env = None
     logger.warning("Jinja2 not found. Template rendering will be limited.")
 
+# 回退渲染用的模板文本缓存: 模板名 -> (文件 mtime, 模板文本)
+_fallback_templates: Dict[str, Tuple[float, str]] = {}
+_fallback_lock = threading.Lock()
+
+
+def _load_fallback_template(template_name: str) -> str:
+    """读取模板文本，文件未修改时直接使用缓存"""
+    tpl_path = TEMPLATE_DIR / template_name
+    mtime = tpl_path.stat().st_mtime
+    cached = _fallback_templates.get(template_name)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    tpl_text = tpl_path.read_text(encoding="utf-8")
+    with _fallback_lock:
+        _fallback_templates[template_name] = (mtime, tpl_text)
+    return tpl_text
+
+
 def render_template(template_name: str, **context) -> str:
     """
     渲染 HTML 邮件模板。
@@ -52,14 +88,61 @@ def render_template(template_name: str, **context) -> str:
     else:
         # 简单的回退逻辑，不支持复杂的 Jinja2 语法
         try:
-            tpl_path = TEMPLATE_DIR / template_name
-            tpl_text = tpl_path.read_text(encoding="utf-8")
+            tpl_text = _load_fallback_template(template_name)
             # 注意：这无法处理 {% if %} 等逻辑，仅作紧急回退
             return tpl_text.format(**context)
         except Exception as e:
             logger.error(f"Fallback rendering failed: {e}")
             return "<html><body><h1>Error rendering template</h1></body></html>"
 
+
+class BatchTemplate:
+    """
+    同一封通知发给多个收件人时使用：模板只完整渲染一次，
+    每个收件人只替换自己的字段（如 user_name）。
+    渲染时给这些字段传入占位标记，之后对结果做字符串替换（按模板的转义规则转义字段值）。
+    若某个字段在模板里经过了过滤器等处理导致标记不完整，或字段值为空（模板可能有默认值），
+    则该收件人退回到完整渲染，保证结果与 render_template 一致。
+    """
+
+    def __init__(self, template_name: str, fields: Tuple[str, ...], context: Dict):
+        self.template_name = template_name
+        self.fields = fields
+        self.context = context
+        self._markers = {field: f"\ue000{field}\ue001" for field in fields}
+        shared = render_template(template_name, **context, **self._markers)
+        if all(marker in shared for marker in self._markers.values()):
+            self._shared: Optional[str] = shared
+        else:
+            self._shared = None
+        self._escape = _escape_for(template_name)
+
+    def render(self, **values) -> str:
+        if self._shared is None or not all(values.get(field) for field in self.fields):
+            return render_template(self.template_name, **self.context, **values)
+        html = self._shared
+        for field, marker in self._markers.items():
+            html = html.replace(marker, self._escape(values[field]))
+        return html
+
+
+def _escape_for(template_name: str):
+    """返回与模板自动转义一致的转义函数"""
+    if HAS_JINJA2 and env and env.autoescape(template_name):
+        return lambda value: str(escape(value))
+    return str
+
+
+def render_batch(template_name: str, per_recipient: Tuple[str, ...] = ("user_name",), **context) -> BatchTemplate:
+    """
+    预渲染模板中所有收件人相同的部分。
+    用法:
+        batch = render_batch('new_arrival.html', product_name=..., ...)
+        for user in users:
+            html = batch.render(user_name=user['name'])
+    """
+    return BatchTemplate(template_name, tuple(per_recipient), context)
+
 def _resolve_sender() -> Tuple[str, str]:
     """
     解析发件人信息。
@@ -103,26 +186,44 @@ def _resolve_sender() -> Tuple[str, str]:
 
     return header_value, email_addr
 
-def send_email(to_email: str, subject: str, content: str, html: Optional[str] = None, to_name: Optional[str] = None) -> bool:
+@lru_cache(maxsize=256)
+def _encoded_header(value: str) -> str:
+    return Header(value, 'utf-8').encode()
+
+
+@lru_cache(maxsize=64)
+def _encoded_part(text: str, subtype: str) -> str:
     """
-    发送邮件。
-    
-    :param to_email: 收件人邮箱
-    :param subject: 邮件主题
-    :param content: 纯文本内容
-    :param html: HTML 内容（可选）
-    :param to_name: 收件人名称（可选）
-    :return: 是否成功
+    序列化好的正文部分（部分头 + base64 正文，与 MIMEText(text, subtype, 'utf-8') 的输出一致）。
+    同一批通知的纯文本正文、以及内容相同的 HTML 正文只编码一次，在多个收件人之间复用。
     """
-    if not to_email:
-        logger.error("收件人邮箱为空")
-        return False
+    return (
+        f'Content-Type: text/{subtype}; charset="utf-8"\n'
+        'MIME-Version: 1.0\n'
+        'Content-Transfer-Encoding: base64\n'
+        '\n'
+        + base64mime.body_encode(text.encode('utf-8'))
+    )
 
-    logger.info(f"准备发送邮件给: {to_email}")
 
-    msg = MIMEMultipart('alternative') if html else MIMEText(content, 'plain', 'utf-8')
-    
-    formatted_from, envelope_sender = _resolve_sender()
+def _build_message(sender: Tuple[str, str], to_email: str, subject: str, content: str, html: Optional[str] = None, to_name: Optional[str] = None) -> Tuple[str, str]:
+    """构造 MIME 邮件，sender 为 _resolve_sender() 的结果。返回 (envelope sender, 邮件正文字符串)"""
+    if html:
+        # 外层只生成各收件人不同的信头，正文部分直接拼接缓存的序列化结果
+        # （base64 内容不会出现 "--=====" 序列，分隔符不会与正文冲突）
+        boundary = '=' * 15 + f"{random.randrange(sys.maxsize):019d}" + '=='
+        msg = Message()
+        msg['Content-Type'] = f'multipart/alternative; boundary="{boundary}"'
+        msg['MIME-Version'] = '1.0'
+        msg.set_payload(
+            f"--{boundary}\n{_encoded_part(content, 'plain')}\n"
+            f"--{boundary}\n{_encoded_part(html, 'html')}\n"
+            f"--{boundary}--\n"
+        )
+    else:
+        msg = MIMEText(content, 'plain', 'utf-8')
+
+    formatted_from, envelope_sender = sender
     msg['From'] = formatted_from
     
     if to_name:
@@ -130,37 +231,162 @@ def send_email(to_email: str, subject: str, content: str, html: Optional[str] =
     else:
         msg['To'] = to_email
 
-    msg['Subject'] = Header(subject, 'utf-8')
+    msg['Subject'] = _encoded_header(subject)
     msg['Date'] = formatdate(localtime=True)
     msg['Message-ID'] = make_msgid()
 
-    if html:
-        msg.attach(MIMEText(content, 'plain', 'utf-8'))
-        msg.attach(MIMEText(html, 'html', 'utf-8'))
+    return envelope_sender, msg.as_string()
 
-    try:
-        if SMTP_PORT == 465:
-            server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT)
-        else:
-            server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-            server.starttls() # 如果需要 TLS，请取消注释
 
-        if SMTP_USER and SMTP_PASS:
-            server.login(SMTP_USER, SMTP_PASS)
-        
-        failed = server.sendmail(envelope_sender, [to_email], msg.as_string())
-        server.quit()
-        
-        if failed:
-            logger.error(f"邮件发送失败，被服务器拒绝的收件人: {failed}")
+def _connect() -> smtplib.SMTP:
+    """建立并登录一条 SMTP 连接"""
+    if SMTP_PORT == 465:
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_STARTTLS:
+            server.starttls()
+
+    if SMTP_USER and SMTP_PASS:
+        server.login(SMTP_USER, SMTP_PASS)
+    return server
+
+
+class SMTPSession:
+    """
+    可复用的已登录 SMTP 连接，用于连续发送多封邮件：
+    - 第一次发送时才建立连接，之后的邮件复用同一连接（省去 TLS 握手与登录）
+    - 每条连接最多发送 max_messages 封，之后自动换新连接
+    - 空闲较久的连接先 NOOP 检查；发送途中连接断开会重连并重试该邮件一次
+    - 发件人按创建会话时的配置解析一次，之后的邮件共用
+    用法:
+        with SMTPSession() as session:
+            for ...:
+                session.send(to_email, subject, content, html)
+    """
+
+    def __init__(self, max_messages: int = SMTP_MAX_MESSAGES_PER_CONN):
+        self.max_messages = max_messages
+        self.sender = _resolve_sender()
+        self._server: Optional[smtplib.SMTP] = None
+        self._sent_on_conn = 0
+        self._last_used = 0.0
+
+    def __enter__(self) -> "SMTPSession":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            try:
+                self._server.close()
+            except Exception:
+                pass
+        self._server = None
+        self._sent_on_conn = 0
+
+    def _ensure_connected(self) -> smtplib.SMTP:
+        if self._server is not None and self._sent_on_conn >= self.max_messages:
+            self.close()
+        if self._server is not None and time.monotonic() - self._last_used > SMTP_IDLE_CHECK_SECONDS:
+            try:
+                if self._server.noop()[0] != 250:
+                    self.close()
+            except OSError:
+                # smtplib.SMTPException 也是 OSError 的子类
+                self.close()
+        if self._server is None:
+            self._server = _connect()
+            self._sent_on_conn = 0
+        return self._server
+
+    def send_raw(self, envelope_sender: str, to_email: str, message: str) -> bool:
+        """发送已构造好的邮件正文"""
+        for attempt in (1, 2):
+            try:
+                server = self._ensure_connected()
+                failed = server.sendmail(envelope_sender, [to_email], message)
+                self._sent_on_conn += 1
+                self._last_used = time.monotonic()
+                if failed:
+                    logger.error(f"邮件发送失败，被服务器拒绝的收件人: {failed}")
+                    return False
+                return True
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError) as e:
+                # 连接层面的错误：丢弃连接，重连后再试一次
+                self.close()
+                if attempt == 2:
+                    logger.error(f"邮件发送失败: {e}")
+                    return False
+            except smtplib.SMTPException as e:
+                # 协议层面的拒绝（认证失败、收件人被拒等），重试无意义
+                logger.error(f"邮件发送失败: {e}")
+                self.close()
+                return False
+            except OSError as e:
+                # 网络错误（连接被重置、超时等），同样重连再试一次
+                self.close()
+                if attempt == 2:
+                    logger.error(f"邮件发送失败: {e}")
+                    return False
+            except Exception as e:
+                logger.error(f"邮件发送失败: {e}")
+                # 出错后连接状态未知，下次重新建立
+                self.close()
+                return False
+        return False
+
+    def send(self, to_email: str, subject: str, content: str, html: Optional[str] = None, to_name: Optional[str] = None) -> bool:
+        if not to_email:
+            logger.error("收件人邮箱为空")
             return False
+        envelope_sender, message = _build_message(self.sender, to_email, subject, content, html=html, to_name=to_name)
+        ok = self.send_raw(envelope_sender, to_email, message)
+        if ok:
+            logger.info(f"邮件发送成功: {to_email}")
+        return ok
+
 
-        logger.info(f"邮件发送成功: {to_email}")
-        return True
-    except Exception as e:
-        logger.error(f"邮件发送失败: {e}")
+def send_bulk(mails: List[Dict]) -> List[bool]:
+    """
+    通过同一个 SMTP 会话批量发送邮件，返回每封邮件是否成功。
+    每项包含 to_email, subject, content，可选 html, to_name。
+    """
+    with SMTPSession() as session:
+        return [
+            session.send(
+                mail["to_email"], mail["subject"], mail["content"],
+                html=mail.get("html"), to_name=mail.get("to_name")
+            )
+            for mail in mails
+        ]
+
+
+def send_email(to_email: str, subject: str, content: str, html: Optional[str] = None, to_name: Optional[str] = None) -> bool:
+    """
+    发送邮件（单独建立一次连接）。连续发送多封时请使用 SMTPSession 或 send_bulk。
+    
+    :param to_email: 收件人邮箱
+    :param subject: 邮件主题
+    :param content: 纯文本内容
+    :param html: HTML 内容（可选）
+    :param to_name: 收件人名称（可选）
+    :return: 是否成功
+    """
+    if not to_email:
+        logger.error("收件人邮箱为空")
         return False
 
+    logger.info(f"准备发送邮件给: {to_email}")
+    with SMTPSession() as session:
+        return session.send(to_email, subject, content, html=html, to_name=to_name)
+
 if __name__ == "__main__":
     # 测试代码
     if not SMTP_USER or not SMTP_PASS:
@@ -0,0 +1,195 @@
+"""
+上传图片的处理流水线。
+每张图片在上传后生成多个尺寸（thumb / card / full），每个尺寸同时输出原格式与 WebP
+（Pillow 支持时再加 AVIF），并去掉 EXIF 等元数据（先按 EXIF 方向旋正）。
+处理在进程池中进行，不阻塞请求线程；处理完成前 serve_media 直接返回原图。
+
+变体与原图放在同一目录，命名为 <原文件名去扩展名>_<尺寸名>.<格式扩展名>，
+例如 good_3/good_3_0.jpg -> good_3/good_3_0_thumb.jpg、good_3/good_3_0_thumb.webp
+
+文件发送方式由 MEDIA_SERVE_MODE 决定：
+- direct: 由 Python 发送（支持 Range/206；WSGI 服务器提供 wsgi.file_wrapper 时用 sendfile）
+- x-accel: 只返回 X-Accel-Redirect 头，由 nginx 发送文件，需要配置一个 internal location，例如
+      location /_media/ { internal; alias /path/to/media/; }
+- x-sendfile: 返回 X-Sendfile 头，由 Apache mod_xsendfile / lighttpd 发送文件
+文件名中带内容哈希的文件（blobs/ 下的商品媒体、新头像）内容永不改变，响应带一年的 immutable 缓存。
+"""
+
+import logging
+import mimetypes
+import os
+import re
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import quote
+
+from flask import Response, abort, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    from PIL import Image, ImageOps, features
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+logger = logging.getLogger(__name__)
+
+if not HAS_PIL:
+    logger.warning("Pillow not found. Uploaded images will be served as original files only.")
+
+# 尺寸名 -> 最大宽度（像素），按从小到大排列
+VARIANT_WIDTHS: Dict[str, int] = {
+    "thumb": 240,
+    "card": 640,
+    "full": 1600,
+}
+# GIF 可能是动图，缩放会丢帧，保持原样
+IMAGE_EXTENSIONS = {"png", "jpg", "jpeg"}
+# 额外输出的现代格式：扩展名 -> (Pillow 格式名, MIME 类型)
+MODERN_FORMATS = {
+    "avif": ("AVIF", "image/avif"),
+    "webp": ("WEBP", "image/webp"),
+}
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 2))
+MEDIA_QUALITY = int(os.environ.get("MEDIA_QUALITY", 80))
+MEDIA_SERVE_MODE = os.environ.get("MEDIA_SERVE_MODE", "direct")
+MEDIA_ACCEL_PREFIX = os.environ.get("MEDIA_ACCEL_PREFIX", "/_media/")
+IMMUTABLE_MAX_AGE = 31536000
+# 变体尚未生成、暂时返回原图时的缓存时长（秒），之后客户端会重新请求到变体
+PENDING_MAX_AGE = 60
+
+if MEDIA_SERVE_MODE not in ("direct", "x-accel", "x-sendfile"):
+    raise ValueError(f"unknown MEDIA_SERVE_MODE: {MEDIA_SERVE_MODE}")
+
+# 内容哈希命名：blobs/ab/<sha256>.<ext>、user/avatar_<id>_<sha256 前 12 位>.<ext>，以及它们的变体
+_HASHED_NAME = re.compile(r"(?:^|[/_])[0-9a-f]{12,64}(?:_[a-z]+)?\.\w+$")
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def is_image(path: str) -> bool:
+    return path.rsplit(".", 1)[-1].lower() in IMAGE_EXTENSIONS
+
+
+def variant_path(path: str, size: str, ext: Optional[str] = None) -> str:
+    """原图 path 的某个尺寸变体的路径；ext 为 None 时沿用原图格式"""
+    stem, original_ext = path.rsplit(".", 1)
+    return f"{stem}_{size}.{ext or original_ext.lower()}"
+
+
+def _modern_formats() -> List[str]:
+    return [ext for ext, (fmt, _) in MODERN_FORMATS.items() if features.check(fmt.lower())]
+
+
+def process_image(path: str) -> List[str]:
+    """生成 path 的全部变体，返回生成的文件路径。在工作进程中执行。"""
+    generated = []
+    with Image.open(path) as source:
+        # 先按 EXIF 方向旋正，之后保存时不带任何元数据
+        image = ImageOps.exif_transpose(source)
+        original_ext = path.rsplit(".", 1)[1].lower()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "P") else "RGB")
+
+        for size, width in VARIANT_WIDTHS.items():
+            resized = image
+            if image.width > width:
+                height = round(image.height * width / image.width)
+                resized = image.resize((width, height), Image.LANCZOS)
+
+            targets = [(original_ext, None)] + [(ext, MODERN_FORMATS[ext][0]) for ext in _modern_formats()]
+            for ext, fmt in targets:
+                out = variant_path(path, size, ext)
+                tmp = out + ".tmp"
+                frame = resized
+                if ext in ("jpg", "jpeg") and frame.mode != "RGB":
+                    frame = frame.convert("RGB")
+                if fmt is None:
+                    fmt = "JPEG" if ext in ("jpg", "jpeg") else ext.upper()
+                frame.save(tmp, format=fmt, quality=MEDIA_QUALITY, optimize=True)
+                # 写完再改名，serve_media 不会读到写了一半的文件
+                os.replace(tmp, out)
+                generated.append(out)
+    return generated
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=MEDIA_WORKERS)
+    return _executor
+
+
+def _log_result(path: str, future: Future) -> None:
+    error = future.exception()
+    if error is not None:
+        logger.error(f"图片处理失败 {path}: {error}")
+
+
+def submit(path: str) -> Optional[Future]:
+    """把一张刚上传的图片交给进程池处理；不是图片或未安装 Pillow 时什么都不做"""
+    if not HAS_PIL or not is_image(path):
+        return None
+    future = _get_executor().submit(process_image, path)
+    future.add_done_callback(lambda f: _log_result(path, f))
+    return future
+
+
+def remove_variants(path: str) -> None:
+    """删除某张原图的全部变体（替换头像等场景）"""
+    for size in VARIANT_WIDTHS:
+        for ext in [path.rsplit(".", 1)[-1].lower(), *MODERN_FORMATS]:
+            try:
+                os.remove(variant_path(path, size, ext))
+            except OSError:
+                pass
+
+
+def pick_variant(root: str, filename: str, width: Optional[int], accepted: List[str]) -> str:
+    """
+    为请求选择要返回的文件（相对 root 的路径）：
+    - width: 期望宽度，选不小于它的最小尺寸；未指定时用 full
+    - accepted: 客户端明确接受的 MIME 类型，按 MODERN_FORMATS 的顺序优先选现代格式
+    对应变体尚未生成（或不是图片）时返回原文件
+    """
+    if not is_image(filename):
+        return filename
+    size = "full"
+    if width:
+        size = next((name for name, w in VARIANT_WIDTHS.items() if w >= width), "full")
+    candidates = [ext for ext, (_, mime) in MODERN_FORMATS.items() if mime in accepted]
+    candidates.append(None)
+    for ext in candidates:
+        candidate = variant_path(filename, size, ext)
+        if os.path.isfile(os.path.join(root, candidate)):
+            return candidate
+    return filename
+
+
+def cache_control(filename: str, chosen: str) -> str:
+    """filename 为请求的路径，chosen 为实际发送的文件"""
+    if not _HASHED_NAME.search(filename):
+        # 旧的固定文件名可能被覆盖，每次都向服务器校验（ETag / Last-Modified）
+        return "no-cache"
+    if chosen == filename and HAS_PIL and is_image(filename):
+        return f"public, max-age={PENDING_MAX_AGE}"
+    return f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+
+
+def send(root: str, filename: str, width: Optional[int], accepted: List[str]) -> Response:
+    """按 MEDIA_SERVE_MODE 发送 root 下的媒体文件（图片先按 pick_variant 选择变体）"""
+    chosen = pick_variant(root, filename, width, accepted)
+    if MEDIA_SERVE_MODE == "x-accel":
+        path = safe_join(root, chosen)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        # 响应体由 nginx 填充，Range、sendfile 也由 nginx 处理；这里的 Content-Type、Cache-Control 会被保留
+        response = Response(mimetype=mimetypes.guess_type(chosen)[0] or "application/octet-stream")
+        response.headers["X-Accel-Redirect"] = MEDIA_ACCEL_PREFIX + quote(chosen)
+    else:
+        # x-sendfile 模式由 app 的 USE_X_SENDFILE 配置生效
+        response = send_from_directory(root, chosen)
+    response.headers["Cache-Control"] = cache_control(filename, chosen)
+    if is_image(filename):
+        response.vary.add("Accept")
+    return response
@@ -0,0 +1,219 @@
+"""
+密码哈希与校验。
+bcrypt 每次计算要占用上百毫秒 CPU，直接在请求线程里执行时，一波登录请求就会拖慢所有接口。
+这里把计算交给固定大小的进程池：
+- 排队与执行中的任务总数不超过 PASSWORD_QUEUE_LIMIT，超出时抛出 Busy，接口返回 429
+- 工作因子 BCRYPT_ROUNDS 可配置；为 auto 时在启动时校准，取单次哈希不超过 BCRYPT_TARGET_MS 的最大值，
+  但不低于 BCRYPT_MIN_ROUNDS（默认 12，即 bcrypt.gensalt() 的默认值），校准只会提高工作因子。
+  结果写入 BCRYPT_ROUNDS_FILE，之后的进程（及重启后）直接读取，所有进程使用同一个值
+- 进程池的子进程被杀（如 OOM）后整个池不可用，此时丢弃并重建进程池
+- 登录校验通过后，若存储的哈希工作因子低于当前配置（needs_rehash），由调用方重新哈希并保存；
+  更高的不降级
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional, Union
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+# 进程池大小；为 0 时在调用线程内直接计算（不限流）
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", os.cpu_count() or 1))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get("PASSWORD_QUEUE_LIMIT", PASSWORD_WORKERS * 8))
+BCRYPT_ROUNDS = os.environ.get("BCRYPT_ROUNDS", "auto")
+BCRYPT_TARGET_MS = float(os.environ.get("BCRYPT_TARGET_MS", 250))
+# 校准结果的下限与上限。下限为 bcrypt.gensalt() 的默认值 12，机器再慢也不会降低密码强度
+BCRYPT_MIN_ROUNDS = int(os.environ.get("BCRYPT_MIN_ROUNDS", 12))
+BCRYPT_MAX_ROUNDS = int(os.environ.get("BCRYPT_MAX_ROUNDS", 16))
+# 保存校准结果的文件；换了机器想重新校准时删除它即可
+BCRYPT_ROUNDS_FILE = os.environ.get("BCRYPT_ROUNDS_FILE", os.path.join(os.path.dirname(__file__), "bcrypt_rounds"))
+
+
+class Busy(Exception):
+    """排队的哈希任务已达上限"""
+
+
+def _hash(password: bytes, rounds: int) -> bytes:
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password: bytes, stored_hash: bytes) -> bool:
+    return bcrypt.checkpw(password, stored_hash)
+
+
+def calibrate(target_ms: float = BCRYPT_TARGET_MS) -> int:
+    """返回本机单次哈希耗时不超过 target_ms 的最大工作因子（限制在 BCRYPT_MIN_ROUNDS..BCRYPT_MAX_ROUNDS 内）"""
+    rounds = BCRYPT_MIN_ROUNDS
+    while rounds < BCRYPT_MAX_ROUNDS:
+        start = time.perf_counter()
+        _hash(b"calibration", rounds)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        # 工作因子每加一，耗时翻倍
+        if elapsed_ms * 2 > target_ms:
+            break
+        rounds += 1
+    return rounds
+
+
+def _read_rounds(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            # 下限调高之前保存的结果同样不低于下限
+            return max(int(f.read().strip()), BCRYPT_MIN_ROUNDS)
+    except (OSError, ValueError):
+        return None
+
+
+def calibrated_rounds(path: str = BCRYPT_ROUNDS_FILE) -> int:
+    """
+    读取保存的校准结果；没有时校准一次并保存。
+    多个进程同时启动时只有一个能创建文件，其余进程改用它写入的值。
+    """
+    rounds = _read_rounds(path)
+    if rounds is not None:
+        return rounds
+    rounds = calibrate()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write(f"{rounds}\n")
+        # link 在目标已存在时失败，不会覆盖先完成校准的进程写入的值
+        os.link(tmp, path)
+        logger.info(f"bcrypt 工作因子校准为 {rounds}，已保存到 {path}")
+    except FileExistsError:
+        rounds = _read_rounds(path) or rounds
+    except OSError as e:
+        logger.warning(f"无法保存 bcrypt 校准结果 {path}: {e}")
+    finally:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+    return rounds
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._rounds: Optional[int] = None
+        self._lock = threading.Lock()
+        # 校准耗时较长，单独加锁，不阻塞 _run 与 stats
+        self._rounds_lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.pool_restarts = 0
+
+    @property
+    def rounds(self) -> int:
+        """
+        当前使用的工作因子；BCRYPT_ROUNDS=auto 时使用保存的校准结果（没有时先校准）。
+        应在启动时调用一次（见 app.py），不让第一个注册/登录请求等待校准
+        """
+        if self._rounds is None:
+            with self._rounds_lock:
+                if self._rounds is None:
+                    if BCRYPT_ROUNDS == "auto":
+                        self._rounds = calibrated_rounds()
+                    else:
+                        self._rounds = int(BCRYPT_ROUNDS)
+        return self._rounds
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        with self._lock:
+            if self.in_flight >= self.queue_limit:
+                self.rejected += 1
+                raise Busy()
+            self.in_flight += 1
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            executor = self._executor
+        try:
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # 子进程异常退出后这个进程池不再可用，换一个新的重试一次
+                return self._replace_executor(executor).submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+
+    def _replace_executor(self, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+        with self._lock:
+            # 并发的请求可能已经换过了
+            if self._executor is broken:
+                logger.error("密码哈希进程池已损坏，重新创建")
+                self.pool_restarts += 1
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            executor = self._executor
+        broken.shutdown(wait=False)
+        return executor
+
+    def hash(self, password: str) -> str:
+        return self._run(_hash, password.encode("utf-8"), self.rounds).decode("utf-8")
+
+    def verify(self, password: str, stored_hash: Union[str, bytes]) -> bool:
+        if isinstance(stored_hash, str):
+            stored_hash = stored_hash.encode("utf-8")
+        try:
+            return self._run(_check, password.encode("utf-8"), stored_hash)
+        except ValueError:
+            # 存储的不是合法的 bcrypt 哈希
+            return False
+
+    def needs_rehash(self, stored_hash: Union[str, bytes]) -> bool:
+        if isinstance(stored_hash, bytes):
+            stored_hash = stored_hash.decode("utf-8")
+        try:
+            return int(stored_hash.split("$")[2]) < self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_limit": self.queue_limit,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "pool_restarts": self.pool_restarts,
+                "rounds": self._rounds,
+            }
+
+
+_hasher = PasswordHasher(PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT)
+
+
+def hash_password(password: str) -> str:
+    """哈希密码（进程池中执行），队列已满时抛出 Busy"""
+    return _hasher.hash(password)
+
+
+def verify_password(password: str, stored_hash: Union[str, bytes]) -> bool:
+    """校验密码（进程池中执行），队列已满时抛出 Busy"""
+    return _hasher.verify(password, stored_hash)
+
+
+def needs_rehash(stored_hash: Union[str, bytes]) -> bool:
+    """存储的哈希工作因子低于当前配置，应在登录成功后重新哈希"""
+    return _hasher.needs_rehash(stored_hash)
+
+
+def rounds() -> int:
+    return _hasher.rounds
+
+
+def stats() -> Dict:
+    return _hasher.stats()
@@ -0,0 +1,202 @@
+"""
+读多写少接口的响应缓存。
+- 进程内 LRU 保存序列化后的响应体及其 ETag，命中时不再查询数据库或文件系统
+- 请求带 If-None-Match 且 ETag 未变时直接返回 304
+- 每个缓存项属于一个标签（如 "good:42"），写操作后调用 invalidate(标签) 使其失效
+多进程部署时各进程的缓存互相独立，只能看到本进程内的失效通知；
+因此每个缓存项最多保留 RESPONSE_CACHE_MAX_AGE 秒，其他进程写入的改动最迟在这之后可见。
+"""
+
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from flask import Response, make_response, request
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+# 缓存项的最长保留秒数，即多进程部署时其他进程的写入最多延迟多久可见
+RESPONSE_CACHE_MAX_AGE = float(os.environ.get("RESPONSE_CACHE_MAX_AGE", 10))
+
+
+class _Entry:
+    __slots__ = ("body", "mimetype", "etag", "created")
+
+    def __init__(self, body: bytes, mimetype: str):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.created = time.monotonic()
+
+
+class _Tag:
+    """一个标签的状态：代数、当前缓存的键、正在执行视图（未命中后尚未写入）的请求数"""
+    __slots__ = ("generation", "keys", "pending")
+
+    def __init__(self):
+        self.generation = 0
+        self.keys: set = set()
+        self.pending = 0
+
+
+class ResponseCache:
+    """
+    LRU 缓存，键为 (标签, 变体)。同一标签的所有变体（如带不同查询参数的请求）一起失效。
+    每个标签有一个代数，失效时加一：视图函数执行期间如果发生了失效，其结果不会被写入缓存，
+    避免把写操作之前读到的旧数据缓存下来。
+    标签状态只在它有缓存项或有未完成的未命中请求时保留，之后即删除，
+    因此占用的内存受缓存大小与并发请求数限制，不随写过的商品、用户数增长。
+    """
+
+    def __init__(self, size: int, max_age: float):
+        self.size = size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, Hashable], _Entry]" = OrderedDict()
+        self._tags: Dict[str, _Tag] = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.not_modified = 0
+
+    def get(self, key: Tuple[str, Hashable]) -> Tuple[Optional[_Entry], int]:
+        """
+        返回 (缓存项或 None, 该标签当前代数)。
+        未命中时调用方执行视图后，无论是否 put，都必须调用 finish(key)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.created > self.max_age:
+                # 过期：按未命中处理，视图重新生成
+                self.expired += 1
+                del self._entries[key]
+                self._forget(key)
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry, self._tags[key[0]].generation
+            self.misses += 1
+            tag = self._tags.get(key[0])
+            if tag is None:
+                tag = self._tags[key[0]] = _Tag()
+            tag.pending += 1
+            return None, tag.generation
+
+    def put(self, key: Tuple[str, Hashable], entry: _Entry, generation: int) -> None:
+        with self._lock:
+            tag = self._tags.get(key[0])
+            if tag is None or tag.generation != generation:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            tag.keys.add(key)
+            while len(self._entries) > self.size:
+                oldest, _ = self._entries.popitem(last=False)
+                self._forget(oldest)
+
+    def finish(self, key: Tuple[str, Hashable]) -> None:
+        with self._lock:
+            tag = self._tags.get(key[0])
+            if tag is not None:
+                tag.pending -= 1
+                self._drop_if_unused(key[0], tag)
+
+    def _forget(self, key: Tuple[str, Hashable]) -> None:
+        tag = self._tags.get(key[0])
+        if tag is not None:
+            tag.keys.discard(key)
+            self._drop_if_unused(key[0], tag)
+
+    def _drop_if_unused(self, name: str, tag: _Tag) -> None:
+        # 没有缓存项、也没有进行中的请求时，代数已无需记录
+        if not tag.keys and tag.pending <= 0:
+            del self._tags[name]
+
+    def record_not_modified(self) -> None:
+        with self._lock:
+            self.not_modified += 1
+
+    def invalidate(self, name: str) -> None:
+        with self._lock:
+            tag = self._tags.get(name)
+            if tag is None:
+                return
+            tag.generation += 1
+            for key in tag.keys:
+                del self._entries[key]
+            tag.keys.clear()
+            self._drop_if_unused(name, tag)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            # 进行中的请求仍需要它们的标签（代数加一，结果不会写入）
+            for name, tag in list(self._tags.items()):
+                tag.generation += 1
+                tag.keys.clear()
+                self._drop_if_unused(name, tag)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.size,
+                "max_age": self.max_age,
+                "tags": len(self._tags),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "not_modified": self.not_modified,
+            }
+
+
+_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_MAX_AGE)
+
+
+def cached(key_fn: Callable[..., Tuple[str, Hashable]]):
+    """
+    视图装饰器。key_fn 接收与视图相同的参数，返回 (标签, 变体)。
+    只缓存 200 响应；响应带 ETag 与 Cache-Control: no-cache（浏览器每次都来校验，未变时得到 304）。
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = key_fn(*args, **kwargs)
+            entry, generation = _cache.get(key)
+            if entry is None:
+                try:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.direct_passthrough:
+                        return response
+                    entry = _Entry(response.get_data(), response.mimetype)
+                    _cache.put(key, entry, generation)
+                finally:
+                    _cache.finish(key)
+
+            response = Response(entry.body, mimetype=entry.mimetype)
+            response.set_etag(entry.etag)
+            response.headers["Cache-Control"] = "no-cache"
+            response = response.make_conditional(request)
+            if response.status_code == 304:
+                _cache.record_not_modified()
+            return response
+        return wrapper
+    return decorator
+
+
+def invalidate(tag: str) -> None:
+    _cache.invalidate(tag)
+
+
+def clear() -> None:
+    _cache.clear()
+
+
+def stats() -> Dict:
+    return _cache.stats()
@@ -0,0 +1,80 @@
+"""
+过期 session 的后台清理。
+后台线程每隔 SESSION_REAP_INTERVAL 秒调用一次 db.cleanup_expired_sessions，
+按 SESSION_REAP_BATCH 条一批删除，每批一个短事务，不会长时间占住写锁。
+多进程部署时每个进程各自清理，重复执行只是多几次空删除。
+app 在每个请求前调用 start()，gunicorn 等不经过 app.py __main__ 的部署方式也会启动清理线程。
+"""
+
+import logging
+import os
+import random
+import threading
+from typing import Dict, Optional
+
+import db as db_module
+
+logger = logging.getLogger(__name__)
+
+SESSION_REAP_INTERVAL = float(os.environ.get("SESSION_REAP_INTERVAL", 600))
+SESSION_REAP_BATCH = int(os.environ.get("SESSION_REAP_BATCH", 1000))
+
+
+class SessionReaper:
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.runs = 0
+        self.reaped = 0
+
+    def start(self) -> None:
+        """启动清理线程（重复调用无副作用）。fork 出的子进程里线程不存在，会重新启动"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="session-reaper", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def reap(self) -> int:
+        """立即清理一次，返回删除的 session 数"""
+        deleted = db_module.cleanup_expired_sessions(self.batch_size)
+        self.runs += 1
+        self.reaped += deleted
+        if deleted:
+            logger.info(f"清理过期 session {deleted} 个")
+        return deleted
+
+    def _run(self) -> None:
+        # 启动时先清理一次，之后按间隔执行（带随机抖动，避免多进程同时清理）
+        while not self._stop.is_set():
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"清理过期 session 失败: {e}")
+            self._stop.wait(self.interval * random.uniform(0.9, 1.1))
+
+    def stats(self) -> Dict:
+        return {"interval": self.interval, "runs": self.runs, "reaped": self.reaped}
+
+
+_reaper = SessionReaper(SESSION_REAP_INTERVAL, SESSION_REAP_BATCH)
+
+
+def start() -> None:
+    _reaper.start()
+
+
+def reap() -> int:
+    return _reaper.reap()
+
+
+def stats() -> Dict:
+    return _reaper.stats()
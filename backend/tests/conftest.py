@@ -0,0 +1,86 @@
+import os
+import socketserver
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db as db_module  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def db(tmp_path_factory):
+    """整个测试会话共用一个临时数据库（写线程的连接在首次写入时建立，之后不再切换）"""
+    root = tmp_path_factory.mktemp("db")
+    db_module._pool.close_all()
+    db_module.DB_PATH = str(root / "test.db")
+    db_module.MEDIA_DIR = str(root / "media")
+    db_module.init_db()
+    yield db_module
+    db_module._pool.close_all()
+
+
+class _RecordingSMTPHandler(socketserver.StreamRequestHandler):
+    """极简 SMTP 服务端：记录收到的每封邮件的原文；server.reject 为真时拒收"""
+
+    def _reply(self, line: str) -> None:
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        self._reply("220 test ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode(errors="replace").strip().upper()
+            if cmd.startswith("EHLO"):
+                self._reply("250-test")
+                self._reply("250 8BITMIME")
+            elif cmd.startswith("DATA"):
+                self._reply("354 end with .")
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if data in (b".\r\n", b""):
+                        break
+                    lines.append(data)
+                if self.server.reject:
+                    self._reply("554 rejected")
+                else:
+                    self.server.messages.append(b"".join(lines).decode("utf-8", errors="replace"))
+                    self._reply("250 queued")
+            elif cmd.startswith("QUIT"):
+                self._reply("221 bye")
+                return
+            else:
+                self._reply("250 ok")
+
+
+class _RecordingSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = []
+        self.reject = False
+
+
+@pytest.fixture
+def smtp_sink(monkeypatch):
+    """本地 SMTP 服务，mailer 指向它；返回的 server.messages 为收到的邮件原文"""
+    import mailer
+
+    server = _RecordingSMTPServer(("127.0.0.1", 0), _RecordingSMTPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    monkeypatch.setattr(mailer, "SMTP_HOST", host)
+    monkeypatch.setattr(mailer, "SMTP_PORT", port)
+    monkeypatch.setattr(mailer, "SMTP_STARTTLS", False)
+    monkeypatch.setattr(mailer, "SMTP_USER", None)
+    monkeypatch.setattr(mailer, "SMTP_PASS", None)
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,149 @@
+import base64
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import mail_queue
+import mailer
+
+
+@pytest.fixture
+def queue(db):
+    db._write(lambda conn: conn.execute("DELETE FROM mail_queue"))
+    return mail_queue.MailQueue(workers=0)
+
+
+def _deliver_due(db, queue):
+    """在当前线程里取出并发送全部到期邮件（代替后台工作线程）"""
+    with mailer.SMTPSession() as session:
+        for job in db.claim_due_mail(100):
+            queue._deliver(session, job)
+
+
+def _row(db, mail_id):
+    with db._connection() as conn:
+        return dict(conn.execute("SELECT * FROM mail_queue WHERE id = ?", (mail_id,)).fetchone())
+
+
+def _body(message: str) -> str:
+    """取出邮件中全部 base64 段落解码后的文本"""
+    decoded = []
+    for part in message.split("\r\n\r\n")[1:]:
+        chunk = part.split("\r\n--")[0].replace("\r\n", "")
+        try:
+            decoded.append(base64.b64decode(chunk, validate=True).decode("utf-8"))
+        except ValueError:
+            decoded.append(chunk)
+    return "\n".join(decoded)
+
+
+def test_delivers_queued_mail_with_html(db, queue, smtp_sink):
+    mail_id = queue.enqueue_many([{
+        "to_email": "a@example.com", "to_name": "甲", "subject": "新品上架",
+        "content": "纯文本正文", "html": "<p>HTML 正文</p>",
+    }])[0]
+    _deliver_due(db, queue)
+
+    assert len(smtp_sink.messages) == 1
+    body = _body(smtp_sink.messages[0])
+    assert "纯文本正文" in body
+    assert "<p>HTML 正文</p>" in body
+    row = _row(db, mail_id)
+    assert row["status"] == "sent"
+    assert row["sent_at"] is not None
+    assert queue.stats()["sent"] == 1
+
+
+def test_failed_send_is_retried_then_dead_lettered(db, queue, smtp_sink, monkeypatch):
+    monkeypatch.setattr(mail_queue, "MAIL_MAX_ATTEMPTS", 2)
+    smtp_sink.reject = True
+    mail_id = queue.enqueue("b@example.com", "s", "c")
+
+    _deliver_due(db, queue)
+    row = _row(db, mail_id)
+    assert row["status"] == "pending"
+    assert row["attempts"] == 1
+    assert row["next_attempt_at"] > time.time()
+
+    db._write(lambda conn: conn.execute("UPDATE mail_queue SET next_attempt_at = 0 WHERE id = ?", (mail_id,)))
+    _deliver_due(db, queue)
+    assert _row(db, mail_id)["status"] == "dead"
+    assert smtp_sink.messages == []
+
+
+def test_requeue_leaves_claims_within_lease(db, queue):
+    mail_id = queue.enqueue("c@example.com", "s", "c")
+    assert [job["id"] for job in db.claim_due_mail(10)] == [mail_id]
+
+    # 另一个进程启动时，租约内的邮件仍由原进程发送
+    assert db.requeue_interrupted_mail(600) == 0
+    assert _row(db, mail_id)["status"] == "sending"
+    assert db.claim_due_mail(10) == []
+
+    # 租约过期：原进程已退出，重新入队
+    db._write(lambda conn: conn.execute(
+        "UPDATE mail_queue SET claimed_at = ? WHERE id = ?", (time.time() - 601, mail_id)
+    ))
+    assert db.requeue_interrupted_mail(600) == 1
+    assert [job["id"] for job in db.claim_due_mail(10)] == [mail_id]
+
+
+def test_purge_removes_only_old_sent_mail(db, queue):
+    old, recent, pending = queue.enqueue_many([
+        {"to_email": f"{name}@example.com", "subject": "s", "content": "c"} for name in ("old", "recent", "pending")
+    ])
+    db._write(lambda conn: conn.execute(
+        "UPDATE mail_queue SET status = 'sent', sent_at = datetime('now', '-8 days') WHERE id = ?", (old,)
+    ))
+    db.mark_mail_sent(recent)
+
+    assert db.purge_sent_mail(7 * 86400, batch_size=1) == 1
+    with db._connection() as conn:
+        remaining = {row[0] for row in conn.execute("SELECT id FROM mail_queue")}
+    assert remaining == {recent, pending}
+
+
+
+def test_bookkeeping_failure_does_not_kill_worker(db, queue, smtp_sink, monkeypatch):
+    mail_id = queue.enqueue("d@example.com", "s", "c")
+    claim = db.claim_due_mail
+    calls = []
+    next_batch = threading.Event()
+
+    def claim_once(limit):
+        calls.append(limit)
+        if len(calls) == 1:
+            return claim(limit)
+        # 第二次取邮件说明线程处理完上一批后仍在运行；之后停在这里，不影响其他测试
+        next_batch.set()
+        threading.Event().wait()
+
+    def locked(mail_id):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(db, "claim_due_mail", claim_once)
+    monkeypatch.setattr(db, "mark_mail_sent", locked)
+    worker = mail_queue.MailQueue(workers=1)
+    worker.start()
+    assert next_batch.wait(5)
+    assert len(smtp_sink.messages) == 1
+    # 结果没有记下，邮件仍在租约中，过期后重新入队
+    assert _row(db, mail_id)["status"] == "sending"
+
+
+def test_start_replaces_dead_workers(queue, monkeypatch):
+    stop = threading.Event()
+    monkeypatch.setattr(queue, "_run", stop.wait)
+    queue.workers = 1
+    dead = threading.Thread(target=lambda: None)
+    dead.start()
+    dead.join()
+    queue._threads = [dead]
+    queue.start()
+    try:
+        assert queue._threads[0] is not dead and queue._threads[0].is_alive()
+        assert queue.stats()["restarts"] == 1
+    finally:
+        stop.set()
@@ -0,0 +1,29 @@
+import sqlite3
+
+import pytest
+
+
+def test_duplicate_logins_abort_migration(db, tmp_path, monkeypatch):
+    conn = sqlite3.connect(tmp_path / "old.db")
+    conn.row_factory = sqlite3.Row
+    try:
+        monkeypatch.setattr(db, "_MIGRATIONS", [m for m in db._MIGRATIONS if m[0] < 12])
+        db._migrate(conn)
+        conn.executemany(
+            "INSERT INTO users (name, email, prefer, verified) VALUES (?, ?, '[]', 1)",
+            [("amy", "amy@example.com"), ("amy", "other@example.com"), ("bob", "amy@example.com")],
+        )
+        conn.commit()
+        monkeypatch.undo()
+
+        with pytest.raises(RuntimeError) as info:
+            db._migrate(conn)
+        assert "用户名 'amy': 用户 id 1, 2" in str(info.value)
+        assert "邮箱 'amy@example.com': 用户 id 1, 3" in str(info.value)
+        # 迁移回滚，账号数据不变
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 11
+        assert [tuple(r) for r in conn.execute("SELECT name, email FROM users ORDER BY id")] == [
+            ("amy", "amy@example.com"), ("amy", "other@example.com"), ("bob", "amy@example.com"),
+        ]
+    finally:
+        conn.close()
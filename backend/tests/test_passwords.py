@@ -0,0 +1,22 @@
+import os
+
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+
+import passwords
+
+
+def test_saved_rounds_never_below_floor(tmp_path):
+    path = tmp_path / "bcrypt_rounds"
+    path.write_text("10\n")
+    assert passwords.calibrated_rounds(str(path)) == passwords.BCRYPT_MIN_ROUNDS >= 12
+
+
+def test_broken_pool_is_replaced():
+    hasher = passwords.PasswordHasher(workers=1, queue_limit=8)
+    # 子进程直接退出，相当于被 OOM 杀掉；重试的新进程池同样被杀，异常抛给调用方
+    with pytest.raises(BrokenProcessPool):
+        hasher._run(os._exit, 1)
+    assert hasher._run(passwords._check, b"secret", passwords._hash(b"secret", 4)) is True
+    assert hasher.stats()["pool_restarts"] == 2
+    hasher._executor.shutdown()
@@ -0,0 +1,10 @@
+def test_hot_queries_use_indexes(db):
+    plans = db.explain_hot_queries()
+    assert plans
+    assert db.find_full_scans(plans) == {}
+
+
+def test_full_scan_detection(db):
+    assert db.find_full_scans({"q": ["SCAN goods"]}) == {"q": ["SCAN goods"]}
+    assert db.find_full_scans({"q": ["SCAN goods_fts VIRTUAL TABLE INDEX 0:M2"]}) == {}
+    assert db.find_full_scans({"q": ["SEARCH goods USING INTEGER PRIMARY KEY (rowid=?)"]}) == {}
@@ -0,0 +1,51 @@
+import contextlib
+import threading
+import time
+
+
+def _seed(db):
+    seller = db.create_user("pool-seller", "pool@example.com", "x", verified=True)
+    return [db.create_good(f"随机 {i}", seller["id"], 1, 1.0, "")["id"] for i in range(3)]
+
+
+def test_writes_during_reload_are_kept(db, monkeypatch):
+    ids = _seed(db)
+    pool = db._AvailableGoodsPool(ttl=0)
+    connection = db._connection
+
+    @contextlib.contextmanager
+    def racing_connection():
+        # 读取在售商品期间，另一个线程上架了新商品、卖出了一个旧商品
+        pool.add(10**9, 0)
+        pool.discard(ids[0])
+        with connection() as conn:
+            yield conn
+
+    monkeypatch.setattr(db, "_connection", racing_connection)
+    sampled = pool.sample(0, 10**6)
+    assert 10**9 in sampled
+    assert ids[0] not in sampled
+    assert set(ids[1:]) <= set(sampled)
+
+
+def test_one_thread_reloads_expired_pool(db, monkeypatch):
+    pool = db._AvailableGoodsPool(ttl=60)
+    pool.sample(0, 1)
+    pool._loaded_at[0] = 0
+    loads = []
+    connection = db._connection
+
+    @contextlib.contextmanager
+    def slow_connection():
+        loads.append(1)
+        time.sleep(0.2)
+        with connection() as conn:
+            yield conn
+
+    monkeypatch.setattr(db, "_connection", slow_connection)
+    threads = [threading.Thread(target=pool.sample, args=(0, 1)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
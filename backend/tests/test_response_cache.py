@@ -0,0 +1,53 @@
+import time
+
+from response_cache import ResponseCache, _Entry
+
+
+def _load(cache, key, body=b"{}"):
+    entry, generation = cache.get(key)
+    if entry is None:
+        try:
+            cache.put(key, _Entry(body, "application/json"), generation)
+        finally:
+            cache.finish(key)
+
+
+def test_invalidated_tags_are_not_kept():
+    cache = ResponseCache(4, 60)
+    for i in range(100):
+        _load(cache, (f"good:{i}", None))
+        cache.invalidate(f"good:{i}")
+        cache.invalidate(f"user:{i}")
+    assert cache.stats()["tags"] == 0
+
+    # 被 LRU 淘汰的缓存项也不留下标签
+    for i in range(100):
+        _load(cache, (f"good:{i}", None))
+    assert cache.stats()["size"] == 4
+    assert cache.stats()["tags"] == 4
+
+
+def test_invalidation_during_load_skips_put():
+    cache = ResponseCache(4, 60)
+    key = ("good:1", None)
+    entry, generation = cache.get(key)
+    assert entry is None
+    cache.invalidate("good:1")
+    cache.put(key, _Entry(b"stale", "application/json"), generation)
+    cache.finish(key)
+    assert cache.get(key)[0] is None
+    cache.finish(key)
+    assert cache.stats()["tags"] == 0
+
+
+def test_entries_expire_after_max_age():
+    cache = ResponseCache(4, 0.05)
+    key = ("good:1", None)
+    _load(cache, key)
+    assert cache.get(key)[0] is not None
+    time.sleep(0.06)
+    # 其他进程的写入不会通知本进程，过期后重新生成
+    assert cache.get(key)[0] is None
+    cache.finish(key)
+    assert cache.stats()["expired"] == 1
+    assert cache.stats()["tags"] == 0
@@ -0,0 +1,27 @@
+import sqlite3
+
+
+def test_bigram_index_follows_goods_writes(db):
+    seller = db.create_user("bigram-seller", "bigram@example.com", "x", verified=True)
+    good = db.create_good("小米台灯", seller["id"], 1, 10.0, "宿舍自提")
+    assert [g["id"] for g in db.search_goods("台灯")] == [good["id"]]
+
+    db.update_good_status(good["id"], "sold")
+    assert db.search_goods("台灯") == []
+    db.update_good_status(good["id"], "available")
+    assert [g["id"] for g in db.search_goods("自提")] == [good["id"]]
+
+
+def test_goods_writable_without_module_connection(db):
+    # 不经过 db 模块的连接（如 sqlite3 命令行）也能写 goods
+    conn = sqlite3.connect(db.DB_PATH)
+    try:
+        seller_id = conn.execute("SELECT id FROM users LIMIT 1").fetchone()[0]
+        conn.execute(
+            "INSERT INTO goods (seller_id, name, num, sold_num, labels, value, description) VALUES (?, '外部', 1, 0, '[]', 1, '')",
+            (seller_id,),
+        )
+        conn.execute("UPDATE goods SET name = '外部写入' WHERE name = '外部'")
+        conn.commit()
+    finally:
+        conn.close()
@@ -0,0 +1,33 @@
+import io
+import os
+
+import pytest
+
+
+@pytest.fixture
+def client(db, monkeypatch, tmp_path):
+    import app as app_module
+    import mail_queue
+    import session_reaper
+    import uploads
+
+    monkeypatch.setattr(mail_queue, "start", lambda: None)
+    monkeypatch.setattr(session_reaper, "start", lambda: None)
+    monkeypatch.setattr(uploads, "UPLOAD_TMP_DIR", str(tmp_path / "upload_tmp"))
+    return app_module.app.test_client()
+
+
+def test_other_endpoints_accept_any_file_part(client):
+    response = client.post("/user/register", data={"email": "a@example.com", "note": (io.BytesIO(b"plain text, not an image"), "note.txt")})
+    # 到达注册视图（缺少字段），而不是被上传检查拒绝
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Name is required"
+
+
+def test_upload_endpoint_sniffs_files_outside_media(client, tmp_path, db):
+    response = client.post("/upload", data={
+        "type": "good", "id": "1", "files": (io.BytesIO(b"plain text, not an image"), "a.png"),
+    })
+    assert response.status_code == 415
+    assert (tmp_path / "upload_tmp").is_dir()
+    assert not os.path.exists(os.path.join(db.MEDIA_DIR, "tmp"))
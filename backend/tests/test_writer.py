@@ -0,0 +1,53 @@
+import sqlite3
+import threading
+
+import pytest
+
+
+def test_failed_connection_fails_pending_writes(db, monkeypatch):
+    writer = db._Writer(batch=8)
+
+    def broken_conn():
+        raise sqlite3.OperationalError("unable to open database file")
+
+    monkeypatch.setattr(db, "_get_conn", broken_conn)
+    with pytest.raises(sqlite3.OperationalError):
+        writer.submit(lambda conn: conn.execute("SELECT 1"))
+
+    # 连接恢复后，同一个写线程继续工作
+    monkeypatch.undo()
+    assert writer.submit(lambda conn: conn.execute("SELECT 1").fetchone()[0]) == 1
+
+
+def test_failed_rollback_reopens_connection(db):
+    writer = db._Writer(batch=8)
+    assert writer.submit(lambda conn: 1) == 1
+    first = writer._conn
+
+    class BrokenConn:
+        in_transaction = True
+
+        def execute(self, sql):
+            raise sqlite3.OperationalError("disk I/O error")
+
+        def close(self):
+            pass
+
+    writer._conn = BrokenConn()
+    with pytest.raises(sqlite3.OperationalError):
+        writer.submit(lambda conn: 1)
+    assert writer.submit(lambda conn: conn.execute("SELECT 2").fetchone()[0]) == 2
+    assert writer._conn is not first
+
+
+def test_dead_writer_thread_is_restarted(db):
+    writer = db._Writer(batch=8)
+    # 一个已经结束的线程，相当于写线程意外退出
+    dead = threading.Thread(target=lambda: None)
+    dead.start()
+    dead.join()
+    writer._thread = dead
+
+    assert writer.submit(lambda conn: conn.execute("SELECT 3").fetchone()[0]) == 3
+    assert writer._thread is not dead and writer._thread.is_alive()
+    assert writer.stats()["restarts"] == 1
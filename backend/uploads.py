@@ -0,0 +1,195 @@
+"""
+上传文件的流式接收与内容寻址存储。
+- 上传接口（UploadRequest.upload_endpoints）解析 multipart 时，每个文件按块直接写入 UPLOAD_TMP_DIR
+  下的临时文件，同时计算 SHA-256；
+  超过该类型的大小上限或文件头不是支持的格式时立即中止，不必先收完整个文件
+- 文件类型按文件头（magic bytes）判断，不信任客户端给的扩展名
+- 内容相同的文件只存一份：media/blobs/<哈希前两位>/<哈希>.<扩展名>，
+  商品通过 goods_media 中的路径引用，不再被任何商品引用的文件才会被删除
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from typing import List, Optional, Tuple
+
+from flask import Request
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+import db as db_module
+import media
+
+# 整个请求体的上限（字节），作为 Flask 的 MAX_CONTENT_LENGTH，超过时不读取请求体直接返回 413
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 512 * 1024 * 1024))
+# 单个文件的上限，按识别出的类型区分
+UPLOAD_IMAGE_MAX_BYTES = int(os.environ.get("UPLOAD_IMAGE_MAX_BYTES", 10 * 1024 * 1024))
+UPLOAD_VIDEO_MAX_BYTES = int(os.environ.get("UPLOAD_VIDEO_MAX_BYTES", 200 * 1024 * 1024))
+
+BLOB_DIR = "blobs"
+# 上传文件的临时目录。不放在对外提供的 media 目录下；默认与 media 目录同级，同一文件系统上保存时用硬链接
+UPLOAD_TMP_DIR = os.environ.get("UPLOAD_TMP_DIR")
+VIDEO_TYPES = {"mp4", "mov", "avi"}
+# 识别文件类型需要的文件头长度
+_SNIFF_BYTES = 12
+
+# 写入 blob 与删除不再引用的 blob 互斥，避免刚被新上传复用的文件被当作孤儿删掉
+_store_lock = threading.Lock()
+
+
+def sniff(header: bytes) -> Optional[str]:
+    """根据文件头识别类型，返回规范扩展名；不支持的格式返回 None"""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"AVI ":
+        return "avi"
+    if header[4:8] == b"ftyp":
+        return "mov" if header[8:12] == b"qt  " else "mp4"
+    return None
+
+
+def size_limit(kind: str) -> int:
+    return UPLOAD_VIDEO_MAX_BYTES if kind in VIDEO_TYPES else UPLOAD_IMAGE_MAX_BYTES
+
+
+class HashingFile:
+    """multipart 解析器写入的文件对象：边写边计算哈希、识别类型、检查大小"""
+
+    def __init__(self, directory: str):
+        # 关闭（请求结束）时自动删除；保存时用硬链接留下内容
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix="upload_")
+        self.name = self._file.name
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.kind: Optional[str] = None
+        self._header = b""
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.kind is None:
+            self._header += data[:_SNIFF_BYTES - len(self._header)]
+            if len(self._header) >= _SNIFF_BYTES:
+                self.kind = sniff(self._header)
+                if self.kind is None:
+                    raise UnsupportedMediaType("Unsupported file type")
+        if self.size > size_limit(self.kind or ""):
+            raise RequestEntityTooLarge("File too large")
+        self.sha256.update(data)
+        return self._file.write(data)
+
+    def finish(self) -> Optional[str]:
+        """文件接收完毕后调用，返回识别出的类型（不足一个文件头长度的文件在这里识别）"""
+        if self.kind is None:
+            self.kind = sniff(self._header)
+        self._file.flush()
+        return self.kind
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def tmp_dir() -> str:
+    return UPLOAD_TMP_DIR or os.path.join(os.path.dirname(os.path.abspath(db_module.MEDIA_DIR)), "upload_tmp")
+
+
+class UploadRequest(Request):
+    """
+    请求类（app.request_class）：upload_endpoints 中的接口把上传文件写入 HashingFile；
+    其他接口（如带文件字段的注册表单）按 Flask 默认方式接收，不做类型与大小检查
+    """
+
+    upload_endpoints = frozenset()
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint not in self.upload_endpoints:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        directory = tmp_dir()
+        os.makedirs(directory, exist_ok=True)
+        return HashingFile(directory)
+
+
+def file_kind(upload: FileStorage) -> Optional[str]:
+    """上传文件的实际类型（规范扩展名）；不是经 UploadRequest 接收的文件或格式不支持时返回 None"""
+    if not isinstance(upload.stream, HashingFile):
+        return None
+    return upload.stream.finish()
+
+
+def content_hash(upload: FileStorage) -> str:
+    """上传文件内容的 SHA-256（十六进制）"""
+    upload.stream.finish()
+    return upload.stream.sha256.hexdigest()
+
+
+def _link(source: str, dest: str) -> None:
+    """把临时文件的内容原子地放到 dest（同一文件系统上用硬链接，不复制数据）"""
+    staging = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, staging)
+    except OSError:
+        shutil.copyfile(source, staging)
+    os.chmod(staging, 0o644)
+    os.replace(staging, dest)
+
+
+def store(upload: FileStorage, root: str) -> Tuple[str, bool]:
+    """
+    按内容哈希保存一个已通过 file_kind 检查的上传文件。
+    返回 (相对 root 的路径, 是否新写入)；相同内容已存在时不再写盘。
+    """
+    stream = upload.stream
+    kind = stream.finish()
+    digest = stream.sha256.hexdigest()
+    path = f"{BLOB_DIR}/{digest[:2]}/{digest}.{kind}"
+    dest = os.path.join(root, path)
+    if os.path.exists(dest):
+        return path, False
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    _link(stream.name, dest)
+    return path, True
+
+
+def save_as(upload: FileStorage, dest: str) -> None:
+    """把上传文件保存到固定路径（如头像），覆盖已有文件"""
+    upload.stream.finish()
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    _link(upload.stream.name, dest)
+
+
+def _remove(root: str, path: str) -> None:
+    full = os.path.join(root, path)
+    try:
+        os.remove(full)
+    except OSError:
+        pass
+    media.remove_variants(full)
+
+
+def replace_good_media(good_id: int, files: List[FileStorage], root: str) -> List[str]:
+    """保存商品的上传文件并替换其 goods_media 记录，删除不再被引用的旧文件。返回新的路径列表。"""
+    with _store_lock:
+        stored = []
+        try:
+            for upload in files:
+                stored.append(store(upload, root))
+            paths = [path for path, _ in stored]
+            orphans = db_module.set_good_media(good_id, paths)
+        except BaseException:
+            # 本次新写入的文件还没有任何记录引用（已存在的同内容文件不动）
+            for path, created in stored:
+                if created:
+                    _remove(root, path)
+            raise
+        for orphan in orphans:
+            _remove(root, orphan)
+    # 只有新写入的文件需要生成缩略图等变体，重复内容沿用已有变体
+    for path, created in stored:
+        if created:
+            media.submit(os.path.join(root, path))
+    return paths
@@ -1,6 +1,12 @@
 import { reactive } from 'vue'
 import { API_BASE_URL } from './config.js'
 
+// 消息历史每页条数
+const MESSAGE_PAGE_SIZE = 50
+
+// 后端返回的 /media 相对路径补全为完整 URL，其他链接（默认头像等）原样返回
+const mediaUrl = url => (url && url.startsWith('/media') ? `${API_BASE_URL}${url}` : url)
+
 // 仅保留 任务(Tasks) 和 消息(Chat) 的 Mock 数据
 const MOCK_TASKS = [
   { id: 't1', title: '北门取快递', status: '待接单', bounty: 5, location: '北门 -> A栋', notes: '文件袋', createdAt: Date.now() },
@@ -12,6 +18,8 @@ export const store = reactive({
     items: [],
     tasks: [...MOCK_TASKS],
     messages: [],
+    messagesPeerId: null, // 当前 messages 属于与哪个用户的对话
+    messagesCursor: null, // 已从服务器同步到的最大消息 id，轮询时只拉取更新的消息
     users: {} // 缓存用户信息
   },
 
@@ -84,6 +92,8 @@ export const store = reactive({
     // 清除本地状态
     this.state.currentUser = null
     this.state.messages = []
+    this.state.messagesPeerId = null
+    this.state.messagesCursor = null
     this.state.users = {}
     localStorage.removeItem('user')
     try { sessionStorage.removeItem('auth_token') } catch (e) {}
@@ -91,14 +101,8 @@ export const store = reactive({
 
   // 辅助：更新本地用户状态并持久化
   updateUser(userData) {
-    // 强制刷新头像缓存 (后端覆盖文件，浏览器可能缓存)
-    if (userData.avatar) {
-        // 如果包含 media 路径但不包含 host，拼接一下 (视后端返回情况而定)
-        if (userData.avatar.startsWith('/media')) {
-            userData.avatar = `${API_BASE_URL}${userData.avatar}`
-        }
-        userData.avatar = `${userData.avatar}?t=${new Date().getTime()}`
-    }
+    // 头像文件名带内容哈希，换头像后链接即改变，不需要额外的缓存刷新参数
+    userData.avatar = mediaUrl(userData.avatar)
     this.state.currentUser = userData
     localStorage.setItem('user', JSON.stringify(userData))
   },
@@ -115,29 +119,14 @@ export const store = reactive({
   // --- 获取商品 (适配后端，额外获取图片) ---
   async fetchItems() {
     try {
+      // 列表接口已附带每个商品的图片链接（image_urls），一次请求即可
       const res = await fetch(`${API_BASE_URL}/goods/random?num=20`)
       if (res.ok) {
         const rawData = await res.json()
-        
-        // 并行请求所有商品的图片
-        const itemsWithImages = await Promise.all(rawData.map(async (item) => {
-          let imageUrls = []
-          try {
-            // 调用后端获取该商品的图片链接
-            const imgRes = await fetch(`${API_BASE_URL}/good/${item.id}/images`)
-            if (imgRes.ok) {
-              const imgData = await imgRes.json()
-              // 后端返回 { image_urls: [...] }
-              if (imgData.image_urls && imgData.image_urls.length > 0) {
-                // 补全 URL 前缀
-                imageUrls = imgData.image_urls.map(url => `${API_BASE_URL}${url}`)
-              }
-            }
-          } catch (err) {
-            console.warn(`Failed to fetch images for good ${item.id}`)
-          }
 
-          // 如果没有图片，给一个默认占位图
+        this.state.items = rawData.map(item => {
+          // 补全 URL 前缀；没有图片时给一个默认占位图
+          let imageUrls = (item.image_urls || []).map(url => `${API_BASE_URL}${url}`)
           if (imageUrls.length === 0) {
             imageUrls = ['https://via.placeholder.com/400x300?text=No+Image']
           }
@@ -150,11 +139,11 @@ export const store = reactive({
             sellerId: item.seller_id,
             status: item.status === 'available' ? '在售' : '已售',
             images: imageUrls,
+            // 列表卡片用缩小后的图片，服务端按 w 选择尺寸
+            cover: item.image_urls?.length ? `${imageUrls[0]}?w=640` : imageUrls[0],
             category: '闲置'
           }
-        }))
-
-        this.state.items = itemsWithImages
+        })
       }
     } catch (e) {
       console.error(e)
@@ -264,22 +253,8 @@ export const store = reactive({
           credentials: 'include'
         })
         if (res.ok) {
-            const userData = await res.json()
-            // 补充头像逻辑：如果是相对路径，且后端get_user_info返回的avatar是接口生成的
-            // 后端 app.py 的 get_user_info 现在返回的是picsum默认图。
-            // 我们需要手动请求一下 /user/<id>/avatar 接口确认是否有真实头像
-            
-            const avatarRes = await fetch(`${API_BASE_URL}/user/${userData.id}/avatar`, {
-              headers: this.authHeaders(),
-              credentials: 'include'
-            })
-            if (avatarRes.ok) {
-                const avatarData = await avatarRes.json()
-                if (avatarData.avatar_url) {
-                    userData.avatar = avatarData.avatar_url
-                }
-            }
-            this.updateUser(userData)
+            // 用户信息已附带头像链接，无需再请求 /user/<id>/avatar
+            this.updateUser(await res.json())
         }
     } catch(e) { console.error(e) }
   },
@@ -312,8 +287,8 @@ export const store = reactive({
       const data = await res.json()
 
       if (res.ok) {
-        // 将消息添加到本地状态
-        this.state.messages.push(data)
+        // 推送流可能先于响应送达同一条消息，按 id 合并
+        if (this.state.messagesPeerId === receiverId) this.mergeMessages([data])
         return { success: true, message: data }
       } else {
         return { success: false, message: data.error || '发送失败' }
@@ -324,23 +299,43 @@ export const store = reactive({
     }
   },
 
-  async loadMessagesWithUser(userId) {
+  // 加载与某用户的消息：切换对话时取最新一页，之后只取 messagesCursor 之后的新消息；
+  // 传入 beforeId 时向上加载更早的一页
+  async loadMessagesWithUser(userId, { beforeId = null } = {}) {
     if (!this.state.currentUser) {
       return { success: false, message: '请先登录' }
     }
 
+    const sameChat = this.state.messagesPeerId === userId
+    const params = new URLSearchParams({ limit: MESSAGE_PAGE_SIZE })
+    if (beforeId) {
+      params.set('before_id', beforeId)
+    } else if (sameChat && this.state.messagesCursor) {
+      params.set('after_id', this.state.messagesCursor)
+    }
+
     try {
-      const res = await fetch(`${API_BASE_URL}/messages/${userId}`, {
+      const res = await fetch(`${API_BASE_URL}/messages/${userId}?${params}`, {
         method: 'GET',
         headers: this.authHeaders(),
         credentials: 'include'
       })
 
       if (res.ok) {
-        const messages = await res.json()
-        // 更新状态中的消息 (只保留与当前用户的对话)
-        this.state.messages = messages
-        return { success: true }
+        const page = await res.json()
+        if (!sameChat) {
+          // 切换了对话：替换为新对话的最新一页
+          this.state.messages = page
+          this.state.messagesPeerId = userId
+        } else {
+          // 本地发送或推送来的消息可能已在列表中
+          this.mergeMessages(page)
+        }
+        if (!sameChat) this.state.messagesCursor = null
+        if (!beforeId && page.length > 0) {
+          this.state.messagesCursor = Math.max(this.state.messagesCursor || 0, page[page.length - 1].id)
+        }
+        return { success: true, hasMore: page.length === MESSAGE_PAGE_SIZE }
       } else {
         console.error('加载消息失败')
         return { success: false, message: '加载消息失败' }
@@ -351,6 +346,57 @@ export const store = reactive({
     }
   },
 
+  // 打开新消息推送流（SSE），推送来的消息会合并进当前对话。返回 EventSource，调用方负责 close()
+  openMessageStream({ onMessage, onOpen, onError } = {}) {
+    let url = `${API_BASE_URL}/messages/stream`
+    try {
+      // EventSource 不能设置 Authorization 头，token 模式下通过查询参数传递
+      const token = sessionStorage.getItem('auth_token')
+      if (token) url += `?token=${encodeURIComponent(token)}`
+    } catch (e) {}
+
+    const source = new EventSource(url, { withCredentials: true })
+    source.addEventListener('message', (e) => {
+      const msg = JSON.parse(e.data)
+      this.receiveMessage(msg)
+      if (onMessage) onMessage(msg)
+    })
+    if (onOpen) source.onopen = onOpen
+    if (onError) source.onerror = onError
+    return source
+  },
+
+  // 按 id 去重后并入当前对话，保持按 id 升序（补拉的消息可能比已推送的消息更早）
+  mergeMessages(incoming) {
+    const known = new Set(this.state.messages.map(m => m.id))
+    const fresh = incoming.filter(m => !known.has(m.id))
+    if (fresh.length === 0) return
+    this.state.messages = [...this.state.messages, ...fresh].sort((a, b) => a.id - b.id)
+  },
+
+  // 把推送来的消息并入当前对话。对方发来的消息已被看到，同步标记已读。
+  // 不推进 messagesCursor：断线重连后仍从上次拉取的位置补齐，避免漏掉断线期间的消息
+  receiveMessage(msg) {
+    const me = this.state.currentUser && this.state.currentUser.id
+    const peerId = msg.senderId === me ? msg.receiverId : msg.senderId
+    if (peerId !== this.state.messagesPeerId) return
+    this.mergeMessages([msg])
+    if (msg.senderId !== me) this.markConversationRead(peerId)
+  },
+
+  async markConversationRead(userId) {
+    try {
+      await fetch(`${API_BASE_URL}/messages/${userId}/read`, {
+        method: 'POST',
+        headers: this.authHeaders(),
+        credentials: 'include'
+      })
+      if (this.state.users[userId]) this.state.users[userId].unreadCount = 0
+    } catch (e) {
+      console.error('标记已读失败:', e)
+    }
+  },
+
   async loadChatUsers() {
     if (!this.state.currentUser) {
       return { success: false, message: '请先登录' }
@@ -367,6 +413,7 @@ export const store = reactive({
         const users = await res.json()
         // 缓存这些用户信息
         users.forEach(u => {
+          u.avatar = mediaUrl(u.avatar)
           this.state.users[u.id] = u
         })
         return { success: true, users }